@@ -0,0 +1,29 @@
+import numpy as np
+import torch
+
+from torch.autograd import Variable
+
+# Helpers for running the forward and backward directions of a recurrence as
+# one batch, shared by the qNet, rNet and MatchLSTM models.
+
+# Reverse the input along its first (time) dimension.
+def reverse(vals):
+  idxs = torch.arange(vals.size()[0] - 1, -1, -1).long()
+  if vals.is_cuda:
+    idxs = idxs.cuda()
+  return torch.index_select(vals, 0, Variable(idxs, requires_grad = False))
+
+# Stack the input and its time-reversed copy along the batch dimension, so
+# that forward and backward directions can be run as one batch.
+# vals.shape = (seq_len, batch, ...)
+# Returned shape = (seq_len, 2 * batch, ...)
+def stack_directions(vals):
+  return torch.cat((vals, reverse(vals)), dim=1)
+
+# Mask of the unpadded positions of each example at every time step, for
+# forward and backward directions stacked along the batch dimension.
+# Built once per batch, and indexed by time step inside the recurrence.
+# Returned shape = (max_len, 2 * batch, 1)
+def get_fused_masks(max_len, lens):
+  mask = np.arange(max_len)[:, None] < np.array(lens)[None, :]
+  return np.concatenate((mask, mask[::-1]), axis=1)[:, :, None]
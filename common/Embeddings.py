@@ -0,0 +1,100 @@
+import hashlib
+import numpy as np
+import os
+
+# Initialization of the embeddings of words without pre-trained vectors, from
+# the statistics of the known embeddings.
+
+# Number of embeddings processed at a time by the statistics and samplers
+# below, to bound their float64 temporaries.
+embedding_block_size = 100000
+
+# Sample mean and covariance of the embeddings (rows) selected by the mask,
+# computed blockwise in float64. If diagonal, only the per-dimension variances
+# are computed.
+def embedding_statistics(embeddings, mask, diagonal=False):
+  embed_size = embeddings.shape[1]
+  num_embeddings = mask.sum()
+  total = np.zeros(embed_size)
+  for start in range(0, len(embeddings), embedding_block_size):
+    block = embeddings[start:start+embedding_block_size]
+    total += block[mask[start:start+embedding_block_size]].sum(axis=0, dtype=np.float64)
+  mean = total / num_embeddings
+  covar = np.zeros(embed_size) if diagonal else \
+          np.zeros((embed_size, embed_size))
+  for start in range(0, len(embeddings), embedding_block_size):
+    block = embeddings[start:start+embedding_block_size]
+    block = block[mask[start:start+embedding_block_size]] - mean
+    covar += (block * block).sum(axis=0) if diagonal else np.dot(block.T, block)
+  return mean, covar / max(num_embeddings - 1, 1)
+
+# Mean and Cholesky factor of the covariance of the known embeddings. They are
+# cached in the given file, for the given key (e.g. a hash of the known
+# words and the vectors file version), so that later model builds over the same
+# vocabulary skip the covariance computation.
+def cholesky_statistics(embeddings, found, cache_filename, key):
+  if cache_filename is not None and os.path.exists(cache_filename):
+    with np.load(cache_filename) as cached:
+      if str(cached['key']) == key:
+        return cached['mean'], cached['factor']
+  mean, covar = embedding_statistics(embeddings, found)
+  # A small jitter keeps the factorization stable for near-singular covariances.
+  jitter = 1e-10 * np.trace(covar) / len(covar)
+  factor = np.linalg.cholesky(covar + jitter * np.eye(len(covar)))
+  if cache_filename is not None:
+    try:
+      with open(cache_filename + ".tmp", "wb") as fout:
+        np.savez(fout, key=key, mean=mean, factor=factor)
+      os.rename(cache_filename + ".tmp", cache_filename)
+    except (IOError, OSError) as e:
+      print "Could not cache embedding statistics (%s)." % e
+  return mean, factor
+
+# Initialize embeddings of words without pre-trained vectors (where found is
+# False) by sampling from a normal distribution, with mean and covariance as
+# sample mean and covariance of the known embeddings. Methods:
+#   full: numpy's multivariate_normal with the full covariance.
+#   diagonal: independent dimensions with the per-dimension variances.
+#   cholesky: full covariance, sampled through its Cholesky factor, which is
+#             cached next to the vectors file.
+# embeddings are filled in place.
+def init_unknown_embeddings(embeddings, found, method, np_rng,
+                            vectors_path=None, known_words=None):
+  unknown_idxs = np.flatnonzero(~found)
+  if len(unknown_idxs) == 0:
+    return
+  embed_size = embeddings.shape[1]
+  if method == "full":
+    known_embeddings = embeddings[found]
+    known_mean = np.mean(known_embeddings, axis=0)
+    known_covar = np.cov(known_embeddings, rowvar=0)
+    embeddings[unknown_idxs] = \
+      np_rng.multivariate_normal(mean=known_mean, cov=known_covar,
+                                 size=len(unknown_idxs)).astype(np.float32)
+    return
+
+  if method == "diagonal":
+    mean, variances = embedding_statistics(embeddings, found, diagonal=True)
+    std = np.sqrt(variances)
+  elif method == "cholesky":
+    cache_filename, key = None, None
+    if vectors_path is not None and known_words is not None:
+      cache_filename = vectors_path + ".cholesky.npz"
+      key = hashlib.sha1(str(os.path.getmtime(vectors_path)))
+      for word in known_words:
+        if isinstance(word, unicode):
+          word = word.encode("utf8")
+        key.update(word + "\n")
+      key = key.hexdigest()
+    mean, factor = cholesky_statistics(embeddings, found, cache_filename, key)
+  else:
+    assert False, "Unrecognized unknown embedding initialization: %s" % method
+
+  for start in range(0, len(unknown_idxs), embedding_block_size):
+    idxs = unknown_idxs[start:start+embedding_block_size]
+    samples = np_rng.standard_normal((len(idxs), embed_size))
+    if method == "diagonal":
+      samples = mean + samples * std
+    else:
+      samples = mean + np.dot(samples, factor.T)
+    embeddings[idxs] = samples
@@ -0,0 +1,34 @@
+import numpy as np
+
+# F1 scores of candidate answer spans against the true answer span, for the
+# expected F1 loss. Spans are (start, end) token indices, both inclusive.
+
+def f1_score(start, end, ans_start_idx, ans_end_idx):
+  # Get the F1 score for two given ranges: candidate range and true range.
+  if end < start:
+    return 0.0
+  intersection = min(end, ans_end_idx) - max(start, ans_start_idx)
+  if intersection < 0:
+    return 0.0
+  intersection += 1
+  true = ans_end_idx - ans_start_idx + 1
+  ours = end - start + 1
+  precision = intersection/float(ours)
+  recall = intersection/float(true)
+  return 2 * precision * recall / (precision + recall)
+
+# Get the F1 scores (as given by f1_score) of all candidate ranges with start
+# in [0, ans_end_idx] and end in [ans_start_idx, para_len), against the true
+# range. Returned matrix shape = (ans_end_idx + 1, para_len - ans_start_idx).
+def f1_partial_matrix(ans_start_idx, ans_end_idx, para_len):
+  starts = np.arange(ans_end_idx + 1)[:, None]
+  ends = np.arange(ans_start_idx, para_len)[None, :]
+  intersection = np.minimum(ends, ans_end_idx) - \
+                 np.maximum(starts, ans_start_idx) + 1
+  true = ans_end_idx - ans_start_idx + 1
+  ours = ends - starts + 1
+  with np.errstate(divide='ignore', invalid='ignore'):
+    precision = intersection/ours.astype(float)
+    recall = intersection/float(true)
+    f1 = 2 * precision * recall / (precision + recall)
+  return np.where((ends >= starts) & (intersection > 0), f1, 0.0)
@@ -0,0 +1,125 @@
+import numpy
+import os
+import tempfile
+
+# Reading of pre-trained word vectors, shared by the qNet, rNet and MatchLSTM
+# models.
+
+# Parse the given line of a text vectors file into (word, vector). Words may
+# contain spaces, so the vector is taken as the last embed_size fields when the
+# line doesn't split at its first space. Returns None for the header line of
+# fastText files, and for malformed lines.
+def parse_vector_line(line, embed_size):
+  line = line.rstrip()
+  split_at = line.find(" ")
+  if split_at <= 0:
+    return None
+  vector = numpy.fromstring(line[split_at+1:], dtype=numpy.float32, sep=" ")
+  if len(vector) == embed_size:
+    return line[:split_at], vector
+  fields = line.rsplit(" ", embed_size)
+  if len(fields) != embed_size + 1:
+    return None
+  try:
+    return fields[0], numpy.array(fields[1:], dtype=numpy.float32)
+  except ValueError:
+    return None
+
+# Create a uniquely named temporary file next to the given path, so that
+# concurrent conversions don't write to the same file, and the rename to the
+# path stays on one filesystem. Returns its open file descriptor and name.
+def make_temp_file(path, suffix):
+  return tempfile.mkstemp(suffix=suffix + ".tmp",
+                          prefix=os.path.basename(path) + ".",
+                          dir=os.path.dirname(os.path.abspath(path)))
+
+# Convert a text vectors file into a binary float32 matrix (vectors_path.npy)
+# and its list of words, one per line (vectors_path.words). Files are written
+# under temporary names and renamed when complete.
+def convert_vectors(vectors_path, embed_size):
+  with open(vectors_path) as fin:
+    num_lines = sum(1 for _ in fin)
+  matrix_fd, matrix_path = make_temp_file(vectors_path, ".npy")
+  words_fd, words_path = make_temp_file(vectors_path, ".words")
+  os.close(matrix_fd)
+  try:
+    matrix = numpy.lib.format.open_memmap(matrix_path, mode="w+",
+                                          dtype=numpy.float32,
+                                          shape=(num_lines, embed_size))
+    num_words = 0
+    with open(vectors_path) as fin, os.fdopen(words_fd, "w") as fout:
+      for line in fin:
+        parsed = parse_vector_line(line, embed_size)
+        if parsed is None:
+          continue
+        fout.write(parsed[0] + "\n")
+        matrix[num_words] = parsed[1]
+        num_words += 1
+    matrix.flush()
+    del matrix
+    # mkstemp creates files readable only by their owner.
+    for path in [matrix_path, words_path]:
+      os.chmod(path, 0644)
+    # Words are written last, as the presence of the word list marks a
+    # complete conversion.
+    os.rename(matrix_path, vectors_path + ".npy")
+    os.rename(words_path, vectors_path + ".words")
+  except:
+    for path in [matrix_path, words_path]:
+      if os.path.exists(path):
+        os.remove(path)
+    raise
+
+# Whether the binary conversion of the vectors file exists, for the given
+# dimension, and is newer than the vectors file.
+def has_converted_vectors(vectors_path, embed_size):
+  for suffix in [".npy", ".words"]:
+    if not os.path.exists(vectors_path + suffix) or \
+       os.path.getmtime(vectors_path + suffix) < os.path.getmtime(vectors_path):
+      return False
+  matrix = numpy.load(vectors_path + ".npy", mmap_mode="r")
+  return matrix.shape[1] == embed_size
+
+# Read the pre-trained vectors of the words in word_to_index. On first use,
+# the text vectors file is converted into a binary matrix and a word list next
+# to it. Later reads memory-map the matrix, and only gather the rows of the
+# words in the vocabulary. If the conversion can't be written, the text file
+# is read directly.
+# Returns the embeddings, with zeros for words not found, and a mask of the
+# words found.
+# embeddings.shape = (vocab_size, embed_size)
+# found.shape = (vocab_size)
+def read_vectors(vectors_path, word_to_index, vocab_size, embed_size):
+  embeddings = numpy.zeros((vocab_size, embed_size), dtype=numpy.float32)
+  found = numpy.zeros(vocab_size, dtype=bool)
+  if not has_converted_vectors(vectors_path, embed_size):
+    try:
+      convert_vectors(vectors_path, embed_size)
+    except (IOError, OSError) as e:
+      print "Could not convert vectors file (%s). Reading text vectors." % e
+      # Lines are filtered on their parsed word, which may contain spaces.
+      with open(vectors_path) as fin:
+        for line in fin:
+          parsed = parse_vector_line(line, embed_size)
+          if parsed is not None and parsed[0] in word_to_index:
+            embeddings[word_to_index[parsed[0]]] = parsed[1]
+            found[word_to_index[parsed[0]]] = True
+      return embeddings, found
+
+  # Row of each vocabulary word in the matrix. Later duplicates of a word
+  # take precedence, as they would reading the text file.
+  rows = {}
+  with open(vectors_path + ".words") as fin:
+    for row, word in enumerate(fin):
+      word = word[:-1]
+      if word in word_to_index:
+        rows[word_to_index[word]] = row
+  if len(rows) > 0:
+    # Gather rows in file order, for sequential reads of the matrix.
+    idxs = numpy.array(rows.keys())
+    rows = numpy.array(rows.values())
+    order = numpy.argsort(rows)
+    matrix = numpy.load(vectors_path + ".npy", mmap_mode="r")
+    embeddings[idxs[order]] = matrix[rows[order]]
+    found[idxs] = True
+  return embeddings, found
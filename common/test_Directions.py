@@ -0,0 +1,31 @@
+import numpy as np
+import torch
+
+from Directions import get_fused_masks, reverse, stack_directions
+from torch.autograd import Variable
+
+# The per-step mask that get_fused_masks replaced.
+def get_fused_mask_loop(t, max_len, lens, batch_size):
+  mask_f = [ [1.0] if t < lens[i] else [0.0] for i in range(batch_size) ]
+  mask_b = [ [1.0] if max_len-t-1 < lens[i] else [0.0] \
+               for i in range(batch_size) ]
+  return np.array(mask_f + mask_b)
+
+def test_fused_masks_match_per_step_masks():
+  rng = np.random.RandomState(0)
+  for trial in range(50):
+    batch_size = rng.randint(1, 6)
+    max_len = rng.randint(1, 20)
+    lens = rng.randint(1, max_len + 1, batch_size).tolist()
+    masks = get_fused_masks(max_len, lens)
+    assert masks.shape == (max_len, 2 * batch_size, 1)
+    for t in range(max_len):
+      assert np.array_equal(masks[t],
+                            get_fused_mask_loop(t, max_len, lens, batch_size))
+
+def test_stack_directions_reverses_time():
+  vals = Variable(torch.arange(24).view(4, 2, 3))
+  stacked = stack_directions(vals).data.numpy()
+  assert np.array_equal(stacked[:, :2], vals.data.numpy())
+  assert np.array_equal(stacked[:, 2:], vals.data.numpy()[::-1])
+  assert np.array_equal(reverse(reverse(vals)).data.numpy(), vals.data.numpy())
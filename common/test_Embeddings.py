@@ -0,0 +1,41 @@
+import numpy as np
+import os
+
+import Embeddings
+
+from Embeddings import embedding_statistics, init_unknown_embeddings
+
+def random_embeddings(rng, vocab_size, embed_size):
+  embeddings = rng.randn(vocab_size, embed_size).astype(np.float32)
+  found = rng.uniform(size=vocab_size) < 0.7
+  embeddings[~found] = 0
+  return embeddings, found
+
+def test_blockwise_statistics_match_numpy(monkeypatch):
+  monkeypatch.setattr(Embeddings, 'embedding_block_size', 7)
+  rng = np.random.RandomState(0)
+  embeddings, found = random_embeddings(rng, 50, 4)
+  mean, covar = embedding_statistics(embeddings, found)
+  assert np.allclose(mean, embeddings[found].mean(axis=0))
+  assert np.allclose(covar, np.cov(embeddings[found], rowvar=0))
+  mean, variances = embedding_statistics(embeddings, found, diagonal=True)
+  assert np.allclose(variances, embeddings[found].var(axis=0, ddof=1))
+
+def test_unknown_embeddings_are_sampled(tmpdir):
+  rng = np.random.RandomState(1)
+  embeddings, found = random_embeddings(rng, 40, 3)
+  vectors_path = str(tmpdir.join('vectors.txt'))
+  open(vectors_path, 'w').close()
+  for method in ('full', 'diagonal', 'cholesky'):
+    sampled = embeddings.copy()
+    init_unknown_embeddings(sampled, found, method, np.random.RandomState(2),
+                            vectors_path, [ 'w%d' % i for i in range(10) ])
+    assert np.array_equal(sampled[found], embeddings[found])
+    assert np.all(sampled[~found] != 0)
+  # The statistics are cached, and read back for the same known words, even
+  # though the embeddings changed.
+  assert os.path.exists(vectors_path + ".cholesky.npz")
+  cached = embeddings * 2
+  init_unknown_embeddings(cached, found, 'cholesky', np.random.RandomState(2),
+                          vectors_path, [ 'w%d' % i for i in range(10) ])
+  assert np.array_equal(cached[~found], sampled[~found])
@@ -0,0 +1,13 @@
+import numpy as np
+
+from F1 import f1_partial_matrix, f1_score
+
+def test_f1_partial_matrix_matches_f1_score():
+  for para_len in range(1, 12):
+    for ans_start_idx in range(para_len):
+      for ans_end_idx in range(ans_start_idx, para_len):
+        matrix = f1_partial_matrix(ans_start_idx, ans_end_idx, para_len)
+        expected = [ [ f1_score(start, end, ans_start_idx, ans_end_idx) \
+                         for end in range(ans_start_idx, para_len) ] \
+                       for start in range(ans_end_idx + 1) ]
+        assert matrix.tolist() == expected
@@ -0,0 +1,54 @@
+import numpy
+import os
+
+from Vectors import has_converted_vectors, read_vectors
+
+def write_vectors(path, rng, words, embed_size):
+  vectors = rng.uniform(-1, 1, (len(words), embed_size)).astype(numpy.float32)
+  with open(path, "w") as fout:
+    # fastText header line.
+    fout.write("%d %d\n" % (len(words), embed_size))
+    for word, vector in zip(words, vectors):
+      fout.write(word + " " + " ".join(repr(float(v)) for v in vector) + "\n")
+  return vectors
+
+def test_converted_vectors_match_text_vectors(tmpdir):
+  rng = numpy.random.RandomState(0)
+  words = [ "the", "a b", "of", "x", "the" ]
+  vectors_path = str(tmpdir.join("vectors.txt"))
+  vectors = write_vectors(vectors_path, rng, words, 4)
+  word_to_index = { "<pad>": 0, "the": 1, "a b": 2, "missing": 3, "x": 4 }
+
+  embeddings, found = read_vectors(vectors_path, word_to_index, 5, 4)
+  assert has_converted_vectors(vectors_path, 4)
+  assert not has_converted_vectors(vectors_path, 3)
+  assert sorted(os.listdir(str(tmpdir))) == \
+         [ "vectors.txt", "vectors.txt.npy", "vectors.txt.words" ]
+  assert found.tolist() == [ False, True, True, False, True ]
+  # Later duplicates take precedence.
+  assert numpy.array_equal(embeddings[1:3], vectors[[4, 1]])
+  assert numpy.array_equal(embeddings[4], vectors[3])
+  assert not embeddings[[0, 3]].any()
+
+  cached_embeddings, cached_found = read_vectors(vectors_path, word_to_index,
+                                                 5, 4)
+  assert numpy.array_equal(cached_embeddings, embeddings)
+  assert numpy.array_equal(cached_found, found)
+
+def test_failed_conversion_reads_text_vectors(tmpdir, monkeypatch):
+  rng = numpy.random.RandomState(1)
+  vectors_path = str(tmpdir.join("vectors.txt"))
+  vectors = write_vectors(vectors_path, rng, [ "the", "of", "a b" ], 3)
+  def full_disk(*args, **kwargs):
+    raise IOError("No space left on device")
+  monkeypatch.setattr(numpy.lib.format, "open_memmap", full_disk)
+  # "a" is in the vocabulary, but its only vector line is the one of "a b".
+  embeddings, found = read_vectors(vectors_path, { "of": 0, "a": 1 }, 2, 3)
+  # Temporary files are removed.
+  assert os.listdir(str(tmpdir)) == [ "vectors.txt" ]
+  assert found.tolist() == [ True, False ]
+  assert numpy.array_equal(embeddings[0], vectors[1])
+  assert not embeddings[1].any()
+  embeddings, found = read_vectors(vectors_path, { "a b": 0 }, 1, 3)
+  assert found.tolist() == [ True ]
+  assert numpy.array_equal(embeddings[0], vectors[2])
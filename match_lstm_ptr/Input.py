@@ -6,6 +6,14 @@ import sys
 
 from nltk.tokenize import sent_tokenize, word_tokenize
 
+# "word in string.punctuation" is a substring test, so any substring of it
+# counts as punctuation. A set of all those substrings keeps the same test,
+# without scanning the string for every word.
+punctuation_substrings = \
+  frozenset(string.punctuation[i:j] \
+              for i in range(len(string.punctuation)) \
+              for j in range(i, len(string.punctuation) + 1))
+
 class Dictionary:
   def __init__(self, lowercase=True, remove_punctuation=True,
                answer_start="ANSWERSTART", answer_end="ANSWEREND"):
@@ -21,13 +29,9 @@ class Dictionary:
   def size(self):
     return len(self.index_to_word)
 
-  def add_or_get_index(self, word):
-    if word == self.answer_start or word == self.answer_end:
-      return -1
-    # We ignore punctuation symbols
-    if self.remove_punctuation:
-      if word in string.punctuation:
-        return None
+  # Add a word that is neither an answer marker nor punctuation, or get its
+  # index if it already exists.
+  def add_word(self, word):
     if self.lowercase:
       word = word.strip().lower()
     if word in self.word_to_index:
@@ -39,16 +43,53 @@ class Dictionary:
     self.index_to_word.append(word)
     return new_index
 
+  def add_or_get_index(self, word):
+    if word == self.answer_start or word == self.answer_end:
+      return -1
+    # We ignore punctuation symbols
+    if self.remove_punctuation:
+      if word in punctuation_substrings:
+        return None
+    return self.add_word(word)
+
+  # add_or_get_index for every word in the list. Words already in the
+  # dictionary are looked up without any method calls.
+  def add_or_get_indices(self, words):
+    markers = frozenset((self.answer_start, self.answer_end))
+    punctuation = punctuation_substrings if self.remove_punctuation else ()
+    get = self.word_to_index.get
+    indices = []
+    append = indices.append
+    for word in words:
+      if word in markers:
+        append(-1)
+      elif word in punctuation:
+        append(None)
+      else:
+        index = get(word.strip().lower() if self.lowercase else word)
+        append(index if index is not None else self.add_word(word))
+    return indices
+
   def get_index(self, word):
     if word == self.answer_start or word == self.answer_end:
       return -1
     if self.remove_punctuation:
-      if word in string.punctuation:
+      if word in punctuation_substrings:
         return None
     if word in self.word_to_index:
       return self.word_to_index[word]
     return self.pad_index
 
+  # get_index for every word in the list.
+  def get_indices(self, words):
+    markers = frozenset((self.answer_start, self.answer_end))
+    punctuation = punctuation_substrings if self.remove_punctuation else ()
+    get = self.word_to_index.get
+    pad_index = self.pad_index
+    return [ -1 if word in markers else \
+             None if word in punctuation else \
+             get(word, pad_index) for word in words ]
+
   def get_word(self, index):
     return self.index_to_word[index]
 
@@ -91,9 +132,8 @@ class Data:
 
   def tokenize_para(self, para_text):
     # Create tokenized paragraph representation.
-    tokenized_para = [ [ self.dictionary.add_or_get_index(word) \
-                         for word in word_tokenize(sent) ] \
-                           for sent in sent_tokenize(para_text) ]
+    tokenized_para = [ self.dictionary.add_or_get_indices(word_tokenize(sent)) \
+                         for sent in sent_tokenize(para_text) ]
     tokenized_para = [ filter(None, x) for x in tokenized_para ]
     tokenized_para = [ x for x in tokenized_para if len(x) > 0 ]
     joined_para = []
@@ -109,8 +149,7 @@ class Data:
 
   def word_tokenize_para(self, para_text):
     # Create tokenized paragraph representation.
-    tokenized_para = [ self.dictionary.add_or_get_index(word) \
-                         for word in word_tokenize(para_text) ]
+    tokenized_para = self.dictionary.add_or_get_indices(word_tokenize(para_text))
     return tokenized_para
 
   def add_paragraph(self, paragraph):
@@ -129,8 +168,8 @@ class Data:
       self.questions[qa['id']] = qa['question']
 
       # Tokenize question
-      processed_question = [ self.dictionary.add_or_get_index(word) \
-                               for word in word_tokenize(qa['question']) ]
+      processed_question = \
+        self.dictionary.add_or_get_indices(word_tokenize(qa['question']))
       processed_question = filter(None, processed_question)
 
       # Tokenize answer phrases
@@ -44,6 +44,7 @@ def init_parser():
   parser.add_argument('--cuda', action='store_true')
   parser.add_argument('--max_answer_span', type=int, default=15)
   parser.add_argument('--use_greedy', action='store_true')
+  parser.add_argument('--fuse_directions', action='store_true')
   return parser
 
 
@@ -166,6 +167,9 @@ def train_model(args):
     model = model.load_from_file(args.model_file)
     print "Loaded model from %s." % args.model_file
 
+  # Execution options that aren't stored with the model.
+  model.fuse_directions = args.fuse_directions
+
   start_time = time.time()
   print "Starting training."
 
@@ -350,6 +354,9 @@ def test_model(args):
     if not args.disable_glove:
       print "Embedding shape:", model.embedding.shape
 
+  # Execution options that aren't stored with the model.
+  model.fuse_directions = args.fuse_directions
+
   test_start_t = time.time()
   test_loss_sum = 0.0
   all_predictions = {}
@@ -1,9 +1,14 @@
 import numpy as np
+import os
 import sys
 import torch
 import torch.nn as nn
 import torch.nn.functional as f
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, 'common'))
+from Directions import get_fused_masks, reverse, stack_directions
+from Vectors import read_vectors
 from torch.autograd import Variable
 
 class MatchLSTM(nn.Module):
@@ -20,6 +25,9 @@ class MatchLSTM(nn.Module):
     # Construct the model, storing all necessary layers.
     self.build_model()
 
+    # Run the forward and backward Match-LSTM directions as one batch.
+    self.fuse_directions = False
+
   # Load configuration options
   def load_from_config(self, config):
     self.embed_size = config['embed_size']
@@ -39,16 +47,11 @@ class MatchLSTM(nn.Module):
     self.oov_count = 0
     self.oov_list = []
     if self.use_glove:
-      embeddings = np.zeros((self.vocab_size, self.embed_size))
-      with open(self.glove_path) as f:
-        for line in f:
-          line = line.split()
-          if line[0] in self.word_to_index:
-            embeddings[self.word_to_index[line[0]]] = np.array(map(float,line[1:]))
-      for i, embedding in enumerate(embeddings):
-        if sum(embedding) == 0:
-          self.oov_count += 1
-          self.oov_list.append(self.index_to_word[i])
+      embeddings, found = read_vectors(self.glove_path, self.word_to_index,
+                                       self.vocab_size, self.embed_size)
+      unknown_idxs = np.flatnonzero(~found)
+      self.oov_count = len(unknown_idxs)
+      self.oov_list = [ self.index_to_word[i] for i in unknown_idxs ]
       self.embedding = embeddings
     else:
       self.embedding = nn.Embedding(self.vocab_size, self.embed_size,
@@ -169,6 +172,52 @@ class MatchLSTM(nn.Module):
     # Attended question is the same at each time step. Just compute it once.
     # attended_question.shape = (seq_len, batch, hdim)
     attended_question = self.attend_question(Hq)
+
+    if self.fuse_directions:
+      # Run both directions as one batch, with the backward direction reading
+      # the passage in reverse.
+      # attended_question.shape = (seq_len, 2 * batch, hdim)
+      # Hp.shape = (seq_len, 2 * batch, hdim)
+      # masks.shape = (seq_len, 2 * batch, 1)
+      # {h,c}.shape = (2 * batch, hdim)
+      attended_question = torch.cat((attended_question, attended_question), dim=1)
+      transposed_Hq = torch.transpose(Hq, 0, 1)
+      transposed_Hq = torch.cat((transposed_Hq, transposed_Hq), dim=0)
+      Hp = stack_directions(Hp)
+      masks = self.placeholder(get_fused_masks(max_passage_len, passage_lens))
+      h = torch.cat((hf, hb), dim=0)
+      c = torch.cat((cf, cb), dim=0)
+      H = []
+      for i in range(max_passage_len):
+        # g.shape = (seq_len, 2 * batch, hdim)
+        g = f.tanh(attended_question + \
+               (self.attend_passage(Hp[i]).expand_as(attended_question) + \
+                self.attend_hidden(h)))
+
+        # alpha.shape = (seq_len, 2 * batch, 1)
+        alpha = f.softmax(self.alpha_transform(g), dim=0)
+
+        # weighted_Hq.shape = (2 * batch, hdim)
+        weighted_Hq = torch.squeeze(torch.bmm(alpha.permute(1, 2, 0),
+                                    transposed_Hq), dim=1)
+
+        # z.shape = (2 * batch, 2 * hdim)
+        z = torch.cat((Hp[i], weighted_Hq), dim=-1)
+        mask = masks[i]
+        z = z * mask
+
+        # LSTM step, then back to initial zero states for padded regions.
+        h, c = self.match_lstm(z, (h, c))
+        h = h * mask
+        c = c * mask
+        H.append(h)
+
+      # H.shape = (seq_len, 2 * batch, hdim)
+      # Hr.shape = (seq_len, batch, 2 * hdim)
+      H = torch.stack(H, dim=0)
+      Hr = torch.cat((H[:, :batch_size], reverse(H[:, batch_size:])), dim=-1)
+      return Hr
+
     Hf, Hb = [], []
     for i in range(max_passage_len):
         forward_idx = i
@@ -1,64 +1,317 @@
+import Queue
 import cPickle as pickle
 import gzip
+import bisect
+import codecs
+import fcntl
+import hashlib
+import itertools
 import json
+import mmap
 import numpy
+import os
+import random
+import requests
+import shutil
 import string
+import struct
 import sys
+import threading
 import time
 
 from joblib import Parallel, delayed
-from pycorenlp import StanfordCoreNLP
 from tqdm import tqdm
 
 # Define URL of running StanfordCoreNLPServer.
 corenlp_url = 'http://localhost:9001'
 max_tries = 10
+# Number of texts packed into a single annotate request.
+corenlp_batch_size = 64
+# Delay before the first retry of a failed request. Doubled after every
+# further failure, up to corenlp_max_backoff seconds.
+corenlp_backoff = 0.1
+corenlp_max_backoff = 10.0
+# Texts packed into one request are separated by a blank line, which CoreNLP
+# is told to treat as a hard sentence break.
+corenlp_separator = u"\n\n"
 
-def word_tokenize(idx, sentence):
-  stanford_corenlp = StanfordCoreNLP(corenlp_url)
-  tries = 0
-  while True:
-    try:
-      annotation = stanford_corenlp.annotate(
-        sentence.encode('utf8'),
-        properties = { 'annotators': 'tokenize',
-                       'outputFormat': 'json' })
-      assert type(annotation) == dict
-      break
-    except Exception:
-      time.sleep(1)
-      tries += 1
-      if tries == 10:
-        return (idx, None)
-      pass
-  tokens = []
-  tokens.extend([ token['word'] for token in annotation['tokens'] ])
-  return (idx, tokens)
-
-def tokenize_and_tag(idx, sentence):
-  stanford_corenlp = StanfordCoreNLP(corenlp_url)
-  tries = 0
-  while True:
-    try:
-      annotation = stanford_corenlp.annotate(
-        sentence.encode('utf8'),
-        properties = { 'annotators': 'tokenize,pos,ner',
-                       'outputFormat': 'json' })
-      assert type(annotation) == dict
-      break
-    except Exception:
-      time.sleep(1)
-      tries += 1
-      if tries == 10:
-        print "Failed for %s" % sentence
-        return (idx, None, None, None)
-      pass
-  tokens, pos_tags, ner_tags = [], [], []
-  for sentence in annotation['sentences']:
-    tokens.extend([ token['word'] for token in sentence['tokens'] ])
-    pos_tags.extend([ token['pos'] for token in sentence['tokens'] ])
-    ner_tags.extend([ token['ner'] for token in sentence['tokens'] ])
-  return (idx, tokens, pos_tags, ner_tags)
+class CoreNLPClient:
+  ''' Client for a running StanfordCoreNLPServer. Connections to the server are
+      kept alive across requests, and many texts are annotated per request.'''
+
+  def __init__(self, url=corenlp_url, pool_size=4):
+    self.url = url
+    self.session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                            pool_maxsize=pool_size)
+    self.session.mount('http://', adapter)
+    self.session.mount('https://', adapter)
+
+  # Annotate text with the given (comma separated) annotators, retrying with
+  # exponential backoff. Returns None if all tries fail.
+  def annotate(self, text, annotators):
+    properties = { 'annotators': annotators,
+                   'outputFormat': 'json',
+                   'ssplit.newlineIsSentenceBreak': 'two' }
+    tries = 0
+    while True:
+      try:
+        response = self.session.post(
+          self.url, params = { 'properties': json.dumps(properties) },
+          data = text.encode('utf8'))
+        response.raise_for_status()
+        annotation = response.json()
+        assert type(annotation) == dict
+        return annotation
+      except Exception:
+        tries += 1
+        if tries == max_tries:
+          return None
+        time.sleep(min(corenlp_backoff * 2 ** (tries - 1), corenlp_max_backoff))
+
+  # Annotate all texts with a single request, and split the annotated tokens
+  # back by text, with character offsets made relative to their own text.
+  # Returns a list with one list of token dicts per text, or None if the
+  # request failed.
+  def annotate_batch(self, texts, annotators):
+    # Start offsets of each text in the joined text. CoreNLP reports offsets
+    # in UTF-16 code units.
+    starts = []
+    offset = 0
+    for text in texts:
+      starts.append(offset)
+      offset += (len(text.encode('utf-16-le')) + \
+                 len(corenlp_separator.encode('utf-16-le'))) // 2
+    annotation = self.annotate(corenlp_separator.join(texts), annotators)
+    if annotation is None:
+      return None
+
+    if 'sentences' in annotation:
+      tokens = [ token for sentence in annotation['sentences'] \
+                   for token in sentence['tokens'] ]
+    else:
+      tokens = annotation['tokens']
+    split_tokens = [ [] for _ in texts ]
+    text_idx = 0
+    for token in tokens:
+      while text_idx + 1 < len(texts) and \
+            token['characterOffsetBegin'] >= starts[text_idx + 1]:
+        text_idx += 1
+      token['characterOffsetBegin'] -= starts[text_idx]
+      token['characterOffsetEnd'] -= starts[text_idx]
+      split_tokens[text_idx].append(token)
+    return split_tokens
+
+# One client per process, so that joblib workers never share a connection.
+corenlp_clients = {}
+
+def get_corenlp_client():
+  pid = os.getpid()
+  if pid not in corenlp_clients:
+    corenlp_clients[pid] = CoreNLPClient(corenlp_url)
+  return corenlp_clients[pid]
+
+# Annotate (idx, text) pairs in a single request. If the batched request
+# fails, each text is retried on its own, so that one bad text only fails
+# itself. Returns a list of (idx, tokens) pairs, with tokens None on failure.
+def annotate_batch(items, annotators):
+  client = get_corenlp_client()
+  texts = [ text for _, text in items ]
+  split_tokens = client.annotate_batch(texts, annotators)
+  if split_tokens is None and len(items) > 1:
+    split_tokens = [ client.annotate_batch([ text ], annotators) \
+                       for text in texts ]
+    split_tokens = [ tokens[0] if tokens is not None else None \
+                       for tokens in split_tokens ]
+  elif split_tokens is None:
+    split_tokens = [ None ]
+  return [ (idx, tokens) for (idx, _), tokens in zip(items, split_tokens) ]
+
+# Convert offsets into text in UTF-16 code units, as reported by CoreNLP, to
+# indices into the text. They only differ for texts with characters outside
+# the Basic Multilingual Plane, on Python builds that count those as one.
+def utf16_to_text_offsets(text, offsets):
+  if len(text.encode('utf-16-le')) == 2 * len(text):
+    return offsets
+  units = numpy.cumsum([ 2 if ord(char) > 0xffff else 1 for char in text ])
+  return numpy.searchsorted(units, offsets, side='right').tolist()
+
+# Returns (idx, words, POS tags, NER tags, token start offsets, token end
+# offsets) for each (idx, text) pair, with None for all but idx on failure.
+# Token offsets are indices into the text.
+def tokenize_and_tag_batch(items):
+  results = []
+  for (idx, tokens), (_, sentence) in \
+      zip(annotate_batch(items, 'tokenize,ssplit,pos,ner'), items):
+    if tokens is None:
+      print "Failed for %s" % sentence
+      results.append((idx, None, None, None, None, None))
+      continue
+    results.append((idx, [ token['word'] for token in tokens ],
+                    [ token['pos'] for token in tokens ],
+                    [ token['ner'] for token in tokens ],
+                    utf16_to_text_offsets(sentence,
+                      [ token['characterOffsetBegin'] for token in tokens ]),
+                    utf16_to_text_offsets(sentence,
+                      [ token['characterOffsetEnd'] for token in tokens ])))
+  return results
+
+class AnnotationCache:
+  ''' Persistent cache of CoreNLP annotations, keyed by a hash of the text and
+      the annotator set. Records are appended to a single binary file, which
+      is memory-mapped for look-ups, so that one cache file can be shared by
+      the preprocessing runs of different models. Appends hold an exclusive
+      lock on the file.'''
+
+  # Record = header (sha1 key, number of tokens, payload bytes) + payload.
+  # The payload is the utf-8 encoding of all tokens, followed by all POS tags,
+  # all NER tags, and all token start and end offsets (in decimal), separated
+  # by null characters.
+  header = struct.Struct('<20sII')
+  # Part of every key, so that records of an older format are never read.
+  # Version 2 added token offsets.
+  format_version = 2
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.index = {}
+    self.pending = {}
+    self.hits = 0
+    self.misses = 0
+    self.data = None
+    # End of the last record indexed so far. Records are only ever appended
+    # (partial records past it are the only ones ever dropped), so every load
+    # only indexes the records past it.
+    self.indexed_end = 0
+    if not os.path.exists(filename):
+      open(filename, 'ab').close()
+    if self.load_index() < os.path.getsize(filename):
+      with open(filename, 'ab') as fout:
+        fcntl.flock(fout, fcntl.LOCK_EX)
+        self.drop_partial_record(fout)
+
+  # Index the complete records appended since the last load, and return the
+  # end of the last complete record. The file is mapped again if its size
+  # changed.
+  def load_index(self):
+    size = os.path.getsize(self.filename)
+    if self.data is not None and len(self.data) != size:
+      self.data.close()
+      self.data = None
+    if size == 0:
+      return 0
+    if self.data is None:
+      with open(self.filename, 'rb') as fin:
+        self.data = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+    offset = self.indexed_end
+    while offset + self.header.size <= size:
+      key, num_tokens, length = self.header.unpack_from(self.data, offset)
+      start = offset + self.header.size
+      if start + length > size:
+        break
+      self.index[key] = (num_tokens, start, length)
+      offset = start + length
+    self.indexed_end = offset
+    return offset
+
+  # Drop a partially written record left by an interrupted run. Records are
+  # only appended while holding the file lock, so with the lock held (on
+  # fout), a partial record can't be another process's append in progress.
+  # Also indexes the records appended by other processes.
+  def drop_partial_record(self, fout):
+    end = self.load_index()
+    if end < os.path.getsize(self.filename):
+      fout.truncate(end)
+      # Maps the shorter file. There are no new records to index.
+      self.load_index()
+
+  def key(self, text, annotators):
+    return hashlib.sha1('%d\0%s\0%s' % (self.format_version, annotators,
+                                         text.encode('utf8'))).digest()
+
+  # Returns (tokens, pos_tags, ner_tags, token_begins, token_ends) for the
+  # given text, or None.
+  def get(self, text, annotators):
+    key = self.key(text, annotators)
+    if key in self.pending:
+      self.hits += 1
+      return self.pending[key]
+    if key not in self.index:
+      self.misses += 1
+      return None
+    self.hits += 1
+    num_tokens, start, length = self.index[key]
+    if num_tokens == 0:
+      return [], [], [], [], []
+    fields = self.data[start:start+length].decode('utf8').split(u'\0')
+    return fields[:num_tokens], fields[num_tokens:2*num_tokens], \
+           fields[2*num_tokens:3*num_tokens], \
+           map(int, fields[3*num_tokens:4*num_tokens]), \
+           map(int, fields[4*num_tokens:])
+
+  def put(self, text, annotators, tokens, pos_tags, ner_tags, token_begins,
+          token_ends):
+    self.pending[self.key(text, annotators)] = \
+      (tokens, pos_tags, ner_tags, token_begins, token_ends)
+
+  # Append all pending records to the cache file, in a single write while
+  # holding an exclusive lock on it, so that processes sharing the file never
+  # interleave their records.
+  def flush(self):
+    if len(self.pending) == 0:
+      return
+    with open(self.filename, 'ab') as fout:
+      fcntl.flock(fout, fcntl.LOCK_EX)
+      self.drop_partial_record(fout)
+      records = []
+      for key, (tokens, pos_tags, ner_tags, token_begins, token_ends) in \
+          self.pending.iteritems():
+        if key in self.index:
+          continue
+        offsets = [ unicode(offset) for offset in token_begins + token_ends ]
+        payload = u'\0'.join(tokens + pos_tags + ner_tags + offsets).encode('utf8')
+        records.append(self.header.pack(key, len(tokens), len(payload)))
+        records.append(payload)
+      fout.write(''.join(records))
+      fout.flush()
+    self.pending = {}
+    self.load_index()
+
+# Tokenize and tag all (idx, text) pairs, corenlp_batch_size texts per
+# request, with requests spread over all cores. Texts found in the
+# annotation cache, if one is given, are not sent to the server.
+def tokenize_and_tag_all(items, verbose=2, cache=None):
+  annotators = 'tokenize,ssplit,pos,ner'
+  results = [ None ] * len(items)
+  to_annotate = []
+  for i, (idx, text) in enumerate(items):
+    cached = cache.get(text, annotators) if cache is not None else None
+    if cached is None:
+      to_annotate.append(i)
+    else:
+      results[i] = (idx,) + cached
+
+  batches = [ [ items[i] for i in to_annotate[j:j+corenlp_batch_size] ] \
+                for j in range(0, len(to_annotate), corenlp_batch_size) ]
+  annotated = Parallel(n_jobs=-1, verbose=verbose)(
+    delayed(tokenize_and_tag_batch)(batch) for batch in batches)
+  annotated = [ result for batch in annotated for result in batch ]
+  for i, result in zip(to_annotate, annotated):
+    results[i] = result
+    if cache is not None and result[1] is not None:
+      cache.put(items[i][1], annotators, *result[1:])
+
+  if cache is not None:
+    cache.flush()
+  return results
+
+# "word in string.punctuation" is a substring test, so any substring of it
+# counts as punctuation. A set of all those substrings keeps the same test,
+# without scanning the string for every word.
+punctuation_substrings = \
+  frozenset(string.punctuation[i:j] \
+              for i in range(len(string.punctuation)) \
+              for j in range(i, len(string.punctuation) + 1))
 
 class Dictionary:
   def __init__(self, lowercase=True, remove_punctuation=True,
@@ -77,13 +330,9 @@ class Dictionary:
   def size(self):
     return len(self.index_to_word)
 
-  def add_or_get_index(self, word):
-    if word == self.answer_start or word == self.answer_end:
-      return -1
-    # We ignore punctuation symbols
-    if self.remove_punctuation:
-      if word in string.punctuation:
-        return None
+  # Add a word that is neither an answer marker nor punctuation, or get its
+  # index if it already exists.
+  def add_word(self, word):
     if self.lowercase:
       word = word.strip().lower()
     if word in self.word_to_index:
@@ -95,6 +344,33 @@ class Dictionary:
     self.index_to_word.append(word)
     return new_index
 
+  def add_or_get_index(self, word):
+    if word == self.answer_start or word == self.answer_end:
+      return -1
+    # We ignore punctuation symbols
+    if self.remove_punctuation:
+      if word in punctuation_substrings:
+        return None
+    return self.add_word(word)
+
+  # add_or_get_index for every word in the list. Words already in the
+  # dictionary are looked up without any method calls.
+  def add_or_get_indices(self, words):
+    markers = frozenset((self.answer_start, self.answer_end))
+    punctuation = punctuation_substrings if self.remove_punctuation else ()
+    get = self.word_to_index.get
+    indices = []
+    append = indices.append
+    for word in words:
+      if word in markers:
+        append(-1)
+      elif word in punctuation:
+        append(None)
+      else:
+        index = get(word.strip().lower() if self.lowercase else word)
+        append(index if index is not None else self.add_word(word))
+    return indices
+
   def add_or_get_postag(self, pos_tag):
     if pos_tag in self.pos_tags:
       return self.pos_tags[pos_tag]
@@ -111,18 +387,59 @@ class Dictionary:
     if word == self.answer_start or word == self.answer_end:
       return -1
     if self.remove_punctuation:
-      if word in string.punctuation:
+      if word in punctuation_substrings:
         return None
     if word in self.word_to_index:
       return self.word_to_index[word]
     return self.pad_index
 
+  # get_index for every word in the list.
+  def get_indices(self, words):
+    markers = frozenset((self.answer_start, self.answer_end))
+    punctuation = punctuation_substrings if self.remove_punctuation else ()
+    get = self.word_to_index.get
+    pad_index = self.pad_index
+    return [ -1 if word in markers else \
+             None if word in punctuation else \
+             get(word, pad_index) for word in words ]
+
   def get_word(self, index):
     return self.index_to_word[index]
 
   def set_immutable(self):
     self.mutable = False
 
+  # Write the words of this dictionary to a word list file.
+  def write_table(self, filename):
+    write_words(filename, self.index_to_word)
+
+  # Replace the words of this dictionary with those of a word list file.
+  def read_table(self, filename):
+    self.index_to_word = read_words(filename)
+    self.word_to_index = dict(zip(self.index_to_word,
+                                  range(len(self.index_to_word))))
+
+# Word lists (the words of a dictionary, question ids) are stored as utf-8
+# words, each followed by a null character, so that words may hold any other
+# character.
+def encode_words(words):
+  return u''.join([ word + u'\0' for word in words ]).encode('utf8')
+
+# Decode a word list. Returns the words, and the length of the data they
+# take, as an interrupted append may leave an incomplete word at the end.
+def decode_words(data):
+  end = data.rfind('\0') + 1
+  return data[:end].decode('utf8').split(u'\0')[:-1], end
+
+# Write a word list, under a temporary name renamed once complete.
+def write_words(filename, words):
+  with open(filename + ".tmp", 'wb') as fout:
+    fout.write(encode_words(words))
+  os.rename(filename + ".tmp", filename)
+
+def read_words(filename):
+  with open(filename, 'rb') as fin:
+    return decode_words(fin.read())[0]
 
 def get_sent_start_end(tokenized_para, ans_start_idx, ans_end_idx):
   sentence_end_markers = [ ".", "...", "!", "?", ";" ]
@@ -143,44 +460,31 @@ def get_sent_start_end(tokenized_para, ans_start_idx, ans_end_idx):
 
   return start_idx, end_idx
 
-def f1_score(start, end, ans_start_idx, ans_end_idx):
-  # Get the F1 score for two given ranges: candidate range and true range.
-  if end < start:
-    return 0.0
-  intersection = min(end, ans_end_idx) - max(start, ans_start_idx)
-  if intersection < 0:
-    return 0.0
-  intersection += 1
-  true = ans_end_idx - ans_start_idx + 1
-  ours = end - start + 1
-  precision = intersection/float(ours)
-  recall = intersection/float(true)
-  return 2 * precision * recall / (precision + recall)
-
-# Create question-answer tuple with required information.
+# Get the (first, last) token indices of the answer at characters
+# [answer_start, answer_end) of the paragraph, from the start and end
+# character offsets of the paragraph tokens: the first token ending after the
+# answer start, and the last token starting before the answer end.
+def get_answer_span(token_begins, token_ends, answer_start, answer_end):
+  return [ bisect.bisect_right(token_ends, answer_start),
+           bisect.bisect_left(token_begins, answer_end) - 1 ]
+
+# Create question-answer tuple with required information. Answers are
+# located in the paragraph tokens through their character offsets.
 def create_data(qid, para_text, tokenized_para, tokenized_para_words,
-                processed_question, dictionary, question, answers):
+                token_begins, token_ends, processed_question, question,
+                answers):
   missed = 0
   processed_answers = []
   sentence_idxs = []
   for answer in answers:
     start_idx = answer['answer_start']
     end_idx = start_idx + len(answer['text'])
-    para_text_modified = para_text[:start_idx] + " " + \
-                         dictionary.answer_start + " " + \
-                         para_text[start_idx:end_idx] + " " + \
-                         dictionary.answer_end + " " + \
-                         para_text[end_idx:]
-    answer_idxs = \
-      [ i for i,idx in \
-          enumerate([ dictionary.get_index(w) for w in \
-                        word_tokenize(None, para_text_modified)[1] ]) \
-          if idx == -1 ]
-    answer_idxs[1] -= 2
-
-    # Valid answers should lie within bounds.
+    answer_idxs = get_answer_span(token_begins, token_ends, start_idx, end_idx)
+
+    # Valid answers should lie within bounds, and cover at least one token.
     if answer_idxs[0] < 0 or answer_idxs[0] >= len(tokenized_para) \
-       or answer_idxs[1] < 0 or answer_idxs[1] >= len(tokenized_para):
+       or answer_idxs[1] < 0 or answer_idxs[1] >= len(tokenized_para) \
+       or answer_idxs[1] < answer_idxs[0]:
       print "\n" * 3
       print "Invalid answer \"%s\" ignored. (%d,%d)\n" % \
             (answer['text'], answer_idxs[0], answer_idxs[1])
@@ -203,21 +507,120 @@ def create_data(qid, para_text, tokenized_para, tokenized_para_words,
            sentence_idxs[-1][1] < len(tokenized_para_words) and \
            sentence_idxs[-1][1] >= answer_idxs[1]
 
-  # Create question-answer tuples.
+  # Create question-answer tuples. F1 matrices are not stored, as they only
+  # depend on the answer span, and are built at batch time by the model.
   data = []
   for processed_answer, sentence_idx in zip(processed_answers, sentence_idxs):
-    f1_partial_matrix = numpy.zeros((processed_answer[1]+1,
-                                     len(tokenized_para)-processed_answer[0]))
-    for start in range(0,processed_answer[1]+1):
-      for end in range(max(start,processed_answer[0]),len(tokenized_para)):
-        f1_partial_matrix[start, end-processed_answer[0]] = \
-          f1_score(start, end, processed_answer[0], processed_answer[1])
-    data.append([processed_question, processed_answer, qid,
-                 f1_partial_matrix, sentence_idx])
+    data.append([processed_question, processed_answer, qid, None,
+                 sentence_idx])
 
   return data, missed
 
+class RaggedArray:
+  ''' Read-only sequence of variable length rows of ints, stored as one flat
+      array of values and an array of row offsets, so that it can be
+      memory-mapped. Rows are returned as lists. If keys are given, rows are
+      looked up by key (like a dict) instead of by position.'''
+
+  def __init__(self, values, offsets, keys=None):
+    # Plain ndarray views slice much faster than numpy.memmap objects, and
+    # offsets are small enough to be kept as a list.
+    self.values = numpy.asarray(values)
+    self.offsets = numpy.asarray(offsets).tolist()
+    self.row_keys = keys
+    self.key_to_row = None
+    if keys is not None:
+      self.key_to_row = dict(zip(keys, range(len(keys))))
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def __contains__(self, key):
+    return key in self.key_to_row
+
+  def __iter__(self):
+    if self.row_keys is not None:
+      return iter(self.row_keys)
+    return (self[row] for row in range(len(self)))
+
+  def __getitem__(self, key):
+    row = key if self.key_to_row is None else self.key_to_row[key]
+    return self.values[self.offsets[row]:self.offsets[row+1]].tolist()
+
+# Flatten rows of ints into (values, offsets) arrays for a RaggedArray. Rows
+# that failed tokenization (None) are stored as empty rows.
+def flatten_rows(rows):
+  rows = [ [] if row is None else row for row in rows ]
+  offsets = numpy.zeros(len(rows) + 1, dtype=numpy.int64)
+  offsets[1:] = numpy.cumsum([ len(row) for row in rows ])
+  values = numpy.fromiter(itertools.chain.from_iterable(rows),
+                          dtype=numpy.int32, count=offsets[-1])
+  return values, offsets
+
+class ColumnWriter:
+  ''' Writes the arrays of a columnar store in chunks. Every chunk is
+      appended to a raw file per array, and close() turns the raw files into
+      .npy files, so only one chunk needs to be in memory at a time.'''
+
+  def __init__(self, dirname):
+    self.dirname = dirname
+    if not os.path.exists(dirname):
+      os.makedirs(dirname)
+    # Array name => [raw file, dtype, row shape, number of rows].
+    self.arrays = {}
+    # Word list files, one word per row.
+    self.word_files = {}
+
+  # Number of rows written to the given array so far.
+  def size(self, name):
+    return self.arrays[name][3] if name in self.arrays else 0
+
+  def append(self, name, values):
+    values = numpy.ascontiguousarray(values)
+    if name not in self.arrays:
+      raw_file = open(os.path.join(self.dirname, name + ".raw"), 'wb')
+      self.arrays[name] = [ raw_file, values.dtype, values.shape[1:], 0 ]
+    array = self.arrays[name]
+    assert values.dtype == array[1] and values.shape[1:] == array[2], name
+    array[0].write(values.tobytes())
+    array[3] += len(values)
+
+  # Append rows of ints (as for flatten_rows) to the given array, and their
+  # offsets, continuing from the rows written before, to offsets_name.
+  def append_rows(self, name, rows, offsets_name=None):
+    values, offsets = flatten_rows(rows)
+    base = self.size(name)
+    self.append(name, values)
+    if offsets_name is None:
+      return
+    if offsets_name in self.arrays:
+      offsets = offsets[1:]
+    self.append(offsets_name, offsets + base)
+
+  def append_words(self, name, words):
+    if name not in self.word_files:
+      self.word_files[name] = open(os.path.join(self.dirname, name + ".txt"),
+                                   'wb')
+    self.word_files[name].write(encode_words(words))
+
+  def close(self):
+    for name, (raw_file, dtype, row_shape, num_rows) in self.arrays.iteritems():
+      raw_file.close()
+      raw_filename = os.path.join(self.dirname, name + ".raw")
+      with open(os.path.join(self.dirname, name + ".npy"), 'wb') as fout:
+        numpy.lib.format.write_array_header_1_0(fout, {
+          'descr': numpy.lib.format.dtype_to_descr(dtype),
+          'fortran_order': False, 'shape': (num_rows,) + row_shape })
+        with open(raw_filename, 'rb') as fin:
+          shutil.copyfileobj(fin, fout)
+      os.remove(raw_filename)
+    for word_file in self.word_files.itervalues():
+      word_file.close()
+
 class Data:
+  # Version of the columnar store layout written by dump_columns.
+  columns_version = 4
+
   def __init__(self, dictionary=None, immutable=False):
     self.dictionary = Dictionary(lowercase=False,
                                  remove_punctuation=False)
@@ -236,6 +639,8 @@ class Data:
     self.tokenized_para_words = []
     self.paras_pos_tags = []
     self.paras_ner_tags = []
+    self.paras_token_begins = []
+    self.paras_token_ends = []
     self.question_to_paragraph = {}
     self.data = []
     self.missed = 0
@@ -254,6 +659,8 @@ class Data:
     del self.question_pos_tags
     del self.paras_pos_tags
     del self.paras_ner_tags
+    del self.paras_token_begins
+    del self.paras_token_ends
 
   def dump_pickle(self, filename):
     with gzip.open(filename + ".gz", 'wb') as fout:
@@ -266,13 +673,134 @@ class Data:
       fin.close()
       return self
 
+  # Write the model inputs (paragraph and question tokens and tags, and the
+  # data tuples) as flat int32 arrays with offsets, one .npy file per array,
+  # in the directory <filename>.columns, with the dictionary's words and the
+  # question ids in word lists. Raw texts are not stored.
+  def dump_columns(self, filename):
+    writer = ColumnWriter(filename + ".columns")
+    self.append_columns(writer, 0)
+    writer.close()
+    self.write_columns_meta(filename)
+
+  # Append the rows of this data to the arrays of a ColumnWriter. Paragraph
+  # indices are offset by para_base, the number of paragraphs written before.
+  def append_columns(self, writer, para_base):
+    qids = list(self.question_to_paragraph)
+    question_base = writer.size('question_paras')
+    qid_rows = dict(zip(qids, range(question_base,
+                                    question_base + len(qids))))
+    writer.append_rows('para_tokens', self.tokenized_paras, 'para_offsets')
+    writer.append_rows('para_pos_tags', self.paras_pos_tags)
+    writer.append_rows('para_ner_tags', self.paras_ner_tags)
+    writer.append_rows('question_tokens',
+                       [ self.questions_tokenized.get(qid) for qid in qids ],
+                       'question_offsets')
+    writer.append_rows('question_pos_tags',
+                       [ self.question_pos_tags.get(qid) for qid in qids ])
+    writer.append_rows('question_ner_tags',
+                       [ self.question_ner_tags.get(qid) for qid in qids ])
+    writer.append('question_paras',
+                  numpy.array([ para_base + self.question_to_paragraph[qid] \
+                                  for qid in qids ], dtype=numpy.int32))
+    writer.append_words('qids', qids)
+    # Data tuples: question row, answer span and answer sentence span.
+    writer.append('example_questions',
+                  numpy.array([ qid_rows[example[2]] for example in self.data ],
+                              dtype=numpy.int32))
+    writer.append('example_answers',
+                  numpy.array([ example[1] for example in self.data ],
+                              dtype=numpy.int32).reshape(-1, 2))
+    writer.append('example_sentences',
+                  numpy.array([ example[4] for example in self.data ],
+                              dtype=numpy.int32).reshape(-1, 2))
+
+  # Write the dictionary and the missed count of a columnar store.
+  def write_columns_meta(self, filename):
+    dirname = filename + ".columns"
+    self.dictionary.write_table(os.path.join(dirname, "vocab.txt"))
+    dictionary = self.dictionary
+    dictionary_meta = { 'lowercase': dictionary.lowercase,
+                        'remove_punctuation': dictionary.remove_punctuation,
+                        'answer_start': dictionary.answer_start,
+                        'answer_end': dictionary.answer_end,
+                        'mutable': dictionary.mutable,
+                        'pos_tags': dictionary.pos_tags,
+                        'ner_tags': dictionary.ner_tags }
+    # Written last, so that an interrupted dump isn't read back.
+    with open(os.path.join(dirname, "meta.json"), 'w') as fout:
+      json.dump({ 'version': self.columns_version, 'missed': self.missed,
+                  'dictionary': dictionary_meta }, fout)
+
+  # Read a store written by dump_columns. Token and tag arrays are
+  # memory-mapped, and rows are only copied out when a batch asks for them;
+  # the pages are shared by all processes reading the same store.
+  def read_from_columns(self, filename):
+    dirname = filename + ".columns"
+    with open(os.path.join(dirname, "meta.json"), 'r') as fin:
+      meta = json.load(fin)
+    assert meta['version'] == self.columns_version, \
+           "Columnar store %s has version %d, expected %d." % \
+           (dirname, meta['version'], self.columns_version)
+    columns = {}
+    for name in os.listdir(dirname):
+      if name.endswith(".npy"):
+        columns[name[:-4]] = numpy.load(os.path.join(dirname, name),
+                                        mmap_mode='r')
+    dictionary_meta = meta['dictionary']
+    self.dictionary = Dictionary(dictionary_meta['lowercase'],
+                                 dictionary_meta['remove_punctuation'],
+                                 dictionary_meta['answer_start'],
+                                 dictionary_meta['answer_end'])
+    self.dictionary.read_table(os.path.join(dirname, "vocab.txt"))
+    self.dictionary.mutable = dictionary_meta['mutable']
+    self.dictionary.pos_tags = dictionary_meta['pos_tags']
+    self.dictionary.ner_tags = dictionary_meta['ner_tags']
+
+    qids = read_words(os.path.join(dirname, "qids.txt"))
+    para_offsets = columns['para_offsets']
+    question_offsets = columns['question_offsets']
+    self.tokenized_paras = RaggedArray(columns['para_tokens'], para_offsets)
+    self.paras_pos_tags = RaggedArray(columns['para_pos_tags'], para_offsets)
+    self.paras_ner_tags = RaggedArray(columns['para_ner_tags'], para_offsets)
+    self.question_pos_tags = RaggedArray(columns['question_pos_tags'],
+                                         question_offsets, qids)
+    self.question_ner_tags = RaggedArray(columns['question_ner_tags'],
+                                         question_offsets, qids)
+    self.question_to_paragraph = \
+      dict(zip(qids, columns['question_paras'].tolist()))
+
+    # Data tuples are a list, as they are sorted and sliced in place. Examples
+    # of the same question share its token list.
+    question_tokens = columns['question_tokens'].tolist()
+    offsets = question_offsets.tolist()
+    tokenized_questions = [ question_tokens[offsets[row]:offsets[row+1]] \
+                              for row in range(len(qids)) ]
+    self.data = [ [ tokenized_questions[row], answer, qids[row], None,
+                    tuple(sentence) ] \
+                    for row, answer, sentence in \
+                      zip(columns['example_questions'].tolist(),
+                          columns['example_answers'].tolist(),
+                          columns['example_sentences'].tolist()) ]
+    self.missed = meta['missed']
+    return self
+
+  def dump(self, filename, data_format='pickle'):
+    if data_format == 'columnar':
+      self.dump_columns(filename)
+    else:
+      self.dump_pickle(filename)
+
+  def read_from_dump(self, filename, data_format='pickle'):
+    if data_format == 'columnar':
+      return self.read_from_columns(filename)
+    return self.read_from_pickle(filename)
+
   def get_ids(self, tokenized_text):
-    return [ self.dictionary.add_or_get_index(word) \
-               for word in tokenized_text ]
+    return self.dictionary.add_or_get_indices(tokenized_text)
 
   def get_ids_immutable(self, tokenized_text):
-    return [ self.dictionary.get_index(word) \
-               for word in tokenized_text ]
+    return self.dictionary.get_indices(tokenized_text)
 
   def add_paragraph(self, paragraph):
     para_text = paragraph['context']
@@ -288,96 +816,421 @@ class Data:
 
     self.paragraphs.append(para_text)
 
-  def read_from_file(self, filename, max_articles):
-    dev_data = {}
-    with open(filename, 'r') as input_file:
-      data = json.load(input_file)
-      dev_data['version'] = data['version']
-      dev_data['data'] = []
-
-      data = data['data']
-      # Read each input article
-      for article_index, article in enumerate(data):
-        if article_index == max_articles:
-          break
-        dev_data['data'].append(article)
-        # Read each para for each article
-        for para_index, paragraph in enumerate(article['paragraphs']):
-          self.add_paragraph(paragraph)
-          print "\r%d Articles, %d Paragraphs processed." \
-                  % (article_index+1, para_index+1),
-          sys.stdout.flush()
-      print ""
-
-    print "Tokenizing paragraphs (%d total)..." % len(self.paragraphs)
-    _, self.tokenized_para_words, self.paras_pos_tags, self.paras_ner_tags = \
-      zip(*Parallel(n_jobs=-1, verbose=2)(
-        delayed(tokenize_and_tag)(None, para_text) for para_text in self.paragraphs))
-    self.tokenized_para_words = list(self.tokenized_para_words)
-    for tokenized_para_words in tqdm(self.tokenized_para_words):
+  def read_from_file(self, filename, max_articles, annotation_cache=None):
+    # Read each input article
+    for article_index, article in \
+        enumerate(iter_json_articles(filename, max_articles)):
+      # Read each para for each article
+      for para_index, paragraph in enumerate(article['paragraphs']):
+        self.add_paragraph(paragraph)
+        print "\r%d Articles, %d Paragraphs processed." \
+                % (article_index+1, para_index+1),
+        sys.stdout.flush()
+    print ""
+
+    self.tokenize(annotation_cache)
+    self.create_tuples()
+
+  # Read a json file chunk_articles articles at a time, and append each
+  # processed chunk to the columnar store at filename, so that only a few
+  # chunks are in memory at a time. The next chunk is parsed and tokenized by
+  # a background thread while the current one is encoded and written. The
+  # thread mostly waits on the tokenizing processes, which joblib's default
+  # (loky) backend starts from any thread; the multiprocessing backend would
+  # run them one at a time, outside the main thread. Chunks
+  # add their words to this dictionary, in order. Returns this data, read
+  # back from the store.
+  def read_from_file_to_columns(self, json_filename, max_articles, filename,
+                                chunk_articles, annotation_cache=None):
+    def tokenize_chunk(articles):
+      chunk = Data(self.dictionary)
+      for article in articles:
+        for paragraph in article['paragraphs']:
+          chunk.add_paragraph(paragraph)
+      chunk.tokenize(annotation_cache, verbose=False)
+      return chunk
+
+    writer = ColumnWriter(filename + ".columns")
+    num_articles, num_paragraphs, num_tuples = 0, 0, 0
+    self.missed = 0
+    chunks = BatchPrefetcher(
+      iter_chunks(iter_json_articles(json_filename, max_articles),
+                  chunk_articles),
+      tokenize_chunk, num_workers=1, depth=2)
+    for articles, chunk in chunks:
+      chunk.create_tuples(verbose=False)
+      chunk.append_columns(writer, num_paragraphs)
+      num_articles += len(articles)
+      num_paragraphs += len(chunk.paragraphs)
+      num_tuples += len(chunk.data)
+      self.missed += chunk.missed
+      print "\r%d Articles, %d Paragraphs, %d data tuples processed." \
+              % (num_articles, num_paragraphs, num_tuples),
+      sys.stdout.flush()
+    print ""
+    writer.close()
+    self.write_columns_meta(filename)
+    return self.read_from_columns(filename)
+
+  # Tokenize and tag all paragraphs and questions.
+  def tokenize(self, annotation_cache=None, verbose=True):
+    if verbose:
+      print "Tokenizing paragraphs (%d total)..." % len(self.paragraphs)
+    _, self.tokenized_para_words, self.paras_pos_tags, self.paras_ner_tags, \
+      self.paras_token_begins, self.paras_token_ends = \
+      unzip(tokenize_and_tag_all([ (None, para_text) \
+                                     for para_text in self.paragraphs ],
+                                 verbose=2 if verbose else 0,
+                                 cache=annotation_cache), 6)
+
+    if verbose:
+      print "Tokenizing questions (%d total)..." % len(self.questions)
+    qids, questions_tokenized_words, question_pos_tags, question_ner_tags, \
+      _, _ = \
+      unzip(tokenize_and_tag_all([ (qid, self.questions[qid]) \
+                                     for qid in self.questions ],
+                                 verbose=10 if verbose else 0,
+                                 cache=annotation_cache), 6)
+    self.questions_tokenized_words = dict(zip(qids, questions_tokenized_words))
+    self.question_pos_tags = dict(zip(qids, question_pos_tags))
+    self.question_ner_tags = dict(zip(qids, question_ner_tags))
+
+  # Get the word and tag indices of all tokenized paragraphs and questions,
+  # and create the data tuples.
+  def create_tuples(self, verbose=True):
+    if verbose:
+      print "Indexing paragraphs..."
+    for tokenized_para_words in tqdm(self.tokenized_para_words,
+                                     disable=not verbose):
       if tokenized_para_words is None:
         self.tokenized_paras.append(None)
         continue
       self.tokenized_paras.append(self.get_ids(tokenized_para_words))
-    self.paras_pos_tags = list(self.paras_pos_tags)
-    for sent_id, pos_tagged_para in tqdm(enumerate(self.paras_pos_tags)):
+    for sent_id, pos_tagged_para in tqdm(enumerate(self.paras_pos_tags),
+                                         disable=not verbose):
       if pos_tagged_para is None:
         continue
       assert len(pos_tagged_para) == len(self.tokenized_paras[sent_id]), str(sent_id)
       self.paras_pos_tags[sent_id] = \
         [ self.dictionary.add_or_get_postag(tag) for tag in pos_tagged_para ]
-    self.paras_ner_tags = list(self.paras_ner_tags)
-    for sent_id, ner_tagged_para in tqdm(enumerate(self.paras_ner_tags)):
+    for sent_id, ner_tagged_para in tqdm(enumerate(self.paras_ner_tags),
+                                         disable=not verbose):
       if ner_tagged_para is None:
         continue
       assert len(ner_tagged_para) == len(self.tokenized_paras[sent_id]), str(sent_id)
       self.paras_ner_tags[sent_id] = \
         [ self.dictionary.add_or_get_nertag(tag) for tag in ner_tagged_para ]
-    print "Done!"
-
-    print "Tokenizing questions (%d total)..." % len(self.questions)
-    qids, self.questions_tokenized_words, self.question_pos_tags, self.question_ner_tags  = \
-      zip(*Parallel(n_jobs=-1, verbose=10)(
-        delayed(tokenize_and_tag)(qid, self.questions[qid]) for qid in self.questions))
-    self.questions_tokenized_words = dict(zip(qids, self.questions_tokenized_words))
-    self.question_pos_tags = dict(zip(qids, self.question_pos_tags))
-    self.question_ner_tags = dict(zip(qids, self.question_ner_tags))
-    for qid in tqdm(self.questions):
+
+    if verbose:
+      print "Indexing questions..."
+    for qid in tqdm(self.questions, disable=not verbose):
       if self.questions_tokenized_words[qid] is None:
         continue
       self.questions_tokenized[qid] = self.get_ids(self.questions_tokenized_words[qid])
-    for qid in tqdm(self.question_pos_tags):
+    for qid in tqdm(self.question_pos_tags, disable=not verbose):
       if self.question_pos_tags[qid] is None:
         continue
       assert len(self.question_pos_tags[qid]) == len(self.questions_tokenized_words[qid]),\
              str(qid)
       self.question_pos_tags[qid] = \
         [ self.dictionary.add_or_get_postag(tag) for tag in self.question_pos_tags[qid] ]
-    for qid in tqdm(self.question_ner_tags):
+    for qid in tqdm(self.question_ner_tags, disable=not verbose):
       if self.question_ner_tags[qid] is None:
         continue
       assert len(self.question_ner_tags[qid]) == len(self.question_pos_tags[qid]),\
              str(qid)
       self.question_ner_tags[qid] = \
         [ self.dictionary.add_or_get_nertag(tag) for tag in self.question_ner_tags[qid] ]
-    print "Done!"
 
+    # Answers are aligned through token offsets, which is cheaper than
+    # handing the paragraphs over to worker processes.
     to_process = (sum([ len(self.answers[qid]) for qid in self.questions ]))
-    print "Creating data tuples for input (%d total)..." % to_process
+    if verbose:
+      print "Creating data tuples for input (%d total)..." % to_process
     qtop = self.question_to_paragraph
-    data, missed = \
-      zip(*Parallel(n_jobs=-1, verbose=10, batch_size=10000)\
-             (delayed(create_data)(qid, self.paragraphs[qtop[qid]],
-                                   self.tokenized_paras[qtop[qid]],
-                                   self.tokenized_para_words[qtop[qid]],
-                                   self.questions_tokenized[qid], self.dictionary,
-                                   self.questions[qid], self.answers[qid]) \
-                for qid in self.questions_tokenized))
-    self.data = [ item for sublist in data for item in sublist ]
-    self.missed = sum(missed)
-    print "Done!"
-
-    return dev_data
+    self.data = []
+    self.missed = 0
+    for qid in self.questions_tokenized:
+      data, missed = create_data(qid, self.paragraphs[qtop[qid]],
+                                 self.tokenized_paras[qtop[qid]],
+                                 self.tokenized_para_words[qtop[qid]],
+                                 self.paras_token_begins[qtop[qid]],
+                                 self.paras_token_ends[qtop[qid]],
+                                 self.questions_tokenized[qid],
+                                 self.questions[qid], self.answers[qid])
+      self.data.extend(data)
+      self.missed += missed
+    if verbose:
+      print "Done!"
+
+  # Read a json file, reusing the processed articles of an ArticleStore.
+  # Articles that aren't in the store (new or changed ones) are tokenized
+  # together, indexed one article at a time, in file order, and stored.
+  def read_from_file_incremental(self, filename, max_articles, article_store,
+                                 annotation_cache=None):
+    new_data = Data(self.dictionary)
+    new_sizes = []
+    articles = []
+    for article in iter_json_articles(filename, max_articles):
+      key = article_store.key(article)
+      chunk = article_store.get(key)
+      if chunk is None:
+        for paragraph in article['paragraphs']:
+          new_data.add_paragraph(paragraph)
+        new_sizes.append(len(article['paragraphs']))
+      articles.append((key, chunk))
+    print "%d Articles read, %d new or changed." % (len(articles), len(new_sizes))
+
+    new_data.tokenize(annotation_cache)
+    new_chunks = iter(new_data.split_articles(new_sizes))
+    for key, chunk in articles:
+      if chunk is None:
+        chunk = next(new_chunks)
+        chunk.create_tuples(verbose=False)
+        article_store.put(key, chunk)
+      self.extend(chunk)
+    article_store.flush()
+
+  # Split tokenized data (before create_tuples) into one Data per article,
+  # given the number of paragraphs of each article.
+  def split_articles(self, article_sizes):
+    starts = [ 0 ] + numpy.cumsum(article_sizes).tolist()
+    chunks = []
+    for start, end in zip(starts[:-1], starts[1:]):
+      chunk = Data(self.dictionary)
+      chunk.paragraphs = self.paragraphs[start:end]
+      chunk.tokenized_para_words = self.tokenized_para_words[start:end]
+      chunk.paras_pos_tags = self.paras_pos_tags[start:end]
+      chunk.paras_ner_tags = self.paras_ner_tags[start:end]
+      chunk.paras_token_begins = self.paras_token_begins[start:end]
+      chunk.paras_token_ends = self.paras_token_ends[start:end]
+      chunks.append(chunk)
+    for qid, para in self.question_to_paragraph.iteritems():
+      # The last article starting at or before the paragraph (articles
+      # without paragraphs start where the next one does).
+      article = bisect.bisect_right(starts, para) - 1
+      chunk = chunks[article]
+      chunk.question_to_paragraph[qid] = para - starts[article]
+      chunk.questions[qid] = self.questions[qid]
+      chunk.answers[qid] = self.answers[qid]
+      chunk.questions_tokenized_words[qid] = self.questions_tokenized_words[qid]
+      chunk.question_pos_tags[qid] = self.question_pos_tags[qid]
+      chunk.question_ner_tags[qid] = self.question_ner_tags[qid]
+    return chunks
+
+  # Append the paragraphs, questions and data tuples of another Data, indexed
+  # with the same dictionary. Raw and tokenized texts are not copied.
+  def extend(self, other):
+    para_base = len(self.tokenized_paras)
+    self.tokenized_paras.extend(other.tokenized_paras)
+    self.paras_pos_tags.extend(other.paras_pos_tags)
+    self.paras_ner_tags.extend(other.paras_ner_tags)
+    for qid, para in other.question_to_paragraph.iteritems():
+      self.question_to_paragraph[qid] = para_base + para
+    self.questions_tokenized.update(other.questions_tokenized)
+    self.question_pos_tags.update(other.question_pos_tags)
+    self.question_ner_tags.update(other.question_ner_tags)
+    self.data.extend(other.data)
+    self.missed += other.missed
+
+class ArticleStore:
+  ''' Processed articles, keyed by a hash of their json, for incremental
+      builds. Each article's word and tag indices and data tuples are pickled
+      to their own file, so they stay valid only as long as the indices do:
+      the store keeps the words and tags of the dictionary, which are loaded
+      into it on open, and only ever appended to. Words of changed or removed
+      articles stay in the vocabulary.'''
+
+  # Part of every key, so that records of an older format are never read.
+  format_version = 1
+  # Data fields pickled for each article.
+  fields = ('tokenized_paras', 'paras_pos_tags', 'paras_ner_tags',
+            'question_to_paragraph', 'questions_tokenized',
+            'question_pos_tags', 'question_ner_tags', 'data', 'missed')
+
+  def __init__(self, dirname, dictionary):
+    self.dirname = dirname
+    self.dictionary = dictionary
+    self.pending = {}
+    self.hits = 0
+    self.misses = 0
+    if not os.path.exists(os.path.join(dirname, "articles")):
+      os.makedirs(os.path.join(dirname, "articles"))
+
+    # The vocabulary is a word list, appended to. A word left incomplete by
+    # an interrupted run is dropped.
+    vocab_filename = os.path.join(dirname, "vocab.txt")
+    if not os.path.exists(vocab_filename):
+      open(vocab_filename, 'wb').close()
+    with open(vocab_filename, 'rb') as fin:
+      vocab = fin.read()
+    words, end = decode_words(vocab)
+    if end < len(vocab):
+      with open(vocab_filename, 'r+b') as fout:
+        fout.truncate(end)
+    tags = { 'pos_tags': {}, 'ner_tags': {} }
+    if os.path.exists(os.path.join(dirname, "tags.json")):
+      with open(os.path.join(dirname, "tags.json"), 'r') as fin:
+        tags = json.load(fin)
+
+    # The dictionary may already hold some of the words, but must not give
+    # them other indices.
+    for index, word in enumerate(words):
+      assert dictionary.add_word(word) == index, \
+             "Dictionary doesn't match the vocabulary of %s." % dirname
+    for tag, index in sorted(tags['pos_tags'].iteritems(),
+                             key=lambda item: item[1]):
+      assert dictionary.add_or_get_postag(tag) == index
+    for tag, index in sorted(tags['ner_tags'].iteritems(),
+                             key=lambda item: item[1]):
+      assert dictionary.add_or_get_nertag(tag) == index
+    self.num_words = len(words)
+
+  def key(self, article):
+    return hashlib.sha1('%d\0%s' % (self.format_version,
+                                    json.dumps(article, sort_keys=True))) \
+             .hexdigest()
+
+  def filename(self, key):
+    return os.path.join(self.dirname, "articles", key + ".pkl")
+
+  # Returns the processed Data of the article with the given key, or None.
+  def get(self, key):
+    if key in self.pending:
+      record = self.pending[key]
+    elif os.path.exists(self.filename(key)):
+      with open(self.filename(key), 'rb') as fin:
+        record = pickle.load(fin)
+    else:
+      self.misses += 1
+      return None
+    self.hits += 1
+    chunk = Data(self.dictionary)
+    for field in self.fields:
+      setattr(chunk, field, record[field])
+    return chunk
+
+  def put(self, key, chunk):
+    self.pending[key] = dict((field, getattr(chunk, field)) \
+                               for field in self.fields)
+
+  # Append the new words of the dictionary to the vocabulary, and then write
+  # all pending articles, so that no article refers to an unsaved word.
+  def flush(self):
+    words = self.dictionary.index_to_word[self.num_words:]
+    if len(words) > 0:
+      with open(os.path.join(self.dirname, "vocab.txt"), 'ab') as fout:
+        fout.write(encode_words(words))
+      self.num_words += len(words)
+    tags_filename = os.path.join(self.dirname, "tags.json")
+    with open(tags_filename + ".tmp", 'w') as fout:
+      json.dump({ 'pos_tags': self.dictionary.pos_tags,
+                  'ner_tags': self.dictionary.ner_tags }, fout)
+    os.rename(tags_filename + ".tmp", tags_filename)
+    # Renamed once complete, so that an interrupted write isn't read back.
+    for key, record in self.pending.iteritems():
+      with open(self.filename(key) + ".tmp", 'wb') as fout:
+        pickle.dump(record, fout, pickle.HIGHEST_PROTOCOL)
+      os.rename(self.filename(key) + ".tmp", self.filename(key))
+    self.pending = {}
+
+# Transpose a list of tuples of the given size into lists, one per field.
+def unzip(tuples, size):
+  if len(tuples) == 0:
+    return [ [] for _ in range(size) ]
+  return [ list(field) for field in zip(*tuples) ]
+
+# Split an iterable into lists of size items (and a shorter last list).
+def iter_chunks(iterable, size):
+  chunk = []
+  for item in iterable:
+    chunk.append(item)
+    if len(chunk) == size:
+      yield chunk
+      chunk = []
+  if len(chunk) > 0:
+    yield chunk
+
+class JsonArticleReader:
+  ''' Reads the articles of a SQuAD json file one at a time, without loading
+      the whole file. The "data" list is decoded one article at a time with
+      JSONDecoder.raw_decode, and more of the file is only read when the next
+      article isn't complete yet. Other top-level fields (like "version") are
+      kept in fields, once read.'''
+
+  def __init__(self, filename, read_size=1 << 20):
+    self.filename = filename
+    self.read_size = read_size
+    self.decoder = json.JSONDecoder()
+    self.fields = {}
+
+  # Read more of the file into the buffer. Returns False at the end of file.
+  def fill(self):
+    text = self.reader.read(self.read_size)
+    if len(text) == 0:
+      return False
+    self.buffer = self.buffer[self.pos:] + text
+    self.pos = 0
+    return True
+
+  # Skip whitespace, and return the next character.
+  def peek(self):
+    while True:
+      while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+        self.pos += 1
+      if self.pos < len(self.buffer):
+        return self.buffer[self.pos]
+      if not self.fill():
+        raise ValueError("Unexpected end of %s." % self.filename)
+
+  def expect(self, char):
+    if self.peek() != char:
+      raise ValueError("Expected '%s' at %d in %s." % \
+                       (char, self.pos, self.filename))
+    self.pos += 1
+
+  # Decode the next json value. A value that ends with the buffer may be
+  # incomplete (like a number), so it is decoded again with more text.
+  def decode(self):
+    self.peek()
+    while True:
+      try:
+        value, end = self.decoder.raw_decode(self.buffer, self.pos)
+        if end < len(self.buffer) or not self.fill():
+          self.pos = end
+          return value
+      except ValueError:
+        if not self.fill():
+          raise
+
+  def __iter__(self):
+    with open(self.filename, 'rb') as fin:
+      self.reader = codecs.getreader('utf8')(fin)
+      self.buffer = u''
+      self.pos = 0
+      self.expect(u'{')
+      while self.peek() != u'}':
+        key = self.decode()
+        self.expect(u':')
+        if key == u'data':
+          self.expect(u'[')
+          while self.peek() != u']':
+            yield self.decode()
+            if self.peek() == u',':
+              self.pos += 1
+          self.pos += 1
+        else:
+          self.fields[key] = self.decode()
+        if self.peek() == u',':
+          self.pos += 1
+
+# Iterate over the first max_articles articles of a SQuAD json file (all, for
+# -1), without reading the rest of the file.
+def iter_json_articles(filename, max_articles=-1):
+  for article_index, article in enumerate(JsonArticleReader(filename)):
+    if article_index == max_articles:
+      break
+    yield article
 
 # Pad a given sequence upto length "length" with the given "element".
 def pad(seq, element, length):
@@ -386,48 +1239,242 @@ def pad(seq, element, length):
   assert len(padded_seq) == length
   return padded_seq
 
-# Create a 2D numpy array of shape "length"x"length" with the given values set,
-# and rest set to element.
-def create2d(partial_matrix, element, length, ans_start):
-  padded_mat = numpy.zeros((length, length))
-  padded_mat[:partial_matrix.shape[0], ans_start:ans_start+partial_matrix.shape[1]] = partial_matrix
-  return padded_mat
+class BucketSampler:
+  ''' Groups examples of similar (passage + question) lengths into buckets of
+      bucket_size examples, and cuts buckets into batches of batch_size
+      examples, or of as many examples as fit in max_tokens padded passage
+      tokens. When shuffling, examples are reshuffled within their bucket, and
+      batches are reshuffled, every epoch. Without a bucket size, all examples
+      form a single bucket in decreasing order of length.'''
+
+  def __init__(self, passage_lens, question_lens, batch_size, bucket_size=0,
+               max_tokens=0, shuffle=True):
+    self.passage_lens = passage_lens
+    self.question_lens = question_lens
+    self.batch_size = batch_size
+    self.bucket_size = bucket_size
+    self.max_tokens = max_tokens
+    self.shuffle = shuffle
+    self.padding_efficiency = None
+
+    order = sorted(range(len(passage_lens)), reverse=True,
+                   key=lambda idx: passage_lens[idx] + question_lens[idx])
+    if bucket_size > 0:
+      self.buckets = [ order[i:i+bucket_size] \
+                         for i in range(0, len(order), bucket_size) ]
+    else:
+      self.buckets = [ order ]
+
+  # Split a bucket into batches of example indices.
+  def split_bucket(self, bucket):
+    if self.max_tokens <= 0:
+      return [ bucket[i:i+self.batch_size] \
+                 for i in range(0, len(bucket), self.batch_size) ]
+    batches, batch, max_len = [], [], 0
+    for idx in bucket:
+      new_max_len = max(max_len, self.passage_lens[idx])
+      if len(batch) > 0 and new_max_len * (len(batch) + 1) > self.max_tokens:
+        batches.append(batch)
+        batch, new_max_len = [], self.passage_lens[idx]
+      batch.append(idx)
+      max_len = new_max_len
+    if len(batch) > 0:
+      batches.append(batch)
+    return batches
+
+  # Get batches of example indices for the next epoch, and record the
+  # padding efficiency (real tokens / padded tokens) of these batches.
+  def get_batches(self):
+    batches = []
+    for bucket in self.buckets:
+      if self.shuffle and self.bucket_size > 0:
+        bucket = list(bucket)
+        random.shuffle(bucket)
+      batches.extend(self.split_bucket(bucket))
+    if self.shuffle:
+      random.shuffle(batches)
+
+    real_tokens, padded_tokens = 0, 0
+    for batch in batches:
+      passage_lens = [ self.passage_lens[idx] for idx in batch ]
+      question_lens = [ self.question_lens[idx] for idx in batch ]
+      real_tokens += sum(passage_lens) + sum(question_lens)
+      padded_tokens += len(batch) * (max(passage_lens) + max(question_lens))
+    self.padding_efficiency = real_tokens / float(max(padded_tokens, 1))
+    return batches
+
+class BatchPrefetcher:
+  ''' Iterates over (batch, make_batch(batch)) pairs, with make_batch run
+      ahead of time by worker threads. At most depth prepared batches are held
+      in a bounded queue, in order. Threads share the dataset with the training
+      loop, so batches are never copied between workers. With no workers,
+      batches are prepared synchronously. If the loop stops early, the threads
+      stop too, and drop their prepared batches.
+      Workers hold the GIL while running Python code, so they only overlap
+      with the parts of the model step that release it.'''
+
+  def __init__(self, batches, make_batch, num_workers=1, depth=2):
+    self.batches = batches
+    self.make_batch = make_batch
+    self.num_workers = num_workers
+    self.depth = max(depth, num_workers)
+    # Total time spent waiting for (or, without workers, preparing) batches.
+    self.wait_time = 0.0
+
+  def __len__(self):
+    return len(self.batches)
+
+  def __iter__(self):
+    if self.num_workers == 0:
+      for batch in self.batches:
+        start_t = time.time()
+        prepared = self.make_batch(batch)
+        self.wait_time += time.time() - start_t
+        yield batch, prepared
+      return
+
+    # Each slot is (done event, [prepared batch, exception info]). Slots are
+    # queued in batch order, so that batches are handed over in order no
+    # matter which worker prepares them.
+    slots = Queue.Queue(maxsize=self.depth)
+    tasks = Queue.Queue()
+    # Set when the loop stops, early or not. The feed thread stops queueing
+    # batches, and workers stop at their next task.
+    stop = threading.Event()
+
+    def feed():
+      for batch in self.batches:
+        slot = (threading.Event(), [None, None])
+        # Wait for a free slot, unless the loop stops first.
+        while True:
+          if stop.is_set():
+            return
+          try:
+            slots.put((batch, slot), timeout=0.1)
+            break
+          except Queue.Full:
+            pass
+        tasks.put((batch, slot))
+      slots.put(None)
+      for _ in range(self.num_workers):
+        tasks.put(None)
+
+    def work():
+      while True:
+        task = tasks.get()
+        if task is None or stop.is_set():
+          return
+        batch, (done, result) = task
+        try:
+          result[0] = self.make_batch(batch)
+        except Exception:
+          result[1] = sys.exc_info()
+        done.set()
+
+    threads = [ threading.Thread(target=feed) ] + \
+              [ threading.Thread(target=work) for _ in range(self.num_workers) ]
+    for thread in threads:
+      thread.daemon = True
+      thread.start()
+
+    try:
+      while True:
+        start_t = time.time()
+        item = slots.get()
+        if item is None:
+          break
+        batch, (done, result) = item
+        while not done.wait(1.0):
+          pass
+        self.wait_time += time.time() - start_t
+        if result[1] is not None:
+          raise result[1][0], result[1][1], result[1][2]
+        yield batch, result[0]
+    finally:
+      # Wake up the workers waiting for tasks, and drop the prepared batches.
+      stop.set()
+      for _ in range(self.num_workers):
+        tasks.put(None)
+      while True:
+        try:
+          slots.get_nowait()
+        except Queue.Empty:
+          break
 
 # Create a one-hot vector of the given size, with position 'pos' set to 1.
 def one_hot(pos, size):
   return [ 1 if i == pos else 0 for i in range(size) ]
 
-# Read train and dev data, either from json files or from pickles, and dump them in
-# pickles if necessary.
+# Read train and dev data, either from json files or from pickles (or columnar
+# stores, for data_format 'columnar'), and dump them if necessary. With
+# stream_articles > 0, json files are read that many articles at a time, and
+# written to columnar stores at the pickle paths as they are read. With an
+# article_store directory, only the articles that aren't in its ArticleStore
+# are processed.
 def read_data(train_json, train_pickle, dev_json, dev_pickle, max_train_articles,
-              max_dev_articles, dump_pickles):
+              max_dev_articles, dump_pickles, annotation_cache=None,
+              data_format='pickle', stream_articles=0, article_store=None):
   reload(sys)
   sys.setdefaultencoding('utf-8')
+  if annotation_cache is not None:
+    annotation_cache = AnnotationCache(annotation_cache)
+  if stream_articles > 0:
+    assert data_format == 'columnar', "Streaming needs the columnar format."
+    assert (train_pickle or not train_json) and (dev_pickle or not dev_json)
   train_data = Data()
+  if article_store is not None:
+    assert stream_articles <= 0, "Streaming can't use an article store."
+    assert train_json, "An article store needs the train json."
+    article_store = ArticleStore(article_store, train_data.dictionary)
   print "Reading training data."
-  if train_json:
-    train_data.read_from_file(train_json, max_train_articles)
+  if train_json and article_store is not None:
+    train_data.read_from_file_incremental(train_json, max_train_articles,
+                                          article_store, annotation_cache)
+  elif train_json and stream_articles > 0:
+    train_data.read_from_file_to_columns(train_json, max_train_articles,
+                                         train_pickle, stream_articles,
+                                         annotation_cache)
+  elif train_json:
+    train_data.read_from_file(train_json, max_train_articles, annotation_cache)
   else:
-    train_data = train_data.read_from_pickle(train_pickle)
+    train_data = train_data.read_from_dump(train_pickle, data_format)
 
   dev_data = Data(train_data.dictionary)
-  if dev_json:
+  if dev_json and stream_articles > 0:
+    print "Reading dev data."
+    dev_data.read_from_file_to_columns(dev_json, max_dev_articles, dev_pickle,
+                                       stream_articles, annotation_cache)
+    # Dev words are added to the train dictionary too, as in the pickles.
+    if train_json:
+      train_data.write_columns_meta(train_pickle)
+  elif dev_json and article_store is not None:
+    print "Reading dev data."
+    dev_data.read_from_file_incremental(dev_json, max_dev_articles,
+                                        article_store, annotation_cache)
+  elif dev_json:
     print "Reading dev data."
-    dev_json_data = dev_data.read_from_file(dev_json, max_dev_articles)
+    dev_data.read_from_file(dev_json, max_dev_articles, annotation_cache)
   else:
     print "Reading dev data."
-    dev_data = dev_data.read_from_pickle(dev_pickle)
+    dev_data = dev_data.read_from_dump(dev_pickle, data_format)
     print "Done."
 
-  if dump_pickles:
+  # Streamed data is already in its store.
+  if dump_pickles and stream_articles <= 0:
     assert not train_pickle == None
     assert not dev_pickle == None
     print "Dumping pickles."
-    train_data.dump_pickle(train_pickle)
-    dev_data.dump_pickle(dev_pickle)
+    train_data.dump(train_pickle, data_format)
+    dev_data.dump(dev_pickle, data_format)
     print "Done."
 
   print "Finished reading all required data."
+  if annotation_cache is not None:
+    print "Annotation cache: %d hits, %d misses." % \
+          (annotation_cache.hits, annotation_cache.misses)
+  if article_store is not None:
+    print "Article store: %d articles reused, %d processed." % \
+          (article_store.hits, article_store.misses)
   print "Train missed %d questions, Dev missed %d." % (train_data.missed, dev_data.missed)
 
   print "Done."
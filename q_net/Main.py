@@ -5,7 +5,6 @@ import cPickle as pickle
 import json
 import numpy as np
 import os
-import random
 import sys
 import time
 import torch
@@ -14,7 +13,7 @@ import torch.nn as nn
 from operator import itemgetter
 from torch.autograd import Variable
 from torch.optim import SGD, Adamax
-from Input import Dictionary, Data, pad, read_data, create2d, one_hot
+from Input import BatchPrefetcher, BucketSampler, Dictionary, Data, pad, read_data, one_hot
 from qNet import qNet
 
 def init_parser():
@@ -35,6 +34,20 @@ def init_parser():
   parser.add_argument('--dump_pickles', action='store_true',
                       help = "Whether the train/dev pickles must be dumped. Input jsons must be "\
                              "provided to create these pickles.")
+  parser.add_argument('--data_format', default='pickle', choices=['pickle', 'columnar'],
+                      help = "Format of the dumped train/dev data. 'columnar' stores flat token arrays "\
+                             "in <pickle path>.columns, which are memory-mapped when read.")
+  parser.add_argument('--stream_articles', type=int, default=0,
+                      help = "If positive, json files are read this many articles at a time, and each "\
+                             "chunk is written to the columnar store before the next one is "\
+                             "processed. Needs --data_format columnar.")
+  parser.add_argument('--article_store',
+                      help = "Directory of processed articles, keyed by a hash of their json, for "\
+                             "incremental builds: only new or changed articles are processed. Word "\
+                             "indices are kept across builds, by appending to the store's vocabulary.")
+  parser.add_argument('--annotation_cache',
+                      help = "Path to a CoreNLP annotation cache file. Texts already annotated in a "\
+                             "previous run (of any model sharing the file) are not sent to the server.")
   parser.add_argument('--max_train_articles', type=int, default=-1,
                       help = "Maximum number of training articles to use, while reading from the "\
                              "train json file.")
@@ -59,6 +72,12 @@ def init_parser():
                       help = "Stop training if dev loss has increased continuously for these many epochs.")
   parser.add_argument('--vectors_path', default='../../data/fasttext/crawl-300d-2M.vec',
                       help = "Path to the pre-trained vectors to use for the embedding layer.")
+  parser.add_argument('--unknown_embedding_init', default='full',
+                      choices=['full', 'diagonal', 'cholesky'],
+                      help = "How embeddings of words without pre-trained vectors are sampled, from the "\
+                             "mean and covariance of the known vectors. 'full' uses the full covariance, "\
+                             "'diagonal' only the per-dimension variances, and 'cholesky' the full "\
+                             "covariance through a Cholesky factor cached next to the vectors file.")
   parser.add_argument('--disable_pretrained', action='store_true',
                       help = "When provided, pretrained vectors are not used, and an embedding layer is "\
                              "learned in an end-to-end manner.")
@@ -74,8 +93,24 @@ def init_parser():
                              "dev predictions json files after every epoch.")
   parser.add_argument('--batch_size', type=int, default=32,
                       help = "Batch size to use during training.")
+  parser.add_argument('--bucket_size', type=int, default=0,
+                      help = "Number of training examples of similar lengths grouped in a bucket, "\
+                             "within which examples are reshuffled every epoch. If 0, batches are "\
+                             "fixed, and only their order is shuffled.")
+  parser.add_argument('--max_train_tokens_per_batch', type=int, default=0,
+                      help = "If set, training batches hold as many examples as fit in this many "\
+                             "padded passage tokens, instead of batch_size examples.")
   parser.add_argument('--test_batch_size', type=int, default=32,
                       help = "Batch size to use during development and test data passes.")
+  parser.add_argument('--max_tokens_per_batch', type=int, default=0,
+                      help = "If set, development and test batches hold as many examples as fit in "\
+                             "this many padded passage tokens, instead of test_batch_size examples.")
+  parser.add_argument('--num_batch_workers', type=int, default=0,
+                      help = "Number of background threads preparing batches ahead of the model. "\
+                             "If 0, batches are prepared synchronously. Batch preparation holds the "\
+                             "GIL, so it only overlaps with model computation that releases the GIL.")
+  parser.add_argument('--prefetch_depth', type=int, default=4,
+                      help = "Maximum number of batches prepared ahead of the model.")
   parser.add_argument('--optimizer', default='Adamax',
                       help = "Optimizer to use. One of either 'SGD', 'Adamax' or 'Adadelta'.")
   parser.add_argument('--debug_level', type=int, default=0,
@@ -103,6 +138,18 @@ def init_parser():
                              "smaller magnitude than the MLE loss.")
   parser.add_argument('--f1_loss_threshold', type=float, default=-1.0,
                       help = "Only penalize F1 values below this threshold. -1 is the distribution loss.")
+  parser.add_argument('--index_tags', action='store_true',
+                      help = "If this flag is set, POS and NER tags are passed to the model as index "\
+                             "tensors and one-hot encoded there, instead of as one-hot arrays.")
+  parser.add_argument('--share_passage_encoding', action='store_true',
+                      help = "If this flag is set, passages shared by several questions in a batch "\
+                             "are embedded and pre-processed once.")
+  parser.add_argument('--fuse_directions', action='store_true',
+                      help = "If this flag is set, the forward and backward directions of the "\
+                             "Match-LSTM layers are run as one batch at each time step.")
+  parser.add_argument('--log_space', action='store_true',
+                      help = "If this flag is set, the answer pointer outputs log-probabilities, and "\
+                             "the loss and answer spans are computed from those.")
   parser.add_argument('--show_losses', action='store_true',
                       help = "If this flag is set, the individual values of the MLE and F1 losses are "\
                              "displayed during training.")
@@ -112,6 +159,14 @@ def init_parser():
 
 
 #------------- ---------------- Preprocess data -------------------------------#
+# Get passage and question lengths of the given examples.
+def get_lengths(data, ques_to_para, tokenized_paras):
+  passage_lens = [ len(tokenized_paras[ques_to_para[example[2]]]) \
+                     for example in data ]
+  question_lens = [ len(example[0]) for example in data ]
+  return passage_lens, question_lens
+
+
 def read_and_process_data(args):
   assert not (args.train_json == None and args.train_pickle == None)
   assert not (args.dev_json == None and args.dev_pickle == None)
@@ -119,7 +174,9 @@ def read_and_process_data(args):
   #----------------------- Read train, dev and test data ------------------------#
   train_data, dev_data = \
     read_data(args.train_json, args.train_pickle, args.dev_json, args.dev_pickle,
-              args.max_train_articles, args.max_dev_articles, args.dump_pickles)
+              args.max_train_articles, args.max_dev_articles, args.dump_pickles,
+              args.annotation_cache, args.data_format, args.stream_articles,
+              args.article_store)
   #------------------------------------------------------------------------------#
 
   # Our dev is also test...
@@ -137,20 +194,17 @@ def read_and_process_data(args):
   dev_tokenized_paras = dev_data.tokenized_paras
   test_tokenized_paras = dev_data.tokenized_paras
 
-  # Sort data by increasing passage+question, for efficient batching.
+  # Sort data by decreasing passage+question, for efficient batching.
   # Data format = (tokenized_question, tokenized_answer, question_id).
   print "Sorting datasets in decreasing order of (para + question) lengths."
-  train.sort(cmp=lambda x,y:\
-      len(x[0]) + len(train_tokenized_paras[train_ques_to_para[x[2]]]) -\
-      (len(y[0]) + len(train_tokenized_paras[train_ques_to_para[y[2]]])),
+  train.sort(key=lambda x:\
+      len(x[0]) + len(train_tokenized_paras[train_ques_to_para[x[2]]]),
       reverse=True)
-  dev.sort(cmp=lambda x,y:\
-      len(x[0]) + len(dev_tokenized_paras[dev_ques_to_para[x[2]]]) -\
-      (len(y[0]) + len(dev_tokenized_paras[dev_ques_to_para[y[2]]])),
+  dev.sort(key=lambda x:\
+      len(x[0]) + len(dev_tokenized_paras[dev_ques_to_para[x[2]]]),
       reverse=True)
-  test.sort(cmp=lambda x,y:\
-      len(x[0]) + len(test_tokenized_paras[test_ques_to_para[x[2]]]) -\
-      (len(y[0]) + len(test_tokenized_paras[test_ques_to_para[y[2]]])),
+  test.sort(key=lambda x:\
+      len(x[0]) + len(test_tokenized_paras[test_ques_to_para[x[2]]]),
       reverse=True)
   print "Done."
 
@@ -160,15 +214,25 @@ def read_and_process_data(args):
     dev = dev[:320]
     test = test[:320]
 
-  train_order = [ i for i in range(0, len(train), batch_size) ]
-  dev_order = [ i for i in range(0, len(dev), test_batch_size) ]
-  test_order = [ i for i in range(0, len(test), test_batch_size) ]
+  # Samplers giving the batches of example indices for every epoch.
+  train_sampler = \
+    BucketSampler(*get_lengths(train, train_ques_to_para, train_tokenized_paras),
+                  batch_size = batch_size, bucket_size = args.bucket_size,
+                  max_tokens = args.max_train_tokens_per_batch)
+  dev_sampler = \
+    BucketSampler(*get_lengths(dev, dev_ques_to_para, dev_tokenized_paras),
+                  batch_size = test_batch_size,
+                  max_tokens = args.max_tokens_per_batch, shuffle = False)
+  test_sampler = \
+    BucketSampler(*get_lengths(test, test_ques_to_para, test_tokenized_paras),
+                  batch_size = test_batch_size,
+                  max_tokens = args.max_tokens_per_batch, shuffle = False)
   print "Done."
 
   return train, dev, test, batch_size, test_batch_size, train_ques_to_para,\
          dev_ques_to_para, test_ques_to_para, train_tokenized_paras,\
-         dev_tokenized_paras, test_tokenized_paras, train_order, dev_order,\
-         test_order, train_data, dev_data, test_data
+         dev_tokenized_paras, test_tokenized_paras, train_sampler, dev_sampler,\
+         test_sampler, train_data, dev_data, test_data
 #------------------------------------------------------------------------------#
 
 
@@ -183,6 +247,7 @@ def build_model(args, vocab_size, index_to_word, word_to_index, num_pos_tags,
              'lr' : args.learning_rate_start,
              'dropout' : args.dropout,
              'vectors_path' : args.vectors_path,
+             'unknown_embedding_init' : args.unknown_embedding_init,
              'use_pretrained' : not args.disable_pretrained,
              'ckpt': args.ckpt,
              'optimizer': args.optimizer,
@@ -219,15 +284,28 @@ def build_model(args, vocab_size, index_to_word, word_to_index, num_pos_tags,
 
 #--------------------------- Create an input minibatch ------------------------#
 def get_batch(batch, ques_to_para, tokenized_paras, paras_pos_tags, paras_ner_tags,
-              question_pos_tags, question_ner_tags, num_pos_tags, num_ner_tags):
+              question_pos_tags, question_ner_tags, num_pos_tags, num_ner_tags,
+              index_tags=False, share_passages=False):
+  # Paragraphs of the batch. When sharing passages, each distinct paragraph
+  # is input once, and passage_map gives the paragraph of each example.
+  para_ids = [ ques_to_para[example[2]] for example in batch ]
+  passage_map = None
+  if share_passages:
+    # Distinct paragraphs in order of first appearance, and their positions.
+    unique_para_ids = []
+    positions = {}
+    for para_id in para_ids:
+      if para_id not in positions:
+        positions[para_id] = len(unique_para_ids)
+        unique_para_ids.append(para_id)
+    passage_map = np.array([ positions[para_id] for para_id in para_ids ])
+    para_ids = unique_para_ids
+
   # Variable length question, answer and paragraph sequences for batch.
   ques_lens_in = [ len(example[0]) for example in batch ]
-  paras_in = [ tokenized_paras[ques_to_para[example[2]]] \
-                 for example in batch ]
-  paras_pos_tags_in = [ paras_pos_tags[ques_to_para[example[2]]] \
-                          for example in batch ]
-  paras_ner_tags_in = [ paras_ner_tags[ques_to_para[example[2]]] \
-                          for example in batch ]
+  paras_in = [ tokenized_paras[para_id] for para_id in para_ids ]
+  paras_pos_tags_in = [ paras_pos_tags[para_id] for para_id in para_ids ]
+  paras_ner_tags_in = [ paras_ner_tags[para_id] for para_id in para_ids ]
   ques_pos_tags_in = [ question_pos_tags[example[2]] \
                           for example in batch ]
   ques_ner_tags_in = [ question_ner_tags[example[2]] \
@@ -240,52 +318,99 @@ def get_batch(batch, ques_to_para, tokenized_paras, paras_pos_tags, paras_ner_ta
   ans_in = np.array([ example[1] for example in batch ]).T
   sent_in = np.array([ example[4] for example in batch ]).T
 
-  # f1_mat_in.shape = (batch, seq_len, seq_len)
-  f1_mat_in = np.array([ create2d(example[3], 0, max_para_len, example[1][0]) \
-                           for example in batch])
   # Fixed-length (padded) input sequences with shape=(seq_len, batch).
   ques_in = np.array([ pad(example[0], 0, max_ques_len)\
                          for example in batch ]).T
   paras_in = np.array([ pad(para, 0, max_para_len) for para in paras_in ]).T
 
   # Fixed-length (padded) pos-tag and ner-tag inputs.
-  question_pos_tags = \
-    np.array([ pad([ one_hot(postag, num_pos_tags) for postag in ques_pos_tags ],
-                   one_hot(-1, num_pos_tags),
-                   max_ques_len) \
-                 for ques_pos_tags in ques_pos_tags_in ])
-  question_ner_tags = \
-    np.array([ pad([ one_hot(nertag, num_ner_tags) for nertag in ques_ner_tags ],
-                   one_hot(-1, num_ner_tags),
-                   max_ques_len) \
-                 for ques_ner_tags in ques_ner_tags_in ])
-  paragraph_pos_tags = \
-    np.array([ pad([ one_hot(postag, num_pos_tags) for postag in paras_pos_tags ],
-                   one_hot(-1, num_pos_tags),
-                   max_para_len) \
-                 for paras_pos_tags in paras_pos_tags_in ])
-  paragraph_ner_tags = \
-    np.array([ pad([ one_hot(nertag, num_ner_tags) for nertag in paras_ner_tags ],
-                   one_hot(-1, num_ner_tags),
-                   max_para_len) \
-                 for paras_ner_tags in paras_ner_tags_in ])
-  question_pos_tags = np.transpose(question_pos_tags, (1, 0, 2))
-  question_ner_tags = np.transpose(question_ner_tags, (1, 0, 2))
-  paragraph_pos_tags = np.transpose(paragraph_pos_tags, (1, 0, 2))
-  paragraph_ner_tags = np.transpose(paragraph_ner_tags, (1, 0, 2))
+  if index_tags:
+    # Tag indices with shape=(seq_len, batch), padded with -1.
+    question_pos_tags = np.array([ pad(ques_pos_tags, -1, max_ques_len) \
+                                     for ques_pos_tags in ques_pos_tags_in ]).T
+    question_ner_tags = np.array([ pad(ques_ner_tags, -1, max_ques_len) \
+                                     for ques_ner_tags in ques_ner_tags_in ]).T
+    paragraph_pos_tags = np.array([ pad(paras_pos_tags, -1, max_para_len) \
+                                      for paras_pos_tags in paras_pos_tags_in ]).T
+    paragraph_ner_tags = np.array([ pad(paras_ner_tags, -1, max_para_len) \
+                                      for paras_ner_tags in paras_ner_tags_in ]).T
+  else:
+    question_pos_tags = \
+      np.array([ pad([ one_hot(postag, num_pos_tags) for postag in ques_pos_tags ],
+                     one_hot(-1, num_pos_tags),
+                     max_ques_len) \
+                   for ques_pos_tags in ques_pos_tags_in ])
+    question_ner_tags = \
+      np.array([ pad([ one_hot(nertag, num_ner_tags) for nertag in ques_ner_tags ],
+                     one_hot(-1, num_ner_tags),
+                     max_ques_len) \
+                   for ques_ner_tags in ques_ner_tags_in ])
+    paragraph_pos_tags = \
+      np.array([ pad([ one_hot(postag, num_pos_tags) for postag in paras_pos_tags ],
+                     one_hot(-1, num_pos_tags),
+                     max_para_len) \
+                   for paras_pos_tags in paras_pos_tags_in ])
+    paragraph_ner_tags = \
+      np.array([ pad([ one_hot(nertag, num_ner_tags) for nertag in paras_ner_tags ],
+                     one_hot(-1, num_ner_tags),
+                     max_para_len) \
+                   for paras_ner_tags in paras_ner_tags_in ])
+    question_pos_tags = np.transpose(question_pos_tags, (1, 0, 2))
+    question_ner_tags = np.transpose(question_ner_tags, (1, 0, 2))
+    paragraph_pos_tags = np.transpose(paragraph_pos_tags, (1, 0, 2))
+    paragraph_ner_tags = np.transpose(paragraph_ner_tags, (1, 0, 2))
 
   passage_input = (paras_in, paras_lens_in)
   question_input = (ques_in, ques_lens_in)
   answer_input = ans_in
   answer_sentence_input = sent_in
 
-  return passage_input, question_input, answer_input, f1_mat_in, question_pos_tags,\
+  return passage_input, question_input, answer_input, question_pos_tags,\
          question_ner_tags, paragraph_pos_tags, paragraph_ner_tags,\
-         answer_sentence_input
+         answer_sentence_input, passage_map
 #------------------------------------------------------------------------------#
 
 
 #--------------- Get the answers from predicted distributions------------------#
+# Get the best (start, end) span for each example in the batch, with ends
+# at most max_answer_span - 1 tokens after starts (or anywhere in the
+# passage, for -1). A span is scored by its forward start and end
+# probabilities times its backward start and end probabilities. For
+# log-probability distributions, the scores are summed instead.
+# distributions => (forward/backward,start/end,batch,values). Phew!
+def get_best_spans(distributions, paras_lens_in, max_answer_span,
+                   log_space=False):
+  batch_size, max_len = distributions[0][0].shape
+  rows = np.arange(batch_size)[:, None]
+  positions = np.arange(max_len)[None, :]
+  passage_lens = np.array(paras_lens_in)[:, None]
+
+  # For every start j, pick the end in its window with the highest end score.
+  # windows.shape = (batch, start, window)
+  span = max_len if max_answer_span == -1 else max_answer_span
+  combine = np.add if log_space else np.multiply
+  end_scores = combine(distributions[0][1], distributions[1][0])
+  padded_end_scores = np.full((batch_size, max_len + span), -np.inf,
+                              dtype=end_scores.dtype)
+  padded_end_scores[:, :max_len] = end_scores
+  if max_answer_span == -1:
+    padded_end_scores[np.arange(max_len + span)[None, :] >= passage_lens] = -np.inf
+  windows = padded_end_scores[:, np.arange(max_len)[:, None] + \
+                                 np.arange(span)[None, :]]
+  ends = positions + np.argmax(windows, axis=2)
+
+  # Score the best span for every start, and pick the best start. Scores are
+  # combined in the same order as the per-span loop did, so that rounding
+  # (and so the pick among near-ties) is the same.
+  scores = combine(combine(combine(distributions[0][1][rows, ends],
+                                   distributions[0][0]),
+                           distributions[1][1]),
+                   distributions[1][0][rows, ends])
+  scores[positions >= passage_lens] = -np.inf
+  starts = np.argmax(scores, axis=1)
+  return [ [start, ends[idx, start]] for idx, start in enumerate(starts) ]
+
+
 def get_batch_answers(args, batch, all_predictions, distributions, data):
   # Get numpy arrays out of the CUDA tensors.
   for j in range(len(distributions)):
@@ -304,23 +429,12 @@ def get_batch_answers(args, batch, all_predictions, distributions, data):
                  for example in batch ]
   paras_lens_in = [ len(para) for para in paras_in ]
 
-  best_idxs = []
-  # distributions => (forward/backward,start/end,batch,values). Phew!
-  for idx in range(len(batch)):
-    best_prob = -1
-    best = [0, 0]
-    max_end = paras_lens_in[idx]
-    for j, start_prob in enumerate(distributions[0][0][idx][:max_end]):
-      cur_end_idx = max_end if args.max_answer_span == -1 \
-                            else j + args.max_answer_span
-      end_idx = np.argmax(distributions[0][1][idx][j:cur_end_idx] * \
-                          distributions[1][0][idx][j:cur_end_idx])
-      prob = distributions[0][1][idx][j+end_idx] * start_prob * \
-             distributions[1][1][idx][j] * distributions[1][0][idx][j+end_idx]
-      if prob > best_prob:
-        best_prob = prob
-        best = [j, j+end_idx]
-    best_idxs.append(best)
+  if args.debug_level >= 3:
+    start_decode = time.time()
+  best_idxs = get_best_spans(distributions, paras_lens_in, args.max_answer_span,
+                             args.log_space)
+  if args.debug_level >= 3:
+    print "Decoding time: %.2fms" % (1000 * (time.time() - start_decode))
 
   answers = [ tokenized_paras[ques_to_para[qids[idx]]][start:end+1] \
                 for idx, (start, end) in enumerate(best_idxs) ]
@@ -334,11 +448,20 @@ def get_batch_answers(args, batch, all_predictions, distributions, data):
 #------------------------------------------------------------------------------#
 
 
+#------------ Print average time per step spent on data vs compute ------------#
+def print_step_times(batches, start_t):
+  total_time = time.time() - start_t
+  print "Time per step: %.1f ms waiting for data, %.1f ms compute." % \
+        (1000.0 * batches.wait_time / len(batches),
+         1000.0 * (total_time - batches.wait_time) / len(batches))
+#------------------------------------------------------------------------------#
+
+
 def train_model(args):
   # Read and process data
   train, dev, test, batch_size, test_batch_size, train_ques_to_para,\
   dev_ques_to_para, test_ques_to_para, train_tokenized_paras,\
-  dev_tokenized_paras, test_tokenized_paras, train_order, dev_order, test_order,\
+  dev_tokenized_paras, test_tokenized_paras, train_sampler, dev_sampler, test_sampler,\
   train_data, dev_data, test_data = read_and_process_data(args)
 
   # Build model
@@ -367,6 +490,10 @@ def train_model(args):
     model = model.load_from_file(args.model_file)
     print "Loaded model from %s." % args.model_file
 
+  # Execution options that aren't stored with the model.
+  model.fuse_directions = args.fuse_directions
+  model.log_space = args.log_space
+
   start_time = time.time()
   print "Starting training."
 
@@ -394,23 +521,29 @@ def train_model(args):
     start_t = time.time()
     train_loss_sum = 0.0
     model.set_train()
-    for i, num in enumerate(train_order):
+    train_order = train_sampler.get_batches()
+    print "Padding efficiency: %.2f%%" % (100.0 * train_sampler.padding_efficiency)
+    # Create batches by getting lengths and padding, ahead of the model.
+    train_batches = BatchPrefetcher(
+      [ [ train[idx] for idx in batch ] for batch in train_order ],
+      lambda batch: get_batch(batch, train_ques_to_para, train_tokenized_paras,
+                              train_data.paras_pos_tags, train_data.paras_ner_tags,
+                              train_data.question_pos_tags,
+                              train_data.question_ner_tags,
+                              num_pos_tags, num_ner_tags, args.index_tags,
+                              args.share_passage_encoding),
+      args.num_batch_workers, args.prefetch_depth)
+    for i, (train_batch, batch_input) in enumerate(train_batches):
       print "\r[%.2f%%] Train epoch %d, %.2f s - (Done %d of %d)" %\
             ((100.0 * (i+1))/len(train_order), EPOCH,
              (time.time()-start_t)*(len(train_order)-i-1)/(i+1), i+1,
              len(train_order)),
 
-      # Create next batch by getting lengths and padding
-      train_batch = train[num:num+batch_size]
-
       # Zero previous gradient.
       model.zero_grad()
 
       # Predict on the network_id assigned to this minibatch.
-      model(*get_batch(train_batch, train_ques_to_para, train_tokenized_paras,
-                       train_data.paras_pos_tags, train_data.paras_ner_tags,
-                       train_data.question_pos_tags, train_data.question_ner_tags,
-                       num_pos_tags, num_ner_tags))
+      model(*batch_input)
       model.loss.backward()
       optimizer.step()
       train_loss_sum += model.loss.data[0]
@@ -426,9 +559,9 @@ def train_model(args):
 
     print "\nLoss: %.5f (in time %.2fs)" % \
           (train_loss_sum/len(train_order), time.time() - start_t)
+    print_step_times(train_batches, start_t)
 
     # End of epoch.
-    random.shuffle(train_order)
     model.zero_grad()
     model.save(args.model_dir, EPOCH)
 
@@ -446,20 +579,23 @@ def train_model(args):
     print "\nRunning on Dev."
 
     model.set_eval()
-    for i, num in enumerate(dev_order):
+    dev_order = dev_sampler.get_batches()
+    dev_batches = BatchPrefetcher(
+      [ [ dev[idx] for idx in batch ] for batch in dev_order ],
+      lambda batch: get_batch(batch, dev_ques_to_para, dev_tokenized_paras,
+                              dev_data.paras_pos_tags, dev_data.paras_ner_tags,
+                              dev_data.question_pos_tags, dev_data.question_ner_tags,
+                              num_pos_tags, num_ner_tags, args.index_tags,
+                              args.share_passage_encoding),
+      args.num_batch_workers, args.prefetch_depth)
+    for i, (dev_batch, batch_input) in enumerate(dev_batches):
       print "\rDev: %.2f s (Done %d of %d)" %\
             ((time.time()-dev_start_t)*(len(dev_order)-i-1)/(i+1), i+1,
             len(dev_order)),
 
-      dev_batch = dev[num:num+test_batch_size]
-
       # distributions[{0,1}][{0,1}].shape = (batch, max_passage_len)
       # Predict using both networks.
-      distributions = \
-        model(*get_batch(dev_batch, dev_ques_to_para, dev_tokenized_paras,
-                         dev_data.paras_pos_tags, dev_data.paras_ner_tags,
-                         dev_data.question_pos_tags, dev_data.question_ner_tags,
-                         num_pos_tags, num_ner_tags))
+      distributions = model(*batch_input)
 
       # Add predictions to all answers.
       get_batch_answers(args, dev_batch, all_predictions, distributions,
@@ -473,6 +609,7 @@ def train_model(args):
     # Print dev stats for epoch
     print "\nDev Loss: %.4f (in time: %.2f s)" %\
           (dev_loss_sum/len(dev_order), (time.time() - dev_start_t))
+    print_step_times(dev_batches, dev_start_t)
 
     # Dump the results json in the required format
     print "Dumping prediction results."
@@ -502,7 +639,7 @@ def test_model(args):
   # Read and process data
   train, dev, test, batch_size, test_batch_size, train_ques_to_para,\
   dev_ques_to_para, test_ques_to_para, train_tokenized_paras,\
-  dev_tokenized_paras, test_tokenized_paras, train_order, dev_order, test_order,\
+  dev_tokenized_paras, test_tokenized_paras, train_sampler, dev_sampler, test_sampler,\
   train_data, dev_data, test_data = read_and_process_data(args)
 
   # Build model
@@ -527,6 +664,10 @@ def test_model(args):
     if not args.disable_pretrained:
       print "Embedding shape:", model.embedding.shape
 
+  # Execution options that aren't stored with the model.
+  model.fuse_directions = args.fuse_directions
+  model.log_space = args.log_space
+
   test_start_t = time.time()
   test_loss_sum = 0.0
   all_predictions = {}
@@ -534,25 +675,32 @@ def test_model(args):
   attention_ends = {}
   model.set_eval()
 
-  for i, num in enumerate(test_order):
+  test_order = test_sampler.get_batches()
+  test_batches = BatchPrefetcher(
+    [ [ test[idx] for idx in batch ] for batch in test_order ],
+    lambda batch: get_batch(batch, test_ques_to_para, test_tokenized_paras,
+                            test_data.paras_pos_tags, test_data.paras_ner_tags,
+                            test_data.question_pos_tags, test_data.question_ner_tags,
+                            num_pos_tags, num_ner_tags, args.index_tags,
+                            args.share_passage_encoding),
+    args.num_batch_workers, args.prefetch_depth)
+  for i, (test_batch, batch_input) in enumerate(test_batches):
     print "\rTest: %.2f s (Done %d of %d) " %\
           ((time.time()-test_start_t)*(len(test_order)-i-1)/(i+1), i+1,
           len(test_order)),
 
-    test_batch = test[num:num+test_batch_size]
     batch_size = len(test_batch)
 
     # distributions[{0,1}].shape = (batch, max_passage_len)
-    distributions = \
-        model(*get_batch(test_batch, test_ques_to_para, test_tokenized_paras,
-                         test_data.paras_pos_tags, test_data.paras_ner_tags,
-                         test_data.question_pos_tags, test_data.question_ner_tags,
-                         num_pos_tags, num_ner_tags))
+    distributions = model(*batch_input)
 
     # Add predictions to all answers.
     get_batch_answers(args, test_batch, all_predictions, distributions, test_data)
 
-    # Dump start and end attention distributions from "0" id network.
+    # Dump start and end attention distributions from "0" id network, as
+    # probabilities.
+    if args.log_space:
+      distributions[0] = [ np.exp(d) for d in distributions[0] ]
     ans_in = np.array([ example[1] for example in test_batch ]).T
     qids = [ example[2] for example in test_batch ]
     for idx in range(batch_size):
@@ -573,6 +721,7 @@ def test_model(args):
   # Print stats
   print "\nTest Loss: %.4f (in time: %.2f s)" %\
         (test_loss_sum/len(test_order), (time.time() - test_start_t))
+  print_step_times(test_batches, test_start_t)
 
   # Dump the results json in the required format
   print "Dumping prediction results."
@@ -1,10 +1,18 @@
+import math
 import numpy as np
+import os
 import sys
 import time
 import torch
 import torch.nn as nn
 import torch.nn.functional as f
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, 'common'))
+from Directions import reverse, stack_directions
+from Embeddings import init_unknown_embeddings
+from F1 import f1_partial_matrix
+from Vectors import read_vectors
 from torch.autograd import Variable
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 
@@ -26,6 +34,13 @@ class qNet(nn.Module):
     # Volatile variables for inference. If true, computation graph isn't built.
     self.volatile = False
 
+    # Run the forward and backward Match-LSTM directions as one batch.
+    self.fuse_directions = False
+
+    # Compute answer pointer distributions, the loss and span scores with
+    # log-probabilities instead of probabilities.
+    self.log_space = False
+
   # Load configuration options
   def load_from_config(self, config):
     self.embed_size = config['embed_size']
@@ -34,6 +49,7 @@ class qNet(nn.Module):
     self.attention_size = config['attention_size']
     self.lr_rate = config['lr']
     self.vectors_path = config['vectors_path']
+    self.unknown_embedding_init = config['unknown_embedding_init']
     self.optimizer = config['optimizer']
     self.index_to_word = config['index_to_word']
     self.word_to_index = config['word_to_index']
@@ -53,38 +69,28 @@ class qNet(nn.Module):
     # Embedding look-up.
     self.oov_count = 0
     self.oov_list = []
-    known_idxs, unknown_idxs = [], []
     if self.use_pretrained and debug_level <= 1:
-      # Read embeddings from file.
-      embeddings = np.zeros((self.vocab_size, self.embed_size))
-      with open(self.vectors_path) as f:
-        for line in f:
-          word = line[:line.index(" ")]
-          if not word in self.word_to_index:
-            continue
-          line = line.split()
-          embeddings[self.word_to_index[line[0]]] = np.array(map(float,line[1:]))
-      for i, embedding in enumerate(embeddings):
-        if sum(embedding) == 0:
-          self.oov_count += 1
-          self.oov_list.append(self.index_to_word[i])
-          unknown_idxs.append(i)
-        else:
-          known_idxs.append(i)
+      # Read embeddings from file, with a mask of the words found there.
+      embeddings, found = read_vectors(self.vectors_path, self.word_to_index,
+                                       self.vocab_size, self.embed_size)
+      unknown_idxs = np.flatnonzero(~found)
+      self.oov_count = len(unknown_idxs)
+      self.oov_list = [ self.index_to_word[i] for i in unknown_idxs ]
 
       # Initialize unknown word embeddings by sampling from multivariate normal distribution,
       # with mean and covariance as sample mean and covariance of known embeddings.
-      known_embeddings = embeddings[known_idxs]
       np_rng = np.random.RandomState(123)
-      known_mean = np.mean(known_embeddings, axis=0)
-      known_covar = np.cov(known_embeddings, rowvar=0)
-      unknown_embeddings = np_rng.multivariate_normal(mean=known_mean, cov=known_covar,
-                                                      size=len(unknown_idxs)).astype(np.float32)
-      embeddings[unknown_idxs] = unknown_embeddings
-      self.embedding = embeddings
+      known_words = [ self.index_to_word[i] for i in np.flatnonzero(found) ]
+      init_unknown_embeddings(embeddings, found, self.unknown_embedding_init,
+                              np_rng, self.vectors_path, known_words)
+      # Fixed embeddings are a float32 buffer, looked up on the tensor side
+      # and moved along with the model.
+      self.register_buffer('embedding',
+                           torch.from_numpy(embeddings.astype(np.float32)))
     elif debug_level >= 2:
       # Initialize all embeddings with zero for debugging.
-      self.embedding = np.zeros((self.vocab_size, self.embed_size))
+      self.register_buffer('embedding',
+                           torch.zeros(self.vocab_size, self.embed_size))
     else:
       # Create trainable embeddings layer.
       self.embedding = nn.Embedding(self.vocab_size, self.embed_size,
@@ -175,6 +181,7 @@ class qNet(nn.Module):
 
   def load(self, path, epoch):
     self = torch.load(path + "/epoch_" + str(epoch) + ".pt")
+    self.convert_embedding()
     return self
 
   def set_train(self):
@@ -193,8 +200,20 @@ class qNet(nn.Module):
 
   def load_from_file(self, path):
     self = torch.load(path)
+    self.convert_embedding()
     return self
 
+  # Models saved before fixed embeddings were a buffer hold them as a float64
+  # numpy array. Convert those to the buffer.
+  def convert_embedding(self):
+    if isinstance(self.embedding, np.ndarray):
+      embedding = self.embedding
+      del self.embedding
+      embedding = torch.from_numpy(embedding.astype(np.float32))
+      if self.use_cuda:
+        embedding = embedding.cuda()
+      self.register_buffer('embedding', embedding)
+
   def variable(self, v):
     if self.use_cuda:
       return Variable(v, requires_grad = False, volatile = self.volatile).cuda()
@@ -230,35 +249,60 @@ class qNet(nn.Module):
   # inp.shape = (seq_len, batch)
   # output.shape = (seq_len, batch, embed_size)
   def get_vector_embeddings(self, inp):
-    return self.placeholder(self.embedding[inp])
-
-  # Detach input of (seq_len, batch, ...) for the given indices,
-  # and fill it with the specified value.
-  def detach3d(self, vals, mask_idxs, fill_val):
-    if len(mask_idxs[0]) == 0:
-      return vals
-    vals = vals.clone()
-    vals[mask_idxs[0], mask_idxs[1], :] = \
-      vals[mask_idxs[0], mask_idxs[1], :].detach().fill_(fill_val)
-    return vals
-
-  # Detach input of (batch, ...) for the given input, for the given
-  # indices, and fill it with the specified value.
-  def detach2d(self, vals, mask_t, fill_val):
-    if len(mask_t) == 0:
-      return vals
-    vals = vals.clone()
-    vals[mask_t, :] = vals[mask_t, :].detach().fill_(fill_val)
-    return vals
-
-  # Softmax over unmasked idxs for each item in the batch, and pad the rest
-  # with zeros. Softmax is done along dimension 0.
+    idxs = torch.from_numpy(inp.astype(np.int64)).view(-1)
+    if self.use_cuda:
+      idxs = idxs.cuda()
+    embedded = torch.index_select(self.embedding, 0, idxs)
+    return self.variable(embedded.view(inp.shape[0], inp.shape[1], -1))
+
+  # One-hot encode tag indices, with padding (-1) encoded as all zeros.
+  # tags.shape = (seq_len, batch)
+  # output.shape = (seq_len, batch, num_tags)
+  def get_one_hot_tags(self, tags, num_tags):
+    tensor = torch.cuda.FloatTensor if self.use_cuda else torch.FloatTensor
+    idxs = torch.from_numpy(tags + 1).unsqueeze(-1)
+    if self.use_cuda:
+      idxs = idxs.cuda()
+    one_hot = tensor(tags.shape[0], tags.shape[1], num_tags + 1).zero_()
+    one_hot.scatter_(2, idxs, 1)
+    return Variable(one_hot[:, :, 1:], requires_grad = False,
+                    volatile = self.volatile)
+
+  # Fill the masked positions of the input with the specified value. The mask
+  # is broadcast over the last dimension.
+  # vals.shape = (..., dim), mask.shape = (..., 1)
+  def fill_masked(self, vals, mask, fill_val):
+    return vals.masked_fill(mask.expand_as(vals), fill_val)
+
+  # Softmax over unmasked positions for each item in the batch, with the
+  # masked positions set to zero. Softmax is done along dimension 0.
+  # vals.shape = mask.shape = (seq_len, batch, 1)
+  # Returned tensor shape = (seq_len, batch, 1)
+  def padded_softmax(self, vals, mask):
+    # exp(-inf) = 0, so masked positions come out as zeros.
+    return f.softmax(self.fill_masked(vals, mask, -float('inf')), dim=0)
+
+  # Log-softmax over unmasked positions, with the masked positions set to
+  # -inf. Log-softmax is done along dimension 0.
+  # vals.shape = mask.shape = (seq_len, batch, 1)
   # Returned tensor shape = (seq_len, batch, 1)
-  def padded_softmax(self, vals, mask_idxs):
-    vals = self.detach3d(vals, mask_idxs, -float('inf'))
-    softmaxed = f.softmax(vals, dim=0)
-    softmaxed = self.detach3d(softmaxed, mask_idxs, 0.0)
-    return softmaxed
+  def padded_log_softmax(self, vals, mask):
+    return f.log_softmax(self.fill_masked(vals, mask, -float('inf')), dim=0)
+
+  # Elementwise log(exp(a) + exp(b)), without over or underflowing.
+  def log_sum_exp(self, a, b):
+    max_ab = torch.max(a, b)
+    return max_ab + torch.log(torch.exp(a - max_ab) + torch.exp(b - max_ab))
+
+  # log(sum(exp(vals))) along the second dimension, without over or
+  # underflowing. Rows that are all -inf give -inf.
+  # vals.shape = (batch, n)
+  # Returned tensor shape = (batch)
+  def log_sum_exp_rows(self, vals):
+    max_vals = torch.max(vals, 1, keepdim=True)[0]
+    max_vals = max_vals.masked_fill(max_vals == -float('inf'), 0.0)
+    return (max_vals + \
+            torch.log(torch.exp(vals - max_vals).sum(1, keepdim=True))).squeeze(1)
 
   # Get final layer hidden states of the provided LSTM run over the given
   # input sequence.
@@ -276,10 +320,41 @@ class qNet(nn.Module):
                            self.variable(torch.arange(idxs.size()[0])).long())
     return torch.index_select(H, 1, unsorted_idxs)
 
+  # One step of a Match-LSTM, attending over a memory given the previous
+  # hidden state. Directions can be stacked along the batch dimension.
+  # attended_memory.shape = (mem_len, batch, hdim)
+  # attended_input.shape = (batch, hdim), or None
+  # transposed_memory.shape = (batch, mem_len, hdim)
+  # inputs.shape = (batch, hdim)
+  # {h,c}.shape = (batch, hdim / 2)
+  def match_lstm_step(self, attended_memory, attended_input, transposed_memory,
+                      inputs, h, c, attend_hidden, alpha_transform, match_lstm):
+    # g.shape = (mem_len, batch, hdim)
+    if attended_input is not None:
+      attended_memory = attended_memory + attended_input
+    g = f.tanh(attended_memory + attend_hidden(h))
+
+    # alpha.shape = (mem_len, batch, 1)
+    # Masking unnecessary here, as the values are already zero.
+    alpha = f.softmax(alpha_transform(g), dim=0)
+
+    # weighted_memory.shape = (batch, hdim)
+    weighted_memory = torch.squeeze(torch.bmm(alpha.permute(1, 2, 0),
+                                              transposed_memory), dim=1)
+
+    # z.shape = (batch, 2 * hdim)
+    z = torch.cat((inputs, weighted_memory), dim=-1)
+
+    # Take an LSTM step, with z as input.
+    return match_lstm(z, (h, c))
+
   # Get a question-aware passage representation.
   def match_question_passage(self, layer_no, Hpi, Hq, max_passage_len,
-                             batch_size, mask_p_idxs, mask_p_ts, mask_q_idxs,
-                             mask_q_ts):
+                             batch_size, mask_p, mask_q, keep_p):
+    attend_passage_hidden = getattr(self, 'attend_passage_hidden_' + layer_no)
+    passage_alpha_transform = getattr(self, 'passage_alpha_transform_' + layer_no)
+    passage_match_lstm = getattr(self, 'passage_match_lstm_' + layer_no)
+
     # Initial hidden and cell states for forward and backward LSTMs.
     # {h,c}{f,b}.shape = (batch, hdim / 2)
     hf, cf = self.get_initial_lstm(batch_size, self.hidden_size // 2)
@@ -287,54 +362,71 @@ class qNet(nn.Module):
 
     # Get vectors zi for each i in passage.
     # Attended question is the same at each time step. Just compute it once.
+    # The attended passage at each time step is added to it inside the loop.
     # attended_{question,passage}.shape = (seq_len, batch, hdim)
     attended_question = getattr(self, 'attend_question_for_passage_' + layer_no)(Hq)
     attended_passage = getattr(self, 'attend_passage_for_passage_' + layer_no)(Hpi)
-    attended_question = self.detach3d(attended_question, mask_q_idxs, 0.0)
-    attended_passage = self.detach3d(attended_passage, mask_p_idxs, 0.0)
-    attention_q_plus_p = []
-    for t in range(max_passage_len):
-      attention_q_plus_p.append(attended_question + attended_passage[t])
+    attended_question = self.fill_masked(attended_question, mask_q, 0.0)
+    attended_passage = self.fill_masked(attended_passage, mask_p, 0.0)
     transposed_Hq = torch.transpose(Hq, 0, 1)
+    min_passage_len = self.get_min_len(mask_p)
+
+    if self.fuse_directions:
+      # Run both directions as one batch, with the backward direction reading
+      # the passage in reverse.
+      # attended_question.shape = (seq_len, 2 * batch, hdim)
+      # {attended_passage,Hpi,keep_p}.shape = (seq_len, 2 * batch, ...)
+      # {h,c}.shape = (2 * batch, hdim / 2)
+      attended_question = torch.cat((attended_question, attended_question), dim=1)
+      transposed_Hq = torch.cat((transposed_Hq, transposed_Hq), dim=0)
+      attended_passage = stack_directions(attended_passage)
+      Hpi = stack_directions(Hpi)
+      keep_p = stack_directions(keep_p)
+      h = torch.cat((hf, hb), dim=0)
+      c = torch.cat((cf, cb), dim=0)
+      H = []
+      for i in range(max_passage_len):
+        h, c = self.match_lstm_step(attended_question, attended_passage[i],
+                                    transposed_Hq, Hpi[i], h, c,
+                                    attend_passage_hidden,
+                                    passage_alpha_transform, passage_match_lstm)
+        # Back to initial zero states for padded regions.
+        if max(i, max_passage_len-i-1) >= min_passage_len:
+          h = h * keep_p[i]
+          c = c * keep_p[i]
+        H.append(h)
+
+      # H.shape = (seq_len, 2 * batch, hdim / 2)
+      # H{f,b}.shape = (seq_len, batch, hdim / 2)
+      H = torch.stack(H, dim=0)
+      Hf = H[:, :batch_size]
+      Hb = reverse(H[:, batch_size:])
+      return torch.cat((Hf, Hb), dim=-1)
+
     Hf, Hb = [], []
     for i in range(max_passage_len):
       forward_idx = i
       backward_idx = max_passage_len-i-1
-      # g{f,b}.shape = (seq_len, batch, hdim)
-      gf = f.tanh(attention_q_plus_p[forward_idx] + \
-               getattr(self, 'attend_passage_hidden_' + layer_no)(hf))
-      gb = f.tanh(attention_q_plus_p[backward_idx] + \
-               getattr(self, 'attend_passage_hidden_' + layer_no)(hb))
-
-      # alpha_{f,g}.shape = (seq_len, batch, 1)
-      alpha_f = getattr(self, 'passage_alpha_transform_' + layer_no)(gf)
-      alpha_b = getattr(self, 'passage_alpha_transform_' + layer_no)(gb)
-
-      # Masking unnecessary here, as the values are already zero.
-      alpha_f = f.softmax(alpha_f, dim=0)
-      alpha_b = f.softmax(alpha_b, dim=0)
-
-      # Hp[{forward,backward}_idx].shape = (batch, hdim)
-      # Hq = (seq_len, batch, hdim)
-      # weighted_Hq_f.shape = (batch, hdim)
-      weighted_Hq_f = torch.squeeze(torch.bmm(alpha_f.permute(1, 2, 0),
-                                    transposed_Hq), dim=1)
-      weighted_Hq_b = torch.squeeze(torch.bmm(alpha_b.permute(1, 2, 0),
-                                    transposed_Hq), dim=1)
-
-      # z{f,b}.shape = (batch, 2 * hdim)
-      zf = torch.cat((Hpi[forward_idx], weighted_Hq_f), dim=-1)
-      zb = torch.cat((Hpi[backward_idx], weighted_Hq_b), dim=-1)
-
-      # Take forward and backward LSTM steps, with zf and zb as inputs.
-      hf, cf = getattr(self, 'passage_match_lstm_' + layer_no)(zf, (hf, cf))
-      hb, cb = getattr(self, 'passage_match_lstm_' + layer_no)(zb, (hb, cb))
-
-      # Back to initial zero states for padded regions.
-      hf = self.detach2d(hf, mask_p_ts[forward_idx], 0.0)
-      hb = self.detach2d(hb, mask_p_ts[backward_idx], 0.0)
-      cf = self.detach2d(cf, mask_p_ts[forward_idx], 0.0)
-      cb = self.detach2d(cb, mask_p_ts[backward_idx], 0.0)
+      # Take forward and backward LSTM steps.
+      hf, cf = self.match_lstm_step(attended_question,
+                                    attended_passage[forward_idx],
+                                    transposed_Hq, Hpi[forward_idx], hf, cf,
+                                    attend_passage_hidden,
+                                    passage_alpha_transform, passage_match_lstm)
+      hb, cb = self.match_lstm_step(attended_question,
+                                    attended_passage[backward_idx],
+                                    transposed_Hq, Hpi[backward_idx], hb, cb,
+                                    attend_passage_hidden,
+                                    passage_alpha_transform, passage_match_lstm)
+
+      # Back to initial zero states for padded regions. Steps within the
+      # shortest passage have nothing to reset.
+      if forward_idx >= min_passage_len:
+        hf = hf * keep_p[forward_idx]
+        cf = cf * keep_p[forward_idx]
+      if backward_idx >= min_passage_len:
+        hb = hb * keep_p[backward_idx]
+        cb = cb * keep_p[backward_idx]
 
       # Append hidden states to create Hf and Hb matrices.
       # h{f,b}.shape = (batch, hdim / 2)
@@ -352,7 +444,11 @@ class qNet(nn.Module):
 
   # Get a self-aware (question-aware) passage representation.
   def match_passage_passage(self, layer_no, Hr, max_passage_len, batch_size,
-                            mask_p_idxs, mask_p_ts):
+                            mask_p, keep_p):
+    attend_self_hidden = getattr(self, 'attend_self_hidden_' + layer_no)
+    self_alpha_transform = getattr(self, 'self_alpha_transform_' + layer_no)
+    self_match_lstm = getattr(self, 'self_match_lstm_' + layer_no)
+
     # Initial hidden and cell states for forward and backward LSTMs.
     # {h,c}{f,b}.shape = (batch, hdim / 2)
     hf, cf = self.get_initial_lstm(batch_size, self.hidden_size // 2)
@@ -362,46 +458,60 @@ class qNet(nn.Module):
     # Attended passage is the same at each time step. Just compute it once.
     # attended_passage.shape = (seq_len, batch, hdim)
     attended_passage = getattr(self, 'attend_self_passage_' + layer_no)(Hr)
-    attended_passage = self.detach3d(attended_passage, mask_p_idxs, 0.0)
+    attended_passage = self.fill_masked(attended_passage, mask_p, 0.0)
     transposed_Hr = torch.transpose(Hr, 0, 1)
+    min_passage_len = self.get_min_len(mask_p)
+
+    if self.fuse_directions:
+      # Run both directions as one batch, with the backward direction reading
+      # the passage in reverse. Both attend over the whole passage.
+      # attended_passage.shape = (seq_len, 2 * batch, hdim)
+      # {Hr,keep_p}.shape = (seq_len, 2 * batch, ...)
+      # {h,c}.shape = (2 * batch, hdim / 2)
+      attended_passage = torch.cat((attended_passage, attended_passage), dim=1)
+      transposed_Hr = torch.cat((transposed_Hr, transposed_Hr), dim=0)
+      Hr = stack_directions(Hr)
+      keep_p = stack_directions(keep_p)
+      h = torch.cat((hf, hb), dim=0)
+      c = torch.cat((cf, cb), dim=0)
+      H = []
+      for i in range(max_passage_len):
+        h, c = self.match_lstm_step(attended_passage, None, transposed_Hr,
+                                    Hr[i], h, c, attend_self_hidden,
+                                    self_alpha_transform, self_match_lstm)
+        # Back to initial zero states for padded regions.
+        if max(i, max_passage_len-i-1) >= min_passage_len:
+          h = h * keep_p[i]
+          c = c * keep_p[i]
+        H.append(h)
+
+      # H.shape = (seq_len, 2 * batch, hdim / 2)
+      # H{f,b}.shape = (seq_len, batch, hdim / 2)
+      H = torch.stack(H, dim=0)
+      Hf = H[:, :batch_size]
+      Hb = reverse(H[:, batch_size:])
+      return torch.cat((Hf, Hb), dim=-1)
+
     Hf, Hb = [], []
     for i in range(max_passage_len):
       forward_idx = i
       backward_idx = max_passage_len-i-1
-      # g{f,b}.shape = (seq_len, batch, hdim)
-      gf = f.tanh(attended_passage + \
-               getattr(self, 'attend_self_hidden_' + layer_no)(hf))
-      gb = f.tanh(attended_passage + \
-               getattr(self, 'attend_self_hidden_' + layer_no)(hb))
-
-      # alpha_{f,g}.shape = (seq_len, batch, 1)
-      alpha_f = getattr(self, 'self_alpha_transform_' + layer_no)(gf)
-      alpha_b = getattr(self, 'self_alpha_transform_' + layer_no)(gb)
-
-      # Masking unnecessary here, as the values are already zero.
-      alpha_f = f.softmax(alpha_f, dim=0)
-      alpha_b = f.softmax(alpha_b, dim=0)
-
-      # Hr[{forward,backward}_idx].shape = (batch, hdim)
-      # weighted_Hr_{f,b}.shape = (batch, hdim)
-      weighted_Hr_f = torch.squeeze(torch.bmm(alpha_f.permute(1, 2, 0),
-                                    transposed_Hr), dim=1)
-      weighted_Hr_b = torch.squeeze(torch.bmm(alpha_b.permute(1, 2, 0),
-                                    transposed_Hr), dim=1)
-
-      # z{f,b}.shape = (batch, 2 * hdim)
-      zf = torch.cat((Hr[forward_idx], weighted_Hr_f), dim=-1)
-      zb = torch.cat((Hr[backward_idx], weighted_Hr_b), dim=-1)
-
-      # Take forward and backward LSTM steps, with zf and zb as inputs.
-      hf, cf = getattr(self, 'self_match_lstm_' + layer_no)(zf, (hf, cf))
-      hb, cb = getattr(self, 'self_match_lstm_' + layer_no)(zb, (hb, cb))
-
-      # Back to initial zero states for padded regions.
-      hf = self.detach2d(hf, mask_p_ts[forward_idx], 0.0)
-      hb = self.detach2d(hb, mask_p_ts[backward_idx], 0.0)
-      cf = self.detach2d(cf, mask_p_ts[forward_idx], 0.0)
-      cb = self.detach2d(cb, mask_p_ts[backward_idx], 0.0)
+      # Take forward and backward LSTM steps.
+      hf, cf = self.match_lstm_step(attended_passage, None, transposed_Hr,
+                                    Hr[forward_idx], hf, cf, attend_self_hidden,
+                                    self_alpha_transform, self_match_lstm)
+      hb, cb = self.match_lstm_step(attended_passage, None, transposed_Hr,
+                                    Hr[backward_idx], hb, cb, attend_self_hidden,
+                                    self_alpha_transform, self_match_lstm)
+
+      # Back to initial zero states for padded regions. Steps within the
+      # shortest passage have nothing to reset.
+      if forward_idx >= min_passage_len:
+        hf = hf * keep_p[forward_idx]
+        cf = cf * keep_p[forward_idx]
+      if backward_idx >= min_passage_len:
+        hb = hb * keep_p[backward_idx]
+        cb = cb * keep_p[backward_idx]
 
       # Append hidden states to create Hf and Hb matrices.
       # h{f,b}.shape = (batch, hdim / 2)
@@ -420,17 +530,21 @@ class qNet(nn.Module):
   # Boundary pointer model, that gives probability distributions over the
   # start and end indices. Returns the hidden states, as well as the predicted
   # distributions.
-  def answer_pointer(self, Hr, Hp, Hq, mask_p_idxs, mask_p_ts, mask_q_idxs,
-                     mask_q_ts, batch_size):
+  def answer_pointer(self, Hr, Hp, Hq, mask_p, mask_q, batch_size):
+    attend_answer = self.attend_answer
+    beta_transform = self.beta_transform
+    answer_pointer_lstm = self.answer_pointer_lstm
+
     # attended_input.shape = (seq_len, batch, hdim)
-    attended_input = getattr(self, 'attend_input')(Hr)
-    attended_input_b = getattr(self, 'attend_input_b')(Hr)
-    attended_input = self.detach3d(attended_input, mask_p_idxs, 0.0)
-    attended_input_b = self.detach3d(attended_input_b, mask_p_idxs, 0.0)
+    attended_input = self.attend_input(Hr)
+    attended_input_b = self.attend_input_b(Hr)
+    attended_input = self.fill_masked(attended_input, mask_p, 0.0)
+    attended_input_b = self.fill_masked(attended_input_b, mask_p, 0.0)
+    transposed_Hr = torch.transpose(Hr, 0, 1)
 
     # weighted_Hq.shape = (batch, hdim)
-    attended_question = f.tanh(getattr(self, 'attend_question')(Hq))
-    alpha_q = getattr(self, 'alpha_transform')(attended_question)
+    attended_question = f.tanh(self.attend_question(Hq))
+    alpha_q = self.alpha_transform(attended_question)
     # Padding unnecessary, as to-be masked regions are already zero.
     alpha_q = f.softmax(alpha_q, dim=0)
     weighted_Hq = torch.squeeze(torch.bmm(alpha_q.permute(1, 2, 0),
@@ -451,139 +565,231 @@ class qNet(nn.Module):
     # 3rd step predicts end/start distributions in 1/2 respectively.
     for k in range(3):
       # Fk[_b].shape = (seq_len, batch, hdim)
-      Fk = f.tanh(attended_input + getattr(self, 'attend_answer')(ha))
-      Fk_b = f.tanh(attended_input_b + getattr(self, 'attend_answer')(hb))
+      Fk = f.tanh(attended_input + attend_answer(ha))
+      Fk_b = f.tanh(attended_input_b + attend_answer(hb))
 
       # Get softmaxes over only valid paragraph lengths for each element in
       # the batch.
       # beta_k[_b].shape = (seq_len, batch, 1)
-      beta_k = getattr(self, 'beta_transform')(Fk)
-      beta_k_b = getattr(self, 'beta_transform')(Fk_b)
-
-      # Mask out padded regions.
-      beta_k = self.padded_softmax(beta_k, mask_p_idxs)
-      beta_k_b = self.padded_softmax(beta_k_b, mask_p_idxs)
+      beta_k = beta_transform(Fk)
+      beta_k_b = beta_transform(Fk_b)
+
+      # Mask out padded regions. In log-space, the log-probabilities are
+      # stored, and their exponents weigh Hr.
+      if self.log_space:
+        out_k = self.padded_log_softmax(beta_k, mask_p)
+        out_k_b = self.padded_log_softmax(beta_k_b, mask_p)
+      else:
+        out_k = beta_k = self.padded_softmax(beta_k, mask_p)
+        out_k_b = beta_k_b = self.padded_softmax(beta_k_b, mask_p)
 
       # Store distributions produced at start and end prediction steps.
       if k > 0:
-        answer_distributions.append(torch.t(torch.squeeze(beta_k, dim=-1)))
-        answer_distributions_b.append(torch.t(torch.squeeze(beta_k_b, dim=-1)))
+        answer_distributions.append(torch.t(torch.squeeze(out_k, dim=-1)))
+        answer_distributions_b.append(torch.t(torch.squeeze(out_k_b, dim=-1)))
 
       # Only the first two steps of the answer pointer are useful beyond
       # this point.
       if k >= 2:
         break
 
+      if self.log_space:
+        beta_k = torch.exp(out_k)
+        beta_k_b = torch.exp(out_k_b)
+
       # weighted_Hr.shape = (batch, hdim)
       weighted_Hr = torch.squeeze(torch.bmm(beta_k.permute(1, 2, 0),
-                                            torch.transpose(Hr, 0, 1)), dim=1)
+                                            transposed_Hr), dim=1)
       weighted_Hr_b = torch.squeeze(torch.bmm(beta_k_b.permute(1, 2, 0),
-                                              torch.transpose(Hr, 0, 1)), dim=1)
+                                              transposed_Hr), dim=1)
 
       # a{f,b}.shape = (batch, 2 * hdim)
       af = torch.cat((weighted_Hr, weighted_Hq), dim=-1)
       ab = torch.cat((weighted_Hr_b, weighted_Hq), dim=-1)
 
       # LSTM step.
-      ha, ca = getattr(self, 'answer_pointer_lstm')(af, (ha, ca))
-      hb, cb = getattr(self, 'answer_pointer_lstm')(ab, (hb, cb))
+      ha, ca = answer_pointer_lstm(af, (ha, ca))
+      hb, cb = answer_pointer_lstm(ab, (hb, cb))
 
     return answer_distributions, answer_distributions_b
 
+  # Get F1 scores of all candidate (start, end) ranges against the true
+  # answer range of each example in the batch, with ranges ending beyond the
+  # passage scored zero. If there is thresholding, scores are 1 above the
+  # threshold and 0 elsewhere. Only the non-zero region of each matrix is
+  # computed, directly into the batch tensor.
+  # answer.shape = (2, batch)
+  # Returned shape = (batch, max_passage_len, max_passage_len)
+  def get_f1_matrices(self, answer, passage_lens, max_passage_len):
+    f1_matrices = torch.zeros(len(passage_lens), max_passage_len,
+                              max_passage_len)
+    for idx, passage_len in enumerate(passage_lens):
+      ans_start, ans_end = answer[0][idx], answer[1][idx]
+      partial_matrix = f1_partial_matrix(ans_start, ans_end, passage_len)
+      if self.f1_loss_threshold >= 0:
+        partial_matrix = partial_matrix > self.f1_loss_threshold
+      f1_matrices[idx, :ans_end+1, ans_start:passage_len] = \
+        torch.from_numpy(partial_matrix.astype(np.float32))
+    return self.variable(f1_matrices)
+
   # Boundary pointer model, that gives probability distributions over the
   # answer start and answer end indices. Additionally returns the loss
   # for training.
-  def point_at_answer(self, Hr, Hp, Hq, batch_size, answer, f1_matrices,
-                      mask_p_idxs, mask_p_ts, mask_q_idxs, mask_q_ts):
+  def point_at_answer(self, Hr, Hp, Hq, batch_size, answer, passage_lens,
+                      mask_p, mask_q):
     # Predict the answer start and end indices.
-    distribution = self.answer_pointer(Hr, Hp, Hq, mask_p_idxs, mask_p_ts,
-                                       mask_q_idxs, mask_q_ts, batch_size)
-
-    batch_losses = [ [] for _ in range(batch_size) ]
-    # For each example in the batch, add the negative log of answer start
-    # and end index probabilities to the MLE loss, from both forward and
-    # backward answer pointers.
-    for idx in range(batch_size):
-      batch_losses[idx].append(
-        distribution[0][0][idx, answer[0][idx]] *\
-        distribution[0][1][idx, answer[1][idx]] *\
-        distribution[1][0][idx, answer[1][idx]] *\
-        distribution[1][1][idx, answer[0][idx]])
+    distribution = self.answer_pointer(Hr, Hp, Hq, mask_p, mask_q, batch_size)
+
+    # answer_{start,end}.shape = (batch, 1)
+    answer_start = self.variable(torch.from_numpy(
+                     np.asarray(answer[0], dtype=np.int64))).unsqueeze(1)
+    answer_end = self.variable(torch.from_numpy(
+                   np.asarray(answer[1], dtype=np.int64))).unsqueeze(1)
+
+    if self.log_space:
+      loss, mle_loss, f1_loss = \
+        self.log_space_losses(distribution, answer_start, answer_end, answer,
+                              passage_lens, Hr.size()[0], batch_size)
+      return distribution, loss, mle_loss, f1_loss
+
+    # For each example in the batch, the product of answer start and end index
+    # probabilities, from both forward and backward answer pointers. Its
+    # negative log is the MLE loss.
+    # mle_probs.shape = (batch)
+    mle_probs = (torch.gather(distribution[0][0], 1, answer_start) * \
+                 torch.gather(distribution[0][1], 1, answer_end) * \
+                 torch.gather(distribution[1][0], 1, answer_end) * \
+                 torch.gather(distribution[1][1], 1, answer_start)).squeeze(1)
+    total_probs = mle_probs
     if self.f1_loss_multiplier > 0:
       # Compute the F1 distribution loss.
-      # f1_matrices.shape = (batch, max_seq_len, max_seq_len)
-      # If there is thresholding, only penalize values below that threshold.
-      if self.f1_loss_threshold >= 0:
-        f1_matrices = self.placeholder(f1_matrices > self.f1_loss_threshold,
-                                       to_float = True)
-      else:
-        f1_matrices = self.placeholder(f1_matrices)
-      loss_f1_f = (torch.bmm(torch.unsqueeze(distribution[0][0], -1),
-                             torch.unsqueeze(distribution[0][1], 1)) * \
-                   f1_matrices).view(batch_size, -1).sum(1)
-      loss_f1_b = (torch.bmm(torch.unsqueeze(distribution[1][1], -1),
-                             torch.unsqueeze(distribution[1][0], 1)) * \
-                   f1_matrices).view(batch_size, -1).sum(1)
-      for idx in range(batch_size):
-        batch_losses[idx].append(self.f1_loss_multiplier * loss_f1_f[idx] *\
-                                 loss_f1_b[idx])
-
-    loss = 0.0
-    mle_loss = 0
+      # f1_probs.shape = (batch)
+      f1_probs = self.f1_loss_multiplier * \
+                 self.get_f1_probs(distribution, answer, passage_lens,
+                                   Hr.size()[0], batch_size)
+      total_probs = mle_probs + f1_probs
+
+    loss = -torch.log(total_probs / (1 + self.f1_loss_multiplier)).sum() / batch_size
+    mle_loss = -torch.log(mle_probs / (1 + self.f1_loss_multiplier)).sum() / batch_size
     f1_loss = 0
-    for idx in range(batch_size):
-      loss += -torch.log(sum(batch_losses[idx]) / (1 + self.f1_loss_multiplier))
-      mle_loss += -torch.log(batch_losses[idx][0] / (1 + self.f1_loss_multiplier))
-      if self.f1_loss_multiplier > 0:
-        f1_loss += -torch.log(batch_losses[idx][1] / (1 + self.f1_loss_multiplier))
-    loss /= batch_size
-    mle_loss /= batch_size
-    f1_loss /= batch_size
+    if self.f1_loss_multiplier > 0:
+      f1_loss = -torch.log(f1_probs / (1 + self.f1_loss_multiplier)).sum() / batch_size
     return distribution, loss, mle_loss, f1_loss
 
-  # Get idxs to be padded for the given input, for the given maximum length,
-  # for lengths in the batch.
-  def get_mask_idxs(self, batch_size, max_len, lens):
-    mask_idxs = [[], []]
-    mask_ts = [ [] for _ in range(max_len) ]
-    for t in range(max_len):
-      for idx in range(batch_size):
-        if t >= lens[idx]:
-          mask_idxs[0].append(t)
-          mask_idxs[1].append(idx)
-          mask_ts[t].append(idx)
-    return mask_idxs, mask_ts
+  # Expected F1 of the forward and backward answer pointer spans, multiplied
+  # together. distribution holds probabilities.
+  # Returned tensor shape = (batch)
+  def get_f1_probs(self, distribution, answer, passage_lens, max_len,
+                   batch_size):
+    # f1_matrices.shape = (batch, max_seq_len, max_seq_len)
+    f1_matrices = self.get_f1_matrices(answer, passage_lens, max_len)
+    loss_f1_f = (torch.bmm(torch.unsqueeze(distribution[0][0], -1),
+                           torch.unsqueeze(distribution[0][1], 1)) * \
+                 f1_matrices).view(batch_size, -1).sum(1)
+    loss_f1_b = (torch.bmm(torch.unsqueeze(distribution[1][1], -1),
+                           torch.unsqueeze(distribution[1][0], 1)) * \
+                 f1_matrices).view(batch_size, -1).sum(1)
+    return loss_f1_f * loss_f1_b
+
+  # Log of get_f1_probs, for log-probability distributions. The log expected
+  # F1 of each pointer is a log-sum-exp over all (start, end) spans, of the
+  # span's log-probability plus its log F1, with zero F1 spans at -inf. It
+  # stays finite when the span probabilities underflow.
+  # Returned tensor shape = (batch)
+  def get_f1_log_probs(self, distribution, answer, passage_lens, max_len,
+                       batch_size):
+    # log_f1_matrices.shape = (batch, max_seq_len, max_seq_len)
+    log_f1_matrices = torch.log(self.get_f1_matrices(answer, passage_lens,
+                                                     max_len))
+    log_f1_f = self.log_sum_exp_rows(
+                 (torch.unsqueeze(distribution[0][0], -1) + \
+                  torch.unsqueeze(distribution[0][1], 1) + \
+                  log_f1_matrices).view(batch_size, -1))
+    log_f1_b = self.log_sum_exp_rows(
+                 (torch.unsqueeze(distribution[1][1], -1) + \
+                  torch.unsqueeze(distribution[1][0], 1) + \
+                  log_f1_matrices).view(batch_size, -1))
+    return log_f1_f + log_f1_b
+
+  # The losses of point_at_answer, for log-probability distributions. The
+  # MLE term is a sum of gathered log-probabilities, and the F1 term is
+  # computed in log-space too, so neither can underflow. They are combined
+  # by a log-sum-exp.
+  def log_space_losses(self, distribution, answer_start, answer_end, answer,
+                       passage_lens, max_len, batch_size):
+    log_norm = math.log(1 + self.f1_loss_multiplier)
+
+    # mle_log_probs.shape = (batch)
+    mle_log_probs = (torch.gather(distribution[0][0], 1, answer_start) + \
+                     torch.gather(distribution[0][1], 1, answer_end) + \
+                     torch.gather(distribution[1][0], 1, answer_end) + \
+                     torch.gather(distribution[1][1], 1, answer_start)).squeeze(1)
+    total_log_probs = mle_log_probs
+    if self.f1_loss_multiplier > 0:
+      # f1_log_probs.shape = (batch)
+      f1_log_probs = math.log(self.f1_loss_multiplier) + \
+                     self.get_f1_log_probs(distribution, answer, passage_lens,
+                                           max_len, batch_size)
+      total_log_probs = self.log_sum_exp(mle_log_probs, f1_log_probs)
+
+    loss = -(total_log_probs - log_norm).sum() / batch_size
+    mle_loss = -(mle_log_probs - log_norm).sum() / batch_size
+    f1_loss = 0
+    if self.f1_loss_multiplier > 0:
+      f1_loss = -(f1_log_probs - log_norm).sum() / batch_size
+    return loss, mle_loss, f1_loss
+
+  # Get a mask of the padded positions for the given maximum length, for
+  # lengths in the batch. Built once per batch, and broadcast over hidden
+  # dimensions with expand_as where needed.
+  # Returned shape = (seq_len, batch, 1), with 1 at padded positions.
+  def get_mask(self, max_len, lens):
+    mask = np.arange(max_len)[:, np.newaxis] >= np.array(lens)[np.newaxis, :]
+    return self.variable(torch.from_numpy(mask.astype(np.uint8))).unsqueeze(-1)
+
+  # Get the shortest length in the batch, from its mask.
+  def get_min_len(self, mask):
+    return mask.size()[0] - int(mask.data.long().sum(0).max())
 
   # Forward pass method.
   # passage = tuple((seq_len, batch), len_within_batch)
   # question = tuple((seq_len, batch), len_within_batch)
   # answer = tuple((2, batch))
-  # f1_matrices = (batch, seq_len, seq_len)
-  # question_pos_tags = (seq_len, batch, num_pos_tags)
-  # question_ner_tags = (seq_len, batch, num_ner_tags)
-  # passage_pos_tags = (seq_len, batch, num_pos_tags)
-  # passage_ner_tags = (seq_len, batch, num_ner_tags)
+  # question_pos_tags = (seq_len, batch, num_pos_tags) or (seq_len, batch)
+  # question_ner_tags = (seq_len, batch, num_ner_tags) or (seq_len, batch)
+  # passage_pos_tags = (seq_len, batch, num_pos_tags) or (seq_len, batch)
+  # passage_ner_tags = (seq_len, batch, num_ner_tags) or (seq_len, batch)
   # answer_sentence = ((2, batch))
-  def forward(self, passage, question, answer, f1_matrices,
-              question_pos_tags, question_ner_tags, passage_pos_tags,
-              passage_ner_tags, answer_sentence):
+  # passage_map = (batch), or None
+  # If passage_map is given, the passage inputs (and passage tags) hold each
+  # distinct passage of the batch once, and passage_map gives the passage of
+  # each example.
+  def forward(self, passage, question, answer, question_pos_tags,
+              question_ner_tags, passage_pos_tags, passage_ner_tags,
+              answer_sentence, passage_map=None):
     if not self.use_pretrained:
       padded_passage = self.placeholder(passage[0], False)
       padded_question = self.placeholder(question[0], False)
-    batch_size = passage[0].shape[1]
+    batch_size = question[0].shape[1]
+    num_passages = passage[0].shape[1]
     max_passage_len = passage[0].shape[0]
     max_question_len = question[0].shape[0]
     passage_lens = passage[1]
     question_lens = question[1]
+    if passage_map is not None:
+      passage_lens = [ passage[1][idx] for idx in passage_map ]
 
     if self.debug_level >= 3:
       start_prepare = time.time()
 
-    # Indices of values to be masked out.
-    mask_p_idxs, mask_p_ts = \
-      self.get_mask_idxs(batch_size, max_passage_len, passage_lens)
-    mask_q_idxs, mask_q_ts = \
-      self.get_mask_idxs(batch_size, max_question_len, question_lens)
+    # Masks of the padded positions, to be masked out.
+    # mask_{p,q}.shape = (seq_len, batch, 1)
+    mask_p = self.get_mask(max_passage_len, passage_lens)
+    mask_q = self.get_mask(max_question_len, question_lens)
+    # Float mask of the unpadded passage positions, to reset recurrent states
+    # by multiplication.
+    # keep_p.shape = (seq_len, batch, 1)
+    keep_p = 1.0 - mask_p.float()
 
     # Get embedded passage and question representations.
     if not self.use_pretrained:
@@ -593,11 +799,21 @@ class qNet(nn.Module):
       p = self.get_vector_embeddings(passage[0])
       q = self.get_vector_embeddings(question[0])
 
+    # Tags are either one-hot arrays, or (seq_len, batch) index arrays.
+    if passage_pos_tags.ndim == 2:
+      passage_pos_tags = self.get_one_hot_tags(passage_pos_tags, self.num_pos_tags)
+      passage_ner_tags = self.get_one_hot_tags(passage_ner_tags, self.num_ner_tags)
+      question_pos_tags = self.get_one_hot_tags(question_pos_tags, self.num_pos_tags)
+      question_ner_tags = self.get_one_hot_tags(question_ner_tags, self.num_ner_tags)
+    else:
+      passage_pos_tags = self.placeholder(passage_pos_tags)
+      passage_ner_tags = self.placeholder(passage_ner_tags)
+      question_pos_tags = self.placeholder(question_pos_tags)
+      question_ner_tags = self.placeholder(question_ner_tags)
+
     # {p,q}.shape = (seq_len, batch, embedding_dim + num_pos_tags + num_ner_tags)
-    p = torch.cat((p, self.placeholder(passage_pos_tags),
-                   self.placeholder(passage_ner_tags)), dim=-1)
-    q = torch.cat((q, self.placeholder(question_pos_tags),
-                   self.placeholder(question_ner_tags)), dim=-1)
+    p = torch.cat((p, passage_pos_tags, passage_ner_tags), dim=-1)
+    q = torch.cat((q, question_pos_tags, question_ner_tags), dim=-1)
 
     if self.debug_level >= 3:
       p.sum()
@@ -607,8 +823,11 @@ class qNet(nn.Module):
 
     # Preprocessing LSTM outputs for passage and question input.
     # H{p,q}.shape = (seq_len, batch, hdim)
-    Hp = self.process_input_with_lstm(p, max_passage_len, passage_lens, batch_size,
+    Hp = self.process_input_with_lstm(p, max_passage_len, passage[1], num_passages,
                                       self.preprocessing_lstm)
+    if passage_map is not None:
+      # Expand the distinct passages to the examples of the batch.
+      Hp = torch.index_select(Hp, 1, self.variable(torch.from_numpy(passage_map)))
     Hq = self.process_input_with_lstm(q, max_question_len, question_lens, batch_size,
                                       self.preprocessing_lstm)
 
@@ -622,8 +841,7 @@ class qNet(nn.Module):
     Hr = Hp
     for layer_no in range(self.num_matchlstm_layers):
       Hr = self.match_question_passage(str(layer_no), Hr, Hq, max_passage_len,
-                                       batch_size, mask_p_idxs, mask_p_ts,
-                                       mask_q_idxs, mask_q_ts)
+                                       batch_size, mask_p, mask_q, keep_p)
       # Question-aware passage representation dropout.
       Hr = getattr(self, 'dropout_passage_matchlstm_' + str(layer_no))(Hr)
 
@@ -636,7 +854,7 @@ class qNet(nn.Module):
     # (Question-aware) passage self-matching layers.
     for layer_no in range(self.num_selfmatch_layers):
       Hr = self.match_passage_passage(str(layer_no), Hr, max_passage_len,
-                                      batch_size, mask_p_idxs, mask_p_ts)
+                                      batch_size, mask_p, keep_p)
       # Passage self-matching layer dropout.
       Hr = getattr(self, 'dropout_self_matchlstm_' + str(layer_no))(Hr)
 
@@ -659,8 +877,8 @@ class qNet(nn.Module):
     # and the loss for training.
     # At this point, Hr.shape = (seq_len, batch, hdim)
     answer_distributions_list, loss, mle_loss, f1_loss = \
-      self.point_at_answer(Hr, Hp, Hq, batch_size, answer, f1_matrices,
-                           mask_p_idxs, mask_p_ts, mask_q_idxs, mask_q_ts)
+      self.point_at_answer(Hr, Hp, Hq, batch_size, answer, passage_lens,
+                           mask_p, mask_q)
 
     if self.debug_level >= 3:
       loss.data[0]
@@ -0,0 +1,559 @@
+# -*- coding: utf-8 -*-
+import BaseHTTPServer
+import fcntl
+import json
+import multiprocessing
+import os
+import random
+import re
+import threading
+import time
+
+import pytest
+
+import Input
+
+# Tokens of the stub tokenizer below: words, and single punctuation marks.
+token_re = re.compile(r'\w+|[^\w\s]', re.UNICODE)
+
+# Stub StanfordCoreNLPServer. Texts are split into sentences at blank lines,
+# and into tokens at word boundaries, with canned tags, and character offsets
+# in UTF-16 code units, as CoreNLP reports them.
+class StubCoreNLPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  def log_message(self, *args):
+    pass
+
+  def do_POST(self):
+    text = self.rfile.read(int(self.headers['Content-Length'])).decode('utf8')
+    self.server.requests.append(text)
+    utf16_offset = lambda index: len(text[:index].encode('utf-16-le')) // 2
+    sentences = []
+    for sentence in re.finditer(r'(?:[^\n]|\n(?!\n))+', text):
+      tokens = []
+      for token in token_re.finditer(sentence.group(0)):
+        word = token.group(0)
+        tokens.append({ 'word': word,
+                        'pos': 'NN' if word.isalpha() else \
+                               'CD' if word.isdigit() else 'SYM',
+                        'ner': 'NUMBER' if word.isdigit() else 'O',
+                        'characterOffsetBegin':
+                          utf16_offset(sentence.start() + token.start()),
+                        'characterOffsetEnd':
+                          utf16_offset(sentence.start() + token.end()) })
+      sentences.append({ 'tokens': tokens })
+    body = json.dumps({ 'sentences': sentences })
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+@pytest.fixture
+def corenlp_server(monkeypatch):
+  server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StubCoreNLPHandler)
+  server.requests = []
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  monkeypatch.setattr(Input, 'corenlp_url',
+                      'http://127.0.0.1:%d' % server.server_address[1])
+  monkeypatch.setattr(Input, 'corenlp_clients', {})
+  yield server
+  server.shutdown()
+  server.server_close()
+
+texts = [ u"The Normans (Norman: Nourmands) gave their name to Normandy.",
+          u"In 1066, William crossed the Channel.",
+          u"Caf\xe9 na\xefve \U0001F600 emoji-words, then more \U0001F600x.",
+          u"Two lines\nin one text, and\n\na blank line too.",
+          u"",
+          u"  Leading and trailing spaces  " ]
+
+def test_batched_requests_match_one_request_per_text(corenlp_server):
+  items = list(enumerate(texts))
+  batched = Input.tokenize_and_tag_batch(items)
+  assert len(corenlp_server.requests) == 1
+  single = [ Input.tokenize_and_tag_batch([ item ])[0] for item in items ]
+  assert len(corenlp_server.requests) == 1 + len(texts)
+  assert batched == single
+
+def test_token_offsets_index_into_each_text(corenlp_server):
+  results = Input.tokenize_and_tag_batch(list(enumerate(texts)))
+  for (idx, words, pos_tags, ner_tags, begins, ends), text in \
+      zip(results, texts):
+    assert len(words) == len(pos_tags) == len(ner_tags) == len(begins)
+    assert [ text[begin:end] for begin, end in zip(begins, ends) ] == words
+
+# The answer span as create_data found it before token offsets: answer
+# markers are inserted around the answer, the paragraph is tokenized again,
+# and the span is read off the marker positions.
+def get_answer_span_with_markers(para_text, answer_start, answer_end):
+  para_text_modified = para_text[:answer_start] + " ANSWERSTART " + \
+                       para_text[answer_start:answer_end] + " ANSWEREND " + \
+                       para_text[answer_end:]
+  answer_idxs = [ i for i, w in enumerate(token_re.findall(para_text_modified)) \
+                    if w in ("ANSWERSTART", "ANSWEREND") ]
+  answer_idxs[1] -= 2
+  return answer_idxs
+
+def test_answer_spans_match_marker_spans():
+  rng = random.Random(0)
+  words = [ u"The", u"Normans", u"(", u"Norman", u":", u"Nourmands", u")",
+            u"1066", u",", u"Caf\xe9", u"na\xefve", u"\U0001F600", u"x",
+            u".", u"emoji-words", u"don't", u"\n" ]
+  for trial in range(300):
+    para_text = u""
+    for i in range(rng.randint(1, 30)):
+      para_text += rng.choice([ u"", u" ", u"  " ]) + rng.choice(words)
+    tokens = list(token_re.finditer(para_text))
+    if len(tokens) == 0:
+      continue
+    token_begins = [ token.start() for token in tokens ]
+    token_ends = [ token.end() for token in tokens ]
+    first = rng.randint(0, len(tokens) - 1)
+    last = rng.randint(first, len(tokens) - 1)
+    # Answers aligned with token boundaries, as most SQuAD answers are.
+    answer_start, answer_end = token_begins[first], token_ends[last]
+    span = Input.get_answer_span(token_begins, token_ends, answer_start,
+                                 answer_end)
+    assert span == [ first, last ]
+    assert span == get_answer_span_with_markers(para_text, answer_start,
+                                                answer_end)
+    # An answer starting mid-token starts at the token that contains it. The
+    # marker method split that token instead.
+    if token_ends[first] - token_begins[first] > 1:
+      assert Input.get_answer_span(token_begins, token_ends, answer_start + 1,
+                                   answer_end) == [ first, last ]
+
+def annotation(text):
+  words = text.split()
+  return words, [ 'NN' ] * len(words), [ 'O' ] * len(words), \
+         range(len(words)), range(1, len(words) + 1)
+
+def fill_cache(filename, prefix):
+  for flush in range(5):
+    cache = Input.AnnotationCache(filename)
+    for i in range(20):
+      text = u"%s text %d %d" % (prefix, flush, i)
+      cache.put(text, 'tokenize', *annotation(text))
+    cache.flush()
+
+def test_annotation_cache_shared_by_processes(tmpdir):
+  filename = str(tmpdir.join('cache.bin'))
+  processes = [ multiprocessing.Process(target=fill_cache,
+                                        args=(filename, u"p%d" % p)) \
+                  for p in range(4) ]
+  for process in processes:
+    process.start()
+  for process in processes:
+    process.join()
+  cache = Input.AnnotationCache(filename)
+  assert len(cache.index) == 4 * 5 * 20
+  for p in range(4):
+    for flush in range(5):
+      for i in range(20):
+        text = u"p%d text %d %d" % (p, flush, i)
+        assert cache.get(text, 'tokenize') == annotation(text)
+
+# Counts the record headers read by a cache.
+class CountingHeader:
+  def __init__(self, header):
+    self.header = header
+    self.size = header.size
+    self.reads = 0
+
+  def pack(self, *values):
+    return self.header.pack(*values)
+
+  def unpack_from(self, data, offset):
+    self.reads += 1
+    return self.header.unpack_from(data, offset)
+
+def test_annotation_cache_indexes_only_new_records(tmpdir):
+  filename = str(tmpdir.join('cache.bin'))
+  fill_cache(filename, u"old")
+  cache = Input.AnnotationCache(filename)
+  cache.header = CountingHeader(cache.header)
+  for flush in range(20):
+    text = u"new text %d" % flush
+    cache.put(text, 'tokenize', *annotation(text))
+    cache.flush()
+    # Another process appends a record between flushes.
+    other = Input.AnnotationCache(filename)
+    text = u"other text %d" % flush
+    other.put(text, 'tokenize', *annotation(text))
+    other.flush()
+  # Each flush reads the headers of the other process's record before it
+  # (if any), and of its own, but not those of the records indexed before.
+  assert cache.header.reads == 2 * 20 - 1
+  assert len(cache.index) == 5 * 20 + 2 * 20 - 1
+  for flush in range(20):
+    for prefix in (u"new", u"other"):
+      text = u"%s text %d" % (prefix, flush)
+      if prefix == u"new" or flush < 19:
+        assert cache.get(text, 'tokenize') == annotation(text)
+
+def test_annotation_cache_keeps_appends_in_progress(tmpdir):
+  filename = str(tmpdir.join('cache.bin'))
+  cache = Input.AnnotationCache(filename)
+  cache.put(u"a b", 'tokenize', *annotation(u"a b"))
+  cache.flush()
+  record = open(filename, 'rb').read()
+  # Another process appending a record, half written so far.
+  fout = open(filename, 'ab')
+  fcntl.flock(fout, fcntl.LOCK_EX)
+  fout.write(record[:len(record) // 2])
+  fout.flush()
+  opened = []
+  thread = threading.Thread(
+    target=lambda: opened.append(Input.AnnotationCache(filename)))
+  thread.start()
+  thread.join(0.2)
+  assert thread.is_alive()
+  fout.write(record[len(record) // 2:])
+  fout.close()
+  thread.join()
+  assert os.path.getsize(filename) == 2 * len(record)
+
+  # A record left partial by an interrupted run is dropped.
+  with open(filename, 'ab') as fout:
+    fout.write(record[:len(record) // 2])
+  cache = Input.AnnotationCache(filename)
+  assert os.path.getsize(filename) == 2 * len(record)
+  cache.put(u"c d e", 'tokenize', *annotation(u"c d e"))
+  cache.flush()
+  cache = Input.AnnotationCache(filename)
+  assert cache.get(u"a b", 'tokenize') == annotation(u"a b")
+  assert cache.get(u"c d e", 'tokenize') == annotation(u"c d e")
+
+def test_word_list_round_trip(tmpdir):
+  dictionary = Input.Dictionary()
+  dictionary.add_or_get_indices([ u"the", u"Caf\xe9", u"\U0001F600", u"the",
+                                  u"a b", u".", u"two\nlines" ])
+  filename = str(tmpdir.join('vocab.txt'))
+  dictionary.write_table(filename)
+  read = Input.Dictionary()
+  read.read_table(filename)
+  assert read.size() == dictionary.size() == 6
+  assert read.index_to_word == dictionary.index_to_word
+  assert read.word_to_index == dictionary.word_to_index
+  # An incomplete word at the end is dropped.
+  data = Input.encode_words(dictionary.index_to_word)
+  assert Input.decode_words(data + u"Caf\xe9".encode('utf8')) == \
+         (dictionary.index_to_word, len(data))
+  assert Input.decode_words('') == ([], 0)
+
+# Wait for the threads started since before to finish. Returns those still
+# running after the timeout.
+def wait_for_threads(before, timeout=5.0):
+  deadline = time.time() + timeout
+  while time.time() < deadline:
+    running = [ thread for thread in threading.enumerate() \
+                  if thread not in before ]
+    if len(running) == 0:
+      break
+    time.sleep(0.01)
+  return running
+
+def test_batch_prefetcher_keeps_batch_order():
+  before = threading.enumerate()
+  rng = random.Random(0)
+  def make_batch(batch):
+    time.sleep(rng.uniform(0, 0.002))
+    return batch * 2
+  for num_workers in (0, 1, 3):
+    batches = Input.BatchPrefetcher(range(50), make_batch, num_workers, 2)
+    assert list(batches) == [ (batch, batch * 2) for batch in range(50) ]
+  assert wait_for_threads(before) == []
+
+def stop_loop_early(num_workers, made, stop_with):
+  def make_batch(batch):
+    made.append(batch)
+    if batch == 5 and stop_with == 'worker':
+      raise ValueError("bad batch")
+    return [ batch ] * 1000
+  for batch, prepared in Input.BatchPrefetcher(range(1000), make_batch,
+                                               num_workers, 2):
+    assert prepared == [ batch ] * 1000
+    if batch == 5 and stop_with == 'break':
+      break
+    if batch == 5 and stop_with == 'loop':
+      raise KeyboardInterrupt()
+
+def test_batch_prefetcher_stops_threads_when_loop_stops():
+  for stop_with, error in (('break', None), ('loop', KeyboardInterrupt),
+                           ('worker', ValueError)):
+    for num_workers in (1, 3):
+      before = threading.enumerate()
+      made = []
+      if error is None:
+        stop_loop_early(num_workers, made, stop_with)
+      else:
+        with pytest.raises(error):
+          stop_loop_early(num_workers, made, stop_with)
+      assert wait_for_threads(before) == []
+      # Only batches up to the prefetch depth (at least the number of
+      # workers) past the last one used were prepared.
+      assert len(made) <= 6 + max(2, num_workers) + 1
+
+squad_words = [ u"The", u"Normans", u"Caf\xe9", u"\U0001F600", u"1066", u",",
+                u".", u'"quoted"', u"back\\slash", u"tab\tbed", u"emoji\U0001F600s" ]
+
+# Random SQuAD articles, with answers aligned with the stub tokens.
+def random_articles(rng, num_articles, prefix=u""):
+  articles = []
+  for a in range(num_articles):
+    paragraphs = []
+    for p in range(rng.randint(1, 3)):
+      context = u" ".join(rng.choice(squad_words) \
+                            for _ in range(rng.randint(3, 30)))
+      tokens = list(token_re.finditer(context))
+      qas = []
+      for q in range(rng.randint(1, 3)):
+        first = rng.randint(0, len(tokens) - 1)
+        last = rng.randint(first, min(first + 3, len(tokens) - 1))
+        answer_start = tokens[first].start()
+        # Some questions have 2 words or less, and are ignored.
+        question = u" ".join(rng.choice(squad_words) \
+                               for _ in range(rng.randint(2, 8)))
+        qas.append({ u"id": u"%s%d-%d-%d" % (prefix, a, p, q),
+                     u"question": question,
+                     u"answers": [ { u"answer_start": answer_start,
+                                     u"text": context[answer_start:
+                                                      tokens[last].end()] } ] })
+      paragraphs.append({ u"context": context, u"qas": qas })
+    articles.append({ u"title": u"%sArticle %d" % (prefix, a),
+                      u"paragraphs": paragraphs })
+  return articles
+
+# Write a SQuAD json file, with "version" before or after "data".
+def write_squad(filename, articles, version=u"1.1", version_first=True,
+                ensure_ascii=True, indent=None):
+  fields = [ u'"version": ' + json.dumps(version),
+             u'"data": ' + json.dumps(articles, ensure_ascii=ensure_ascii,
+                                      indent=indent) ]
+  if not version_first:
+    fields.reverse()
+  with open(filename, 'wb') as fout:
+    fout.write((u"{" + u",\n ".join(fields) + u"}\n").encode('utf8'))
+
+def test_json_article_reader_matches_json_load(tmpdir):
+  rng = random.Random(0)
+  articles = random_articles(rng, 4)
+  filename = str(tmpdir.join('squad.json'))
+  # A number is only complete once the text after it is read.
+  for version, version_first in ((u"1.1", True), (u"1.1", False),
+                                 (110, False)):
+    # Escapes (like \" and \ud83d\ude00 surrogate pairs) or multi-byte UTF-8
+    # characters are split across reads of every size.
+    for ensure_ascii in (True, False):
+      for indent in (None, 1):
+        write_squad(filename, articles, version, version_first,
+                    ensure_ascii, indent)
+        with open(filename, 'rb') as fin:
+          expected = json.load(fin)
+        assert expected['data'] == articles
+        for read_size in (1, 3, 7, 1 << 20):
+          reader = Input.JsonArticleReader(filename, read_size)
+          assert list(reader) == articles
+          assert reader.fields == { u"version": version }
+  assert list(Input.iter_json_articles(filename, 3)) == articles[:3]
+  assert list(Input.iter_json_articles(filename, 0)) == []
+
+# Stub tokenize_and_tag_all, with the tokens and tags of the stub server.
+def stub_tokenize_and_tag_all(items, verbose=2, cache=None):
+  results = []
+  for idx, text in items:
+    tokens = list(token_re.finditer(text))
+    words = [ token.group(0) for token in tokens ]
+    results.append((idx, words,
+                    [ 'NN' if word.isalpha() else \
+                      'CD' if word.isdigit() else 'SYM' for word in words ],
+                    [ 'NUMBER' if word.isdigit() else 'O' for word in words ],
+                    [ token.start() for token in tokens ],
+                    [ token.end() for token in tokens ]))
+  return results
+
+# The model inputs of a Data, with words and tags instead of indices, so
+# that builds with different dictionaries can be compared.
+def data_inputs(data):
+  words = data.dictionary.index_to_word
+  pos_tags = dict((index, tag) for tag, index in \
+                    data.dictionary.pos_tags.iteritems())
+  ner_tags = dict((index, tag) for tag, index in \
+                    data.dictionary.ner_tags.iteritems())
+  paras = [ ([ words[index] for index in para ],
+             [ pos_tags[tag] for tag in pos ],
+             [ ner_tags[tag] for tag in ner ]) \
+              for para, pos, ner in zip(data.tokenized_paras,
+                                        data.paras_pos_tags,
+                                        data.paras_ner_tags) ]
+  questions = dict((qid, ([ pos_tags[tag] for tag in \
+                              data.question_pos_tags[qid] ],
+                          [ ner_tags[tag] for tag in \
+                              data.question_ner_tags[qid] ])) \
+                     for qid in data.question_to_paragraph)
+  examples = sorted((example[2], [ words[index] for index in example[0] ],
+                     list(example[1]), tuple(example[4])) \
+                      for example in data.data)
+  return paras, data.question_to_paragraph, questions, examples, data.missed
+
+def test_streamed_build_matches_whole_file_build(tmpdir, monkeypatch):
+  monkeypatch.setattr(Input, 'tokenize_and_tag_all', stub_tokenize_and_tag_all)
+  rng = random.Random(1)
+  filename = str(tmpdir.join('squad.json'))
+  write_squad(filename, random_articles(rng, 7), version_first=False)
+  for max_articles in (-1, 5):
+    whole = Input.Data()
+    whole.read_from_file(filename, max_articles)
+    for chunk_articles in (1, 2, 10):
+      columns = str(tmpdir.join('streamed-%d-%d' % (max_articles,
+                                                    chunk_articles)))
+      streamed = Input.Data().read_from_file_to_columns(
+        filename, max_articles, columns, chunk_articles)
+      assert len(streamed.data) > 0
+      assert data_inputs(streamed) == data_inputs(whole)
+
+# The texts of an article that a build tokenizes.
+def article_texts(article):
+  texts = []
+  for paragraph in article['paragraphs']:
+    texts.append(paragraph['context'])
+    texts.extend(qa['question'] for qa in paragraph['qas'] \
+                   if len(qa['question'].split()) > 2)
+  return texts
+
+def test_incremental_build_reuses_unchanged_articles(tmpdir, monkeypatch):
+  tokenized = []
+  def tokenize_and_tag_all(items, verbose=2, cache=None):
+    tokenized.extend(text for idx, text in items)
+    return stub_tokenize_and_tag_all(items)
+  monkeypatch.setattr(Input, 'tokenize_and_tag_all', tokenize_and_tag_all)
+  rng = random.Random(2)
+  articles = random_articles(rng, 6)
+  filename = str(tmpdir.join('squad.json'))
+  store_dirname = str(tmpdir.join('store'))
+  # Build max_articles of the file with the store, and check the result
+  # against a build of the whole file.
+  def build(max_articles):
+    write_squad(filename, articles)
+    del tokenized[:]
+    data = Input.Data()
+    store = Input.ArticleStore(store_dirname, data.dictionary)
+    data.read_from_file_incremental(filename, max_articles, store)
+    texts = list(tokenized)
+    whole = Input.Data()
+    whole.read_from_file(filename, max_articles)
+    assert data_inputs(data) == data_inputs(whole)
+    return data, store, texts
+
+  data, store, texts = build(-1)
+  assert (store.hits, store.misses) == (0, 6)
+  assert sorted(texts) == sorted(text for article in articles \
+                                   for text in article_texts(article))
+  words = data.dictionary.index_to_word
+
+  # Fewer articles: all are reused, and the vocabulary is kept.
+  data, store, texts = build(4)
+  assert (store.hits, store.misses, texts) == (4, 0, [])
+  assert data.dictionary.index_to_word == words
+
+  # An edited article with a new word, and a new article, are tokenized.
+  # Words keep their indices, and new words are appended.
+  articles[1]['paragraphs'][0]['context'] += u" Brittany"
+  articles.extend(random_articles(rng, 1, prefix=u"new"))
+  data, store, texts = build(-1)
+  assert (store.hits, store.misses) == (5, 2)
+  assert sorted(texts) == sorted(article_texts(articles[1]) + \
+                                 article_texts(articles[6]))
+  assert data.dictionary.index_to_word[:len(words)] == words
+  assert u"Brittany" in data.dictionary.index_to_word[len(words):]
+
+  # The first build's articles are still in the store.
+  articles[1]['paragraphs'][0]['context'] = \
+    articles[1]['paragraphs'][0]['context'][:-len(u" Brittany")]
+  data, store, texts = build(-1)
+  assert (store.hits, store.misses, texts) == (7, 0, [])
+
+def test_columnar_store_matches_pickle(tmpdir, monkeypatch):
+  monkeypatch.setattr(Input, 'tokenize_and_tag_all', stub_tokenize_and_tag_all)
+  rng = random.Random(3)
+  filename = str(tmpdir.join('squad.json'))
+  write_squad(filename, random_articles(rng, 5))
+  data = Input.Data()
+  data.read_from_file(filename, -1)
+  data.dictionary.set_immutable()
+  assert len(data.data) > 0
+  dump_filename = str(tmpdir.join('train'))
+  data.dump(dump_filename, 'pickle')
+  data.dump(dump_filename, 'columnar')
+  pickled = Input.Data().read_from_dump(dump_filename, 'pickle')
+  columns = Input.Data().read_from_dump(dump_filename, 'columnar')
+
+  assert columns.data == pickled.data
+  assert list(columns.tokenized_paras) == pickled.tokenized_paras
+  assert list(columns.paras_pos_tags) == pickled.paras_pos_tags
+  assert list(columns.paras_ner_tags) == pickled.paras_ner_tags
+  assert columns.question_to_paragraph == pickled.question_to_paragraph
+  for qid in pickled.question_to_paragraph:
+    assert columns.question_pos_tags[qid] == pickled.question_pos_tags[qid]
+    assert columns.question_ner_tags[qid] == pickled.question_ner_tags[qid]
+  assert columns.missed == pickled.missed
+  for field in ('index_to_word', 'word_to_index', 'pos_tags', 'ner_tags',
+                'mutable', 'lowercase', 'remove_punctuation', 'answer_start',
+                'answer_end', 'pad_index'):
+    assert getattr(columns.dictionary, field) == \
+           getattr(pickled.dictionary, field), field
+
+def random_lengths(rng, num_examples):
+  return [ rng.randint(1, 300) for _ in range(num_examples) ], \
+         [ rng.randint(1, 30) for _ in range(num_examples) ]
+
+def test_bucket_sampler_covers_every_example_once():
+  rng = random.Random(0)
+  for num_examples in (0, 1, 7, 250):
+    passage_lens, question_lens = random_lengths(rng, num_examples)
+    for bucket_size in (0, 1, 16, 1000):
+      for shuffle in (False, True):
+        sampler = Input.BucketSampler(passage_lens, question_lens, 8,
+                                      bucket_size, shuffle=shuffle)
+        for epoch in range(2):
+          batches = sampler.get_batches()
+          assert sorted(idx for batch in batches for idx in batch) == \
+                 range(num_examples)
+          assert all(0 < len(batch) <= 8 for batch in batches)
+          # Batches hold examples of a single bucket.
+          ranks = sorted(range(num_examples), reverse=True,
+                         key=lambda idx: passage_lens[idx] + question_lens[idx])
+          bucket_of = dict((idx, rank // bucket_size if bucket_size else 0) \
+                             for rank, idx in enumerate(ranks))
+          assert all(len(set(bucket_of[idx] for idx in batch)) == 1 \
+                       for batch in batches)
+          assert 0 <= sampler.padding_efficiency <= 1
+
+def test_bucket_sampler_respects_token_budget():
+  rng = random.Random(1)
+  for num_examples in (0, 1, 7, 250):
+    passage_lens, question_lens = random_lengths(rng, num_examples)
+    for bucket_size in (0, 16):
+      for max_tokens in (1, 299, 1000, 5000):
+        for shuffle in (False, True):
+          sampler = Input.BucketSampler(passage_lens, question_lens, 8,
+                                        bucket_size, max_tokens, shuffle)
+          batches = sampler.get_batches()
+          assert sorted(idx for batch in batches for idx in batch) == \
+                 range(num_examples)
+          # Only a single example may exceed the budget on its own.
+          padded_tokens = [ len(batch) * max(passage_lens[idx] \
+                                               for idx in batch) \
+                              for batch in batches ]
+          assert all(tokens <= max_tokens or len(batch) == 1 \
+                       for tokens, batch in zip(padded_tokens, batches))
+          if shuffle or bucket_size:
+            continue
+          # Batches are filled in order: the first example of each batch did
+          # not fit in the one before.
+          for batch, next_batch in zip(batches, batches[1:]):
+            grown = batch + next_batch[:1]
+            assert len(grown) * max(passage_lens[idx] for idx in grown) > \
+                   max_tokens
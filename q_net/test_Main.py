@@ -0,0 +1,116 @@
+import numpy as np
+
+from Main import get_batch, get_best_spans
+
+# The per-example, per-start loop that get_best_spans replaced.
+def get_best_spans_loop(distributions, paras_lens_in, max_answer_span):
+  best_idxs = []
+  for idx in range(len(paras_lens_in)):
+    best_prob = -1
+    best = [0, 0]
+    max_end = paras_lens_in[idx]
+    for j, start_prob in enumerate(distributions[0][0][idx][:max_end]):
+      cur_end_idx = max_end if max_answer_span == -1 \
+                            else j + max_answer_span
+      end_idx = np.argmax(distributions[0][1][idx][j:cur_end_idx] * \
+                          distributions[1][0][idx][j:cur_end_idx])
+      prob = distributions[0][1][idx][j+end_idx] * start_prob * \
+             distributions[1][1][idx][j] * distributions[1][0][idx][j+end_idx]
+      if prob > best_prob:
+        best_prob = prob
+        best = [j, j+end_idx]
+    best_idxs.append(best)
+  return best_idxs
+
+def random_distributions(rng, batch_size, max_len, levels):
+  # Few distinct values, so that many spans tie or nearly tie.
+  values = rng.choice(rng.uniform(0.01, 1.0, levels),
+                      size=(2, 2, batch_size, max_len))
+  values /= values.sum(axis=3, keepdims=True)
+  return [ [ values[i, j].astype(np.float32) for j in range(2) ] \
+             for i in range(2) ]
+
+def test_best_spans_match_loop():
+  rng = np.random.RandomState(0)
+  for trial in range(1200):
+    batch_size = rng.randint(1, 6)
+    max_len = rng.randint(1, 50)
+    distributions = random_distributions(rng, batch_size, max_len,
+                                         rng.randint(2, 8))
+    paras_lens_in = rng.randint(1, max_len + 1, batch_size).tolist()
+    paras_lens_in[0] = max_len
+    for max_answer_span in (-1, 1, 5, 15):
+      spans = get_best_spans(distributions, paras_lens_in, max_answer_span)
+      assert [ [ int(start), int(end) ] for start, end in spans ] == \
+             get_best_spans_loop(distributions, paras_lens_in,
+                                 max_answer_span)
+
+def test_log_space_best_spans_match_loop():
+  rng = np.random.RandomState(1)
+  for trial in range(200):
+    batch_size = rng.randint(1, 6)
+    max_len = rng.randint(1, 50)
+    distributions = random_distributions(rng, batch_size, max_len, 1000)
+    log_distributions = [ [ np.log(dist) for dist in pair ] \
+                            for pair in distributions ]
+    paras_lens_in = rng.randint(1, max_len + 1, batch_size).tolist()
+    for max_answer_span in (-1, 5):
+      spans = get_best_spans(log_distributions, paras_lens_in,
+                             max_answer_span, log_space=True)
+      assert [ [ int(start), int(end) ] for start, end in spans ] == \
+             get_best_spans_loop(distributions, paras_lens_in,
+                                 max_answer_span)
+
+# A random batch of twelve questions over six paragraphs, and the inputs of
+# get_batch for it, up to the number of NER tags.
+def random_batch(rng):
+  tokenized_paras = [ rng.randint(1, 20, rng.randint(3, 9)).tolist() \
+                        for _ in range(6) ]
+  paras_pos_tags = [ rng.randint(0, 3, len(para)).tolist() \
+                       for para in tokenized_paras ]
+  paras_ner_tags = [ rng.randint(0, 2, len(para)).tolist() \
+                       for para in tokenized_paras ]
+  ques_to_para = dict(('q%d' % i, rng.randint(0, 6)) for i in range(12))
+  question_tokens = dict((qid, rng.randint(1, 20, rng.randint(3, 6)).tolist()) \
+                           for qid in ques_to_para)
+  question_pos_tags = dict((qid, rng.randint(0, 3, len(tokens)).tolist()) \
+                             for qid, tokens in question_tokens.iteritems())
+  question_ner_tags = dict((qid, rng.randint(0, 2, len(tokens)).tolist()) \
+                             for qid, tokens in question_tokens.iteritems())
+  batch = [ [ question_tokens[qid], [ 0, 1 ], qid, None, (0, 2) ] \
+              for qid in sorted(ques_to_para) ]
+  return batch, [ ques_to_para, tokenized_paras, paras_pos_tags,
+                  paras_ner_tags, question_pos_tags, question_ner_tags, 3, 2 ]
+
+def test_shared_passage_batch_matches_per_example_batch():
+  batch, batch_inputs = random_batch(np.random.RandomState(2))
+  ques_to_para = batch_inputs[0]
+  for index_tags in (False, True):
+    inputs = batch_inputs + [ index_tags ]
+    shared = get_batch(batch, *inputs, share_passages=True)
+    per_example = get_batch(batch, *inputs)
+    passage_map = shared[-1]
+    # Each distinct paragraph once, in order of first appearance.
+    para_ids = [ ques_to_para[example[2]] for example in batch ]
+    assert len(shared[0][1]) == len(set(para_ids))
+    assert [ para_ids[list(passage_map).index(i)] \
+               for i in range(len(shared[0][1])) ] == \
+           sorted(set(para_ids), key=para_ids.index)
+    assert per_example[-1] is None
+    assert np.array_equal(shared[0][0][:, passage_map], per_example[0][0])
+    assert [ shared[0][1][idx] for idx in passage_map ] == per_example[0][1]
+    for field in (5, 6):
+      assert np.array_equal(shared[field][:, passage_map], per_example[field])
+    assert np.array_equal(shared[1][0], per_example[1][0])
+    assert shared[1][1] == per_example[1][1]
+    for field in (2, 3, 4, 7):
+      assert np.array_equal(shared[field], per_example[field])
+
+def test_index_tags_match_one_hot_tags():
+  batch, inputs = random_batch(np.random.RandomState(3))
+  one_hot_batch = get_batch(batch, *inputs)
+  index_batch = get_batch(batch, *inputs, index_tags=True)
+  # Question and passage POS and NER tags.
+  for field, num_tags in ((3, 3), (4, 2), (5, 3), (6, 2)):
+    one_hot_tags = np.eye(num_tags + 1)[index_batch[field] + 1][:, :, 1:]
+    assert np.array_equal(one_hot_tags, one_hot_batch[field])
@@ -0,0 +1,527 @@
+import numpy as np
+import torch
+import torch.nn.functional as f
+
+from torch.autograd import Variable
+from qNet import qNet
+
+def make_model(seed=0, **options):
+  config = { 'embed_size': 6, 'vocab_size': 20, 'hidden_size': 8,
+             'attention_size': 5, 'lr': 0.1, 'vectors_path': None,
+             'unknown_embedding_init': None, 'optimizer': 'SGD',
+             'index_to_word': [ '<pad>' ] + [ 'w%d' % i for i in range(19) ],
+             'word_to_index': { '<pad>': 0 }, 'use_pretrained': False,
+             'cuda': False, 'dropout': 0.0, 'f1_loss_multiplier': 2.0,
+             'f1_loss_threshold': -1.0, 'num_pos_tags': 3, 'num_ner_tags': 2,
+             'num_preprocessing_layers': 1, 'num_postprocessing_layers': 1,
+             'num_matchlstm_layers': 1, 'num_selfmatch_layers': 1 }
+  config.update(options)
+  torch.manual_seed(seed)
+  return qNet(config)
+
+# Random padded token ids and one-hot tags for sequences of the given lengths.
+# Returns ((seq_len, batch) ids, lens), (seq_len, batch, num_pos_tags) and
+# (seq_len, batch, num_ner_tags) arrays.
+def random_sequences(rng, model, lens):
+  ids = np.zeros((max(lens), len(lens)), dtype=np.int64)
+  pos_tags = np.zeros((max(lens), len(lens), model.num_pos_tags))
+  ner_tags = np.zeros((max(lens), len(lens), model.num_ner_tags))
+  for idx, length in enumerate(lens):
+    ids[:length, idx] = rng.randint(1, model.vocab_size, length)
+    pos_tags[np.arange(length), idx,
+             rng.randint(0, model.num_pos_tags, length)] = 1
+    ner_tags[np.arange(length), idx,
+             rng.randint(0, model.num_ner_tags, length)] = 1
+  return (ids, list(lens)), pos_tags, ner_tags
+
+# Random answer spans (2, batch) within the given passage lengths.
+def random_answers(rng, passage_lens):
+  starts = [ rng.randint(0, length) for length in passage_lens ]
+  ends = [ rng.randint(start, min(start + 3, length)) \
+             for start, length in zip(starts, passage_lens) ]
+  return np.array([ starts, ends ])
+
+# Run a forward and backward pass, and return the distributions, the loss
+# and the parameter gradients as numpy arrays.
+def run_model(model, *inputs, **options):
+  model.zero_grad()
+  distributions = model.forward(*inputs, **options)
+  model.loss.backward()
+  grads = dict((name, param.grad.data.numpy().copy()) \
+                 for name, param in model.named_parameters() \
+                 if param.grad is not None)
+  return [ [ dist.data.numpy() for dist in dists ] \
+             for dists in distributions ], \
+         float(model.loss.data.numpy()), grads
+
+def assert_runs_match(run, expected_run, tolerance):
+  distributions, loss, grads = run
+  expected_distributions, expected_loss, expected_grads = expected_run
+  for dists, expected_dists in zip(distributions, expected_distributions):
+    for dist, expected_dist in zip(dists, expected_dists):
+      assert np.allclose(dist, expected_dist, rtol=0, atol=tolerance)
+  assert abs(loss - expected_loss) <= tolerance * max(1, abs(expected_loss))
+  assert sorted(grads) == sorted(expected_grads)
+  for name in grads:
+    assert np.allclose(grads[name], expected_grads[name], rtol=tolerance,
+                       atol=tolerance), name
+
+def test_shared_passage_encoding_matches_per_example():
+  rng = np.random.RandomState(0)
+  model = make_model()
+  # Six questions over three passages.
+  passage_map = np.array([ 0, 0, 1, 2, 2, 1 ], dtype=np.int64)
+  passages, passage_pos_tags, passage_ner_tags = \
+    random_sequences(rng, model, [ 7, 5, 9 ])
+  question, question_pos_tags, question_ner_tags = \
+    random_sequences(rng, model, [ 4, 3, 4, 2, 5, 3 ])
+  answer = random_answers(rng, [ passages[1][idx] for idx in passage_map ])
+
+  shared = run_model(model, passages, question, answer, question_pos_tags,
+                     question_ner_tags, passage_pos_tags, passage_ner_tags,
+                     None, passage_map=passage_map)
+  per_example = run_model(model,
+                          (passages[0][:, passage_map],
+                           [ passages[1][idx] for idx in passage_map ]),
+                          question, answer, question_pos_tags,
+                          question_ner_tags, passage_pos_tags[:, passage_map],
+                          passage_ner_tags[:, passage_map], None)
+  assert_runs_match(shared, per_example, 1e-5)
+
+# Tag indices (seq_len, batch) of one-hot tags, with -1 at padded positions.
+def tag_indices(one_hot_tags):
+  return np.where(one_hot_tags.any(axis=-1), one_hot_tags.argmax(axis=-1), -1)
+
+def test_index_tags_match_one_hot_tags():
+  rng = np.random.RandomState(0)
+  model = make_model()
+  passages, passage_pos_tags, passage_ner_tags = \
+    random_sequences(rng, model, [ 7, 5, 9 ])
+  question, question_pos_tags, question_ner_tags = \
+    random_sequences(rng, model, [ 4, 3, 5 ])
+  answer = random_answers(rng, passages[1])
+  tags = [ question_pos_tags, question_ner_tags, passage_pos_tags,
+           passage_ner_tags ]
+  for one_hot_tags in tags:
+    assert np.array_equal(
+      model.get_one_hot_tags(tag_indices(one_hot_tags),
+                             one_hot_tags.shape[-1]).data.numpy(),
+      one_hot_tags)
+  index_tags = [ tag_indices(one_hot_tags) for one_hot_tags in tags ]
+  one_hot_run = run_model(model, passages, question, answer, *(tags + [ None ]))
+  index_run = run_model(model, passages, question, answer,
+                        *(index_tags + [ None ]))
+  assert_runs_match(index_run, one_hot_run, 0)
+
+# The recurrences as they were before padded states were reset with a keep
+# mask: padded rows of a copy of the state are filled with a detached value.
+def detach3d(vals, mask_idxs, fill_val):
+  if len(mask_idxs[0]) == 0:
+    return vals
+  vals = vals.clone()
+  vals[mask_idxs[0], mask_idxs[1], :] = \
+    vals[mask_idxs[0], mask_idxs[1], :].detach().fill_(fill_val)
+  return vals
+
+def detach2d(vals, mask_t, fill_val):
+  if len(mask_t) == 0:
+    return vals
+  vals = vals.clone()
+  vals[mask_t, :] = vals[mask_t, :].detach().fill_(fill_val)
+  return vals
+
+def get_mask_idxs(batch_size, max_len, lens):
+  mask_idxs = [[], []]
+  mask_ts = [ [] for _ in range(max_len) ]
+  for t in range(max_len):
+    for idx in range(batch_size):
+      if t >= lens[idx]:
+        mask_idxs[0].append(t)
+        mask_idxs[1].append(idx)
+        mask_ts[t].append(idx)
+  return mask_idxs, mask_ts
+
+# Run forward and backward LSTMs over the passage, attending over the given
+# memory at each step, as the old match_question_passage (with Hq as memory)
+# and match_passage_passage (with Hr as memory, and no attended_passage) did.
+def clone_reset_match(model, memory, attended_memory, attended_passage, Hpi,
+                      mask_p_ts, attend_hidden, alpha_transform, match_lstm):
+  max_passage_len, batch_size = Hpi.size()[0], Hpi.size()[1]
+  hf, cf = model.get_initial_lstm(batch_size, model.hidden_size // 2)
+  hb, cb = model.get_initial_lstm(batch_size, model.hidden_size // 2)
+  transposed_memory = torch.transpose(memory, 0, 1)
+  Hf, Hb = [], []
+  for i in range(max_passage_len):
+    forward_idx = i
+    backward_idx = max_passage_len-i-1
+    attended_f, attended_b = attended_memory, attended_memory
+    if attended_passage is not None:
+      attended_f = attended_memory + attended_passage[forward_idx]
+      attended_b = attended_memory + attended_passage[backward_idx]
+    gf = f.tanh(attended_f + attend_hidden(hf))
+    gb = f.tanh(attended_b + attend_hidden(hb))
+    alpha_f = f.softmax(alpha_transform(gf), dim=0)
+    alpha_b = f.softmax(alpha_transform(gb), dim=0)
+    weighted_f = torch.squeeze(torch.bmm(alpha_f.permute(1, 2, 0),
+                                         transposed_memory), dim=1)
+    weighted_b = torch.squeeze(torch.bmm(alpha_b.permute(1, 2, 0),
+                                         transposed_memory), dim=1)
+    zf = torch.cat((Hpi[forward_idx], weighted_f), dim=-1)
+    zb = torch.cat((Hpi[backward_idx], weighted_b), dim=-1)
+    hf, cf = match_lstm(zf, (hf, cf))
+    hb, cb = match_lstm(zb, (hb, cb))
+    hf = detach2d(hf, mask_p_ts[forward_idx], 0.0)
+    hb = detach2d(hb, mask_p_ts[backward_idx], 0.0)
+    cf = detach2d(cf, mask_p_ts[forward_idx], 0.0)
+    cb = detach2d(cb, mask_p_ts[backward_idx], 0.0)
+    Hf.append(hf)
+    Hb.append(hb)
+  return torch.cat((torch.stack(Hf, dim=0), torch.stack(Hb[::-1], dim=0)),
+                   dim=-1)
+
+def clone_reset_match_question_passage(model, layer_no, Hpi, Hq, passage_lens,
+                                       question_lens):
+  batch_size = Hpi.size()[1]
+  mask_p_idxs, mask_p_ts = get_mask_idxs(batch_size, Hpi.size()[0],
+                                         passage_lens)
+  mask_q_idxs, _ = get_mask_idxs(batch_size, Hq.size()[0], question_lens)
+  attended_question = detach3d(
+    getattr(model, 'attend_question_for_passage_' + layer_no)(Hq),
+    mask_q_idxs, 0.0)
+  attended_passage = detach3d(
+    getattr(model, 'attend_passage_for_passage_' + layer_no)(Hpi),
+    mask_p_idxs, 0.0)
+  return clone_reset_match(model, Hq, attended_question, attended_passage, Hpi,
+                           mask_p_ts,
+                           getattr(model, 'attend_passage_hidden_' + layer_no),
+                           getattr(model, 'passage_alpha_transform_' + layer_no),
+                           getattr(model, 'passage_match_lstm_' + layer_no))
+
+def clone_reset_match_passage_passage(model, layer_no, Hr, passage_lens):
+  mask_p_idxs, mask_p_ts = get_mask_idxs(Hr.size()[1], Hr.size()[0],
+                                         passage_lens)
+  attended_passage = detach3d(
+    getattr(model, 'attend_self_passage_' + layer_no)(Hr), mask_p_idxs, 0.0)
+  return clone_reset_match(model, Hr, attended_passage, None, Hr, mask_p_ts,
+                           getattr(model, 'attend_self_hidden_' + layer_no),
+                           getattr(model, 'self_alpha_transform_' + layer_no),
+                           getattr(model, 'self_match_lstm_' + layer_no))
+
+# Random (seq_len, batch, hdim) encodings, zero at padded positions, as the
+# pre-processing LSTM gives them.
+def random_encodings(rng, model, lens):
+  H = rng.randn(max(lens), len(lens), model.hidden_size).astype(np.float32)
+  H[np.arange(max(lens))[:, None] >= np.array(lens)[None, :]] = 0
+  return Variable(torch.from_numpy(H), requires_grad=True)
+
+# The output of fn(Hp, Hq), and the gradients of a random projection of it
+# with respect to Hp, Hq and the model parameters.
+def run_layer(model, fn, Hp, Hq, weights):
+  model.zero_grad()
+  for H in (Hp, Hq):
+    if H.grad is not None:
+      H.grad.data.zero_()
+  output = fn(Hp, Hq)
+  (output * weights).sum().backward()
+  grads = dict((name, param.grad.data.numpy().copy()) \
+                 for name, param in model.named_parameters() \
+                 if param.grad is not None)
+  grads['Hp'] = Hp.grad.data.numpy().copy()
+  grads['Hq'] = Hq.grad.data.numpy().copy()
+  return output.data.numpy(), grads
+
+def test_keep_mask_resets_match_clone_resets():
+  rng = np.random.RandomState(0)
+  model = make_model()
+  passage_lens = [ 9, 4, 7, 9, 1 ]
+  question_lens = [ 3, 5, 2, 5, 4 ]
+  Hp = random_encodings(rng, model, passage_lens)
+  Hq = random_encodings(rng, model, question_lens)
+  weights = Variable(torch.from_numpy(
+    rng.randn(9, 5, model.hidden_size).astype(np.float32)))
+  mask_p = model.get_mask(9, passage_lens)
+  mask_q = model.get_mask(5, question_lens)
+  keep_p = 1.0 - mask_p.float()
+
+  layers = [
+    (lambda Hp, Hq: model.match_question_passage('0', Hp, Hq, 9, 5, mask_p,
+                                                 mask_q, keep_p),
+     lambda Hp, Hq: clone_reset_match_question_passage(model, '0', Hp, Hq,
+                                                       passage_lens,
+                                                       question_lens)),
+    # Hq only takes part through the product, so that it has a gradient.
+    (lambda Hp, Hq: model.match_passage_passage('0', Hp, 9, 5, mask_p,
+                                                keep_p) * Hq.sum(),
+     lambda Hp, Hq: clone_reset_match_passage_passage(model, '0', Hp,
+                                                      passage_lens) * Hq.sum()) ]
+  for layer, clone_reset_layer in layers:
+    expected_output, expected_grads = run_layer(model, clone_reset_layer, Hp,
+                                                Hq, weights)
+    for fuse_directions in (False, True):
+      model.fuse_directions = fuse_directions
+      output, grads = run_layer(model, layer, Hp, Hq, weights)
+      assert np.allclose(output, expected_output, rtol=0, atol=1e-6)
+      assert sorted(grads) == sorted(expected_grads)
+      for name in grads:
+        assert np.allclose(grads[name], expected_grads[name], rtol=1e-5,
+                           atol=1e-6), name
+
+# Pointer log-distributions (batch, seq_len) from the given scores, with
+# positions beyond each passage at -inf.
+def log_distributions(scores, passage_lens):
+  dists = []
+  for pair in scores:
+    pair_dists = []
+    for score in pair:
+      score = score.astype(np.float64)
+      for idx, length in enumerate(passage_lens):
+        score[idx, length:] = -np.inf
+      score -= np.log(np.exp(score - score.max(1, keepdims=True)) \
+                        .sum(1, keepdims=True)) + score.max(1, keepdims=True)
+      pair_dists.append(Variable(torch.from_numpy(score.astype(np.float32)),
+                                 requires_grad=True))
+    dists.append(pair_dists)
+  return dists
+
+# Log of the product of forward and backward expected F1s, in float64.
+def expected_f1_log_probs(model, distribution, answer, passage_lens):
+  f1_matrices = model.get_f1_matrices(answer, passage_lens,
+                                      distribution[0][0].size()[1]).data.numpy()
+  p = [ [ np.exp(d.data.numpy().astype(np.float64)) for d in dists ] \
+          for dists in distribution ]
+  expected_f = np.einsum('bs,be,bse->b', p[0][0], p[0][1], f1_matrices)
+  expected_b = np.einsum('bs,be,bse->b', p[1][1], p[1][0], f1_matrices)
+  return np.log(expected_f) + np.log(expected_b)
+
+def run_log_space_losses(model, distribution, answer, passage_lens):
+  answer_start = Variable(torch.from_numpy(answer[0])).unsqueeze(1)
+  answer_end = Variable(torch.from_numpy(answer[1])).unsqueeze(1)
+  loss, mle_loss, f1_loss = \
+    model.log_space_losses(distribution, answer_start, answer_end, answer,
+                           passage_lens, distribution[0][0].size()[1],
+                           len(passage_lens))
+  loss.backward()
+  grads = [ d.grad.data.numpy() for dists in distribution for d in dists ]
+  return float(loss.data.numpy()), float(f1_loss.data.numpy()), grads
+
+def test_log_space_f1_matches_expected_f1():
+  rng = np.random.RandomState(0)
+  model = make_model()
+  passage_lens = [ 6, 4, 5 ]
+  answer = random_answers(rng, passage_lens)
+  distribution = log_distributions(rng.normal(size=(2, 2, 3, 6)),
+                                   passage_lens)
+  f1_log_probs = model.get_f1_log_probs(distribution, answer, passage_lens, 6,
+                                        3).data.numpy()
+  assert np.allclose(f1_log_probs,
+                     expected_f1_log_probs(model, distribution, answer,
+                                           passage_lens), rtol=0, atol=1e-5)
+  probs = [ [ torch.exp(d) for d in dists ] for dists in distribution ]
+  assert np.allclose(f1_log_probs,
+                     np.log(model.get_f1_probs(probs, answer, passage_lens, 6,
+                                               3).data.numpy()),
+                     rtol=0, atol=1e-5)
+
+def test_log_space_f1_loss_survives_underflow():
+  model = make_model()
+  passage_lens = [ 8, 8 ]
+  answer = np.array([ [ 5, 6 ], [ 6, 7 ] ])
+  # All probability is far from the answers, so the expected F1 of each
+  # pointer is about exp(-120), which underflows float32.
+  scores = np.zeros((2, 2, 2, 8))
+  scores[:, :, :, 4:] = -120.0
+  distribution = log_distributions(scores, passage_lens)
+  probs = [ [ torch.exp(d) for d in dists ] for dists in distribution ]
+  assert not model.get_f1_probs(probs, answer, passage_lens, 8,
+                                2).data.numpy().any()
+
+  f1_log_probs = model.get_f1_log_probs(distribution, answer, passage_lens, 8,
+                                        2).data.numpy()
+  expected = expected_f1_log_probs(model, distribution, answer, passage_lens)
+  assert np.all(expected < -200)
+  assert np.allclose(f1_log_probs, expected, rtol=1e-5, atol=0)
+  loss, f1_loss, grads = run_log_space_losses(model, distribution, answer,
+                                              passage_lens)
+  assert np.isfinite(loss) and np.isfinite(f1_loss)
+  assert abs(f1_loss - (np.log(3.0) - np.log(2.0) - expected.mean())) < 1e-3
+  for grad in grads:
+    assert np.all(np.isfinite(grad))
+
+# The per-example loss loop that point_at_answer's gathers replaced.
+def pointer_losses_loop(model, distribution, answer, passage_lens):
+  batch_size = len(passage_lens)
+  batch_losses = [ [] for _ in range(batch_size) ]
+  for idx in range(batch_size):
+    batch_losses[idx].append(
+      distribution[0][0][idx, answer[0][idx]] *\
+      distribution[0][1][idx, answer[1][idx]] *\
+      distribution[1][0][idx, answer[1][idx]] *\
+      distribution[1][1][idx, answer[0][idx]])
+  if model.f1_loss_multiplier > 0:
+    f1_matrices = model.get_f1_matrices(answer, passage_lens,
+                                        distribution[0][0].size()[1])
+    loss_f1_f = (torch.bmm(torch.unsqueeze(distribution[0][0], -1),
+                           torch.unsqueeze(distribution[0][1], 1)) * \
+                 f1_matrices).view(batch_size, -1).sum(1)
+    loss_f1_b = (torch.bmm(torch.unsqueeze(distribution[1][1], -1),
+                           torch.unsqueeze(distribution[1][0], 1)) * \
+                 f1_matrices).view(batch_size, -1).sum(1)
+    for idx in range(batch_size):
+      batch_losses[idx].append(model.f1_loss_multiplier * loss_f1_f[idx] *\
+                               loss_f1_b[idx])
+
+  loss = 0.0
+  mle_loss = 0
+  f1_loss = 0
+  for idx in range(batch_size):
+    loss += -torch.log(sum(batch_losses[idx]) / (1 + model.f1_loss_multiplier))
+    mle_loss += -torch.log(batch_losses[idx][0] / (1 + model.f1_loss_multiplier))
+    if model.f1_loss_multiplier > 0:
+      f1_loss += -torch.log(batch_losses[idx][1] / (1 + model.f1_loss_multiplier))
+  return loss / batch_size, mle_loss / batch_size, f1_loss / batch_size
+
+def test_pointer_losses_match_loop():
+  rng = np.random.RandomState(0)
+  passage_lens = [ 9, 4, 7, 9, 1 ]
+  answer = random_answers(rng, passage_lens)
+  scores = rng.normal(size=(2, 2, len(passage_lens), 9))
+  for f1_loss_multiplier in (0.0, 2.0):
+    model = make_model(f1_loss_multiplier=f1_loss_multiplier)
+    runs = []
+    for losses_fn in (None, pointer_losses_loop):
+      distribution = [ [ Variable(torch.exp(d.data), requires_grad=True) \
+                           for d in dists ] \
+                         for dists in log_distributions(scores, passage_lens) ]
+      if losses_fn is None:
+        model.answer_pointer = lambda *args: distribution
+        Hr = Variable(torch.zeros(9, len(passage_lens), 1))
+        _, loss, mle_loss, f1_loss = \
+          model.point_at_answer(Hr, None, None, len(passage_lens), answer,
+                                passage_lens, None, None)
+      else:
+        loss, mle_loss, f1_loss = \
+          losses_fn(model, distribution, answer, passage_lens)
+      loss.backward()
+      runs.append(([ float(l.data.numpy()) if isinstance(l, Variable) else l \
+                       for l in (loss, mle_loss, f1_loss) ],
+                   [ d.grad.data.numpy() for dists in distribution \
+                       for d in dists ]))
+    (losses, grads), (expected_losses, expected_grads) = runs
+    assert np.allclose(losses, expected_losses, rtol=1e-6, atol=0)
+    for grad, expected_grad in zip(grads, expected_grads):
+      assert np.allclose(grad, expected_grad, rtol=1e-5, atol=1e-7)
+
+# The answer pointer before modules were resolved once and the transpose
+# of Hr was hoisted out of the loop.
+def answer_pointer_baseline(model, Hr, Hp, Hq, mask_p, mask_q, batch_size):
+  attended_input = getattr(model, 'attend_input')(Hr)
+  attended_input_b = getattr(model, 'attend_input_b')(Hr)
+  attended_input = model.fill_masked(attended_input, mask_p, 0.0)
+  attended_input_b = model.fill_masked(attended_input_b, mask_p, 0.0)
+  attended_question = f.tanh(getattr(model, 'attend_question')(Hq))
+  alpha_q = getattr(model, 'alpha_transform')(attended_question)
+  alpha_q = f.softmax(alpha_q, dim=0)
+  weighted_Hq = torch.squeeze(torch.bmm(alpha_q.permute(1, 2, 0),
+                                        torch.transpose(Hq, 0, 1)), dim=1)
+  ha, ca = model.get_initial_lstm(batch_size, model.hidden_size // 2)
+  hb, cb = model.get_initial_lstm(batch_size, model.hidden_size // 2)
+  answer_distributions = []
+  answer_distributions_b = []
+  for k in range(3):
+    Fk = f.tanh(attended_input + getattr(model, 'attend_answer')(ha))
+    Fk_b = f.tanh(attended_input_b + getattr(model, 'attend_answer')(hb))
+    beta_k = getattr(model, 'beta_transform')(Fk)
+    beta_k_b = getattr(model, 'beta_transform')(Fk_b)
+    beta_k = model.padded_softmax(beta_k, mask_p)
+    beta_k_b = model.padded_softmax(beta_k_b, mask_p)
+    if k > 0:
+      answer_distributions.append(torch.t(torch.squeeze(beta_k, dim=-1)))
+      answer_distributions_b.append(torch.t(torch.squeeze(beta_k_b, dim=-1)))
+    if k >= 2:
+      break
+    weighted_Hr = torch.squeeze(torch.bmm(beta_k.permute(1, 2, 0),
+                                          torch.transpose(Hr, 0, 1)), dim=1)
+    weighted_Hr_b = torch.squeeze(torch.bmm(beta_k_b.permute(1, 2, 0),
+                                            torch.transpose(Hr, 0, 1)), dim=1)
+    af = torch.cat((weighted_Hr, weighted_Hq), dim=-1)
+    ab = torch.cat((weighted_Hr_b, weighted_Hq), dim=-1)
+    ha, ca = getattr(model, 'answer_pointer_lstm')(af, (ha, ca))
+    hb, cb = getattr(model, 'answer_pointer_lstm')(ab, (hb, cb))
+  return answer_distributions, answer_distributions_b
+
+def test_answer_pointer_matches_baseline():
+  rng = np.random.RandomState(0)
+  model = make_model()
+  passage_lens = [ 9, 4, 7, 9, 1 ]
+  question_lens = [ 3, 5, 2, 5, 4 ]
+  Hr = random_encodings(rng, model, passage_lens)
+  Hq = random_encodings(rng, model, question_lens)
+  weights = Variable(torch.from_numpy(
+    rng.randn(4, 5, 9).astype(np.float32)))
+  mask_p = model.get_mask(9, passage_lens)
+  mask_q = model.get_mask(5, question_lens)
+  # All four distributions, stacked into (4, batch, seq_len).
+  def pointer(answer_pointer, exp):
+    def run(Hr, Hq):
+      dists, dists_b = answer_pointer(model, Hr, Hr, Hq, mask_p, mask_q, 5)
+      return torch.stack([ exp(dist) for dist in dists + dists_b ])
+    return run
+  expected_output, expected_grads = \
+    run_layer(model, pointer(answer_pointer_baseline, lambda dist: dist), Hr,
+              Hq, weights)
+  for log_space, exp in ((False, lambda dist: dist), (True, torch.exp)):
+    model.log_space = log_space
+    output, grads = run_layer(model, pointer(qNet.answer_pointer, exp), Hr,
+                              Hq, weights)
+    assert np.allclose(output, expected_output, rtol=0, atol=1e-6)
+    assert sorted(grads) == sorted(expected_grads)
+    for name in grads:
+      assert np.allclose(grads[name], expected_grads[name], rtol=1e-5,
+                         atol=1e-6), name
+
+# A model with fixed pre-trained embeddings, from a vectors file of all but
+# the first two words of the vocabulary.
+def make_pretrained_model(tmpdir):
+  rng = np.random.RandomState(0)
+  words = [ '<pad>' ] + [ 'w%d' % i for i in range(19) ]
+  vectors = rng.randn(len(words), 6)
+  vectors_path = str(tmpdir.join('vectors.txt'))
+  with open(vectors_path, 'w') as fout:
+    for word, vector in zip(words[2:], vectors[2:]):
+      fout.write(word + " " + " ".join(repr(v) for v in vector) + "\n")
+  return make_model(use_pretrained=True, vectors_path=vectors_path,
+                    unknown_embedding_init='diagonal',
+                    word_to_index=dict(zip(words, range(len(words)))))
+
+def test_fixed_embeddings_are_a_float32_buffer(tmpdir):
+  model = make_pretrained_model(tmpdir)
+  assert isinstance(model.embedding, torch.FloatTensor)
+  assert 'embedding' in model.state_dict()
+  assert 'embedding' not in dict(model.named_parameters())
+  inp = np.array([ [ 0, 3, 19 ], [ 1, 2, 0 ] ])
+  assert np.array_equal(model.get_vector_embeddings(inp).data.numpy(),
+                        model.embedding.numpy()[inp])
+
+def test_old_checkpoints_load_with_a_buffer(tmpdir):
+  rng = np.random.RandomState(1)
+  model = make_pretrained_model(tmpdir)
+  passages, passage_pos_tags, passage_ner_tags = \
+    random_sequences(rng, model, [ 7, 5, 9 ])
+  question, question_pos_tags, question_ner_tags = \
+    random_sequences(rng, model, [ 4, 3, 5 ])
+  inputs = [ passages, question, random_answers(rng, passages[1]),
+             question_pos_tags, question_ner_tags, passage_pos_tags,
+             passage_ner_tags, None ]
+  expected_run = run_model(model, *inputs)
+
+  # Models were saved with the embeddings as a float64 numpy array.
+  embedding = model.embedding.numpy().astype(np.float64)
+  del model._buffers['embedding']
+  model.embedding = embedding
+  model.save(str(tmpdir), 3)
+  for loaded in (model.load(str(tmpdir), 3),
+                 model.load_from_file(str(tmpdir.join('epoch_3.pt')))):
+    assert isinstance(loaded.embedding, torch.FloatTensor)
+    assert 'embedding' in loaded.state_dict()
+    assert np.array_equal(loaded.embedding.numpy(), embedding)
+    assert_runs_match(run_model(loaded, *inputs), expected_run, 0)
@@ -6,6 +6,14 @@ import sys
 
 from nltk.tokenize import sent_tokenize, word_tokenize
 
+# "word in string.punctuation" is a substring test, so any substring of it
+# counts as punctuation. A set of all those substrings keeps the same test,
+# without scanning the string for every word.
+punctuation_substrings = \
+  frozenset(string.punctuation[i:j] \
+              for i in range(len(string.punctuation)) \
+              for j in range(i, len(string.punctuation) + 1))
+
 class Dictionary:
   def __init__(self, lowercase=True, remove_punctuation=True,
                answer_start="ANSWERSTART", answer_end="ANSWEREND"):
@@ -27,13 +35,9 @@ class Dictionary:
   def csize(self):
     return len(self.index_to_char)
 
-  def add_or_get_index(self, word):
-    if word == self.answer_start or word == self.answer_end:
-      return -1
-    # We ignore punctuation symbols
-    if self.remove_punctuation:
-      if word in string.punctuation:
-        return None
+  # Add a word that is neither an answer marker nor punctuation, or get its
+  # index if it already exists.
+  def add_word(self, word):
     if self.lowercase:
       word = word.strip().lower()
     if word in self.word_to_index:
@@ -45,9 +49,36 @@ class Dictionary:
     self.index_to_word.append(word)
     return new_index
 
+  def add_or_get_index(self, word):
+    if word == self.answer_start or word == self.answer_end:
+      return -1
+    # We ignore punctuation symbols
+    if self.remove_punctuation:
+      if word in punctuation_substrings:
+        return None
+    return self.add_word(word)
+
+  # add_or_get_index for every word in the list. Words already in the
+  # dictionary are looked up without any method calls.
+  def add_or_get_indices(self, words):
+    markers = frozenset((self.answer_start, self.answer_end))
+    punctuation = punctuation_substrings if self.remove_punctuation else ()
+    get = self.word_to_index.get
+    indices = []
+    append = indices.append
+    for word in words:
+      if word in markers:
+        append(-1)
+      elif word in punctuation:
+        append(None)
+      else:
+        index = get(word.strip().lower() if self.lowercase else word)
+        append(index if index is not None else self.add_word(word))
+    return indices
+
   def add_or_get_cindex(self, char):
     if self.remove_punctuation:
-      if char in string.punctuation:
+      if char in punctuation_substrings:
         return None
     if self.lowercase:
       char = char.strip().lower()
@@ -60,9 +91,23 @@ class Dictionary:
     self.index_to_char.append(char)
     return new_index
 
+  # add_or_get_cindex for every character of the word.
+  def add_or_get_cindices(self, word):
+    punctuation = punctuation_substrings if self.remove_punctuation else ()
+    get = self.char_to_index.get
+    indices = []
+    append = indices.append
+    for char in word:
+      if char in punctuation:
+        append(None)
+      else:
+        index = get(char.strip().lower() if self.lowercase else char)
+        append(index if index is not None else self.add_or_get_cindex(char))
+    return indices
+
   def get_cindex(self, char):
     if self.remove_punctuation:
-      if char in string.punctuation:
+      if char in punctuation_substrings:
         return None
     if char in self.char_to_index:
       return self.char_to_index[char]
@@ -72,12 +117,22 @@ class Dictionary:
     if word == self.answer_start or word == self.answer_end:
       return -1
     if self.remove_punctuation:
-      if word in string.punctuation:
+      if word in punctuation_substrings:
         return None
     if word in self.word_to_index:
       return self.word_to_index[word]
     return self.pad_index
 
+  # get_index for every word in the list.
+  def get_indices(self, words):
+    markers = frozenset((self.answer_start, self.answer_end))
+    punctuation = punctuation_substrings if self.remove_punctuation else ()
+    get = self.word_to_index.get
+    pad_index = self.pad_index
+    return [ -1 if word in markers else \
+             None if word in punctuation else \
+             get(word, pad_index) for word in words ]
+
   def get_word(self, index):
     return self.index_to_word[index]
 
@@ -125,9 +180,8 @@ class Data:
 
   def tokenize_para(self, para_text):
     # Create tokenized paragraph representation.
-    tokenized_para = [ [ self.dictionary.add_or_get_index(word) \
-                         for word in word_tokenize(sent) ] \
-                           for sent in sent_tokenize(para_text) ]
+    tokenized_para = [ self.dictionary.add_or_get_indices(word_tokenize(sent)) \
+                         for sent in sent_tokenize(para_text) ]
     tokenized_para = [ filter(None, x) for x in tokenized_para ]
     tokenized_para = [ x for x in tokenized_para if len(x) > 0 ]
     joined_para = []
@@ -140,21 +194,20 @@ class Data:
 
     joined_para_chars = []
     for word_idx in joined_para:
-      this_char = [ self.dictionary.add_or_get_cindex(char) \
-                      for char in self.dictionary.index_to_word[word_idx] ]
+      this_char = self.dictionary.add_or_get_cindices(
+                    self.dictionary.index_to_word[word_idx])
       joined_para_chars.append(this_char)
 
     return joined_para, joined_para_chars
 
   def word_tokenize_para(self, para_text):
     # Create tokenized paragraph representation.
-    tokenized_para = [ self.dictionary.add_or_get_index(word) \
-                         for word in word_tokenize(para_text) ]
+    tokenized_para = self.dictionary.add_or_get_indices(word_tokenize(para_text))
 
     joined_para_chars = []
     for word_idx in tokenized_para:
-      this_char = [ self.dictionary.add_or_get_cindex(char) \
-                      for char in self.dictionary.index_to_word[word_idx] ]
+      this_char = self.dictionary.add_or_get_cindices(
+                    self.dictionary.index_to_word[word_idx])
       joined_para_chars.append(this_char)
 
     return tokenized_para, joined_para_chars
@@ -176,14 +229,14 @@ class Data:
       self.questions[qa['id']] = qa['question']
 
       # Tokenize question
-      processed_question = [ self.dictionary.add_or_get_index(word) \
-                               for word in word_tokenize(qa['question']) ]
+      processed_question = \
+        self.dictionary.add_or_get_indices(word_tokenize(qa['question']))
       processed_question = filter(None, processed_question)
 
       joined_question_chars = []
       for word_idx in processed_question:
-        this_char = [ self.dictionary.add_or_get_cindex(char) \
-                        for char in self.dictionary.index_to_word[word_idx] ]
+        this_char = self.dictionary.add_or_get_cindices(
+                      self.dictionary.index_to_word[word_idx])
         joined_question_chars.append(this_char)
 
       # Tokenize answer phrases